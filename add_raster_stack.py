@@ -4,11 +4,9 @@ import argparse
 import logging
 import glob
 import shutil
+import tempfile
 
-from ecoshard import geoprocessing
-from ecoshard.geoprocessing.geoprocessing import _GDAL_TYPE_TO_NUMPY_LOOKUP
-from osgeo import gdal
-import numpy
+import stack_reducer
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -18,25 +16,6 @@ logging.basicConfig(
 LOGGER = logging.getLogger(__name__)
 
 
-def _add_with_0(nodata_list, target_nodata):
-    def __add_with_0(*array_list):
-        """Sum the monthly qfis."""
-        running_sum = numpy.zeros(array_list[0].shape)
-        running_valid_mask = numpy.zeros(running_sum.shape, dtype=bool)
-        for local_array, local_nodata in zip(array_list, nodata_list):
-            if local_nodata is not None:
-                local_valid_mask = ~numpy.isclose(local_array, local_nodata)
-            else:
-                local_valid_mask = numpy.ones(local_array.shape, dtype=bool)
-            local_valid_mask &= ~numpy.isnan(local_array)
-            running_sum[local_valid_mask] += local_array[local_valid_mask]
-            running_valid_mask |= local_valid_mask
-        if target_nodata is not None:
-            running_sum[~running_valid_mask] = target_nodata
-        return running_sum
-    return __add_with_0
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Add all rasters together and allow for nodata holes')
@@ -49,21 +28,22 @@ if __name__ == '__main__':
             'Path to target file, if not defined create unique name in '
             'current directory.'))
     parser.add_argument(
-        '--allow_different_blocksizes', action='store_true',
-        help='Set to allow different block size adds')
+        '--allow_different_blocksizes', action='store_true', help=(
+            'no longer needed, rasters are read window by window whatever '
+            'their block size and rasters on different grids are aligned '
+            'on the fly'))
 
     args = parser.parse_args()
 
-    raster_path_band_list = [
-        (path, 1)
+    raster_path_list = [
+        path
         for raster_path_pattern in args.raster_path_pattern
         for path in glob.glob(raster_path_pattern)]
 
-    nodata_list = [
-        geoprocessing.get_raster_info(path[0])['nodata'][0]
-        for path in raster_path_band_list]
-
-    geoprocessing.raster_calculator(
-        raster_path_band_list, _add_with_0(nodata_list, args.target_nodata),
-        args.target_path, gdal.GDT_Float32, args.target_nodata,
-        allow_different_blocksize=args.allow_different_blocksizes)
+    working_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(args.target_path)),
+        prefix='add_raster_stack_workspace')
+    stack_reducer.reduce_stack(
+        raster_path_list, {'sum': args.target_path}, working_dir,
+        target_nodata=args.target_nodata)
+    shutil.rmtree(working_dir)
@@ -2,15 +2,12 @@
 import argparse
 import glob
 import logging
-import os
 import shutil
 import sys
 import tempfile
 
-from ecoshard import geoprocessing
-from osgeo import gdal
 import ecoshard
-import numpy
+import stack_reducer
 
 
 TARGET_AVERAGE_RASTER_PATH = 'average_raster.tif'
@@ -24,55 +21,23 @@ logging.basicConfig(
     stream=sys.stdout)
 LOGGER = logging.getLogger(__name__)
 
-COUNT_NODATA = -1
+COUNT_NODATA = stack_reducer.COUNT_NODATA
 AVERAGE_NODATA = -9999
 
 
-def count_op(*value_nodata_list):
-    """Calculate count of valid pixels over each pixel stack."""
-    result = numpy.zeros(value_nodata_list[0].shape, dtype=numpy.int32)
-    valid_mask = numpy.zeros(result.shape, dtype=bool)
-    list_len = len(value_nodata_list)
-    for array, nodata in zip(
-            value_nodata_list[0:list_len//2],
-            value_nodata_list[list_len//2::]):
-        if nodata is not None:
-            local_valid_mask = ~numpy.isclose(array, nodata)
-        else:
-            local_valid_mask = numpy.ones(array.shape, dtype=bool)
-        result[local_valid_mask] += 1
-        valid_mask |= local_valid_mask
-    result[~valid_mask] = COUNT_NODATA
-    return result
-
-
-def average_op(*value_nodata_list):
-    """Calculate count of valid pixels over each pixel stack."""
-    result = numpy.zeros(value_nodata_list[0].shape, dtype=numpy.float32)
-    count = numpy.zeros(value_nodata_list[0].shape, dtype=numpy.float32)
-    valid_mask = numpy.zeros(result.shape, dtype=bool)
-    list_len = len(value_nodata_list)
-    for array, nodata in zip(
-            value_nodata_list[0:list_len//2],
-            value_nodata_list[list_len//2::]):
-        if nodata is not None:
-            local_valid_mask = ~numpy.isclose(array, nodata)
-        else:
-            local_valid_mask = numpy.ones(array.shape, dtype=bool)
-        count[local_valid_mask] += 1
-        result[local_valid_mask] += array[local_valid_mask]
-        valid_mask |= local_valid_mask
-    result[valid_mask] /= count[valid_mask]
-    result[~valid_mask] = AVERAGE_NODATA
-    return result
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Raster averager.')
     parser.add_argument(
         'raster_pattern', nargs='+', help='List of rasters to average.')
     parser.add_argument(
         '--prefix', default='', help='Prefix to add to output file.')
+    parser.add_argument(
+        '--reductions', nargs='+', default=['mean', 'count'],
+        choices=stack_reducer.REDUCTION_LIST, help=(
+            'per pixel reductions to write in the same pass, mean goes to '
+            f'{TARGET_AVERAGE_RASTER_PATH}, count to '
+            f'{TARGET_VALID_COUNT_RASTER_PATH}, and the rest to '
+            '<reduction>_raster.tif'))
     args = parser.parse_args()
 
     working_dir = tempfile.mkdtemp(dir='.', prefix='avg_raster_workspace')
@@ -80,37 +45,20 @@ if __name__ == '__main__':
     file_list = [
         path for pattern in args.raster_pattern for path in glob.glob(pattern)]
 
-    aligned_list = [
-        os.path.join(working_dir, os.path.basename(path))
-        for path in file_list]
-
-    target_pixel_size = geoprocessing.get_raster_info(
-        file_list[0])['pixel_size']
-
-    geoprocessing.align_and_resize_raster_stack(
-        file_list, aligned_list, ['near'] * len(aligned_list),
-        target_pixel_size, 'union')
-
-    nodata_list = [
-        (geoprocessing.get_raster_info(path)['nodata'][0], 'raw')
-        for path in aligned_list]
-
-    # count valid pixels
-    geoprocessing.raster_calculator(
-        [(path, 1) for path in aligned_list] + nodata_list, count_op,
-        args.prefix+TARGET_VALID_COUNT_RASTER_PATH, gdal.GDT_Int32,
-        COUNT_NODATA)
-
-    # average valid pixels
-    geoprocessing.raster_calculator(
-        [(path, 1) for path in aligned_list] + nodata_list, average_op,
-        args.prefix+TARGET_AVERAGE_RASTER_PATH, gdal.GDT_Float32,
-        AVERAGE_NODATA)
-
-    ecoshard.build_overviews(
-        args.prefix+TARGET_AVERAGE_RASTER_PATH)
-
-    ecoshard.build_overviews(
-        args.prefix+TARGET_VALID_COUNT_RASTER_PATH)
+    reduction_to_target_path_map = {
+        reduction: args.prefix + {
+            'mean': TARGET_AVERAGE_RASTER_PATH,
+            'count': TARGET_VALID_COUNT_RASTER_PATH,
+        }.get(reduction, f'{reduction}_raster.tif')
+        for reduction in args.reductions}
+
+    # rasters on different grids are read through warped VRTs on the union
+    # of their extents at the first raster's pixel size
+    stack_reducer.reduce_stack(
+        file_list, reduction_to_target_path_map, working_dir,
+        target_nodata=AVERAGE_NODATA)
+
+    for target_path in reduction_to_target_path_map.values():
+        ecoshard.build_overviews(target_path)
 
     shutil.rmtree(working_dir)
@@ -0,0 +1,196 @@
+"""Columnar SQLite store of per feature percentile and CDF results.
+
+Results are kept one row per (raster, aggregate vector, feature, nodata0
+flag, percentile) in typed columns rather than as pickled lists so they can
+be filtered and aggregated directly in SQL, for example "the 90% CDF
+threshold of every country for raster X" is a single indexed query. Each
+process holds one connection per database for its lifetime, the database is
+put in WAL mode so readers don't block the writer, and every feature's rows
+are written in a single transaction.
+"""
+import logging
+import os
+import sqlite3
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# maps (process id, thread id, database path) to an open connection
+_CONNECTION_MAP = {}
+
+_CREATE_RESULT_TABLE_SQL = (
+    """
+    CREATE TABLE IF NOT EXISTS feature_percentile (
+        raster_id TEXT NOT NULL,
+        aggregate_vector_id TEXT NOT NULL,
+        feature_id TEXT NOT NULL,
+        nodata0 INT NOT NULL,
+        percentile REAL NOT NULL,
+        percentile_value REAL,
+        cdf_value REAL,
+        PRIMARY KEY (
+            raster_id, aggregate_vector_id, feature_id, nodata0, percentile)
+        ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS feature_percentile_by_vector_percentile ON
+    feature_percentile (raster_id, aggregate_vector_id, nodata0, percentile);
+    """)
+
+
+def get_connection(database_path):
+    """Return this process's persistent connection to ``database_path``.
+
+    The connection is created on first use, switched to WAL journaling, and
+    the result tables are created if they don't exist. Connections are never
+    shared across processes or threads.
+
+    Parameters:
+        database_path (str): path to the SQLite database.
+
+    Returns:
+        sqlite3.Connection.
+
+    """
+    connection_key = (
+        os.getpid(), threading.get_ident(), os.path.abspath(database_path))
+    if connection_key not in _CONNECTION_MAP:
+        connection = sqlite3.connect(database_path, timeout=60.0)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(_CREATE_RESULT_TABLE_SQL)
+        connection.commit()
+        _CONNECTION_MAP[connection_key] = connection
+    return _CONNECTION_MAP[connection_key]
+
+
+def close_connection(database_path):
+    """Close this process's connection to ``database_path`` if it's open."""
+    connection_key = (
+        os.getpid(), threading.get_ident(), os.path.abspath(database_path))
+    connection = _CONNECTION_MAP.pop(connection_key, None)
+    if connection is not None:
+        connection.close()
+
+
+def write_feature_results(
+        database_path, raster_id, aggregate_vector_id, feature_id,
+        percentile_list, result_list, extra_statement_list=()):
+    """Write the percentile and CDF results of one feature.
+
+    All rows and ``extra_statement_list`` are committed in one transaction
+    so a status flag set by an extra statement is never set without its
+    results.
+
+    Parameters:
+        database_path (str): path to the SQLite database.
+        raster_id (str): id of the raster the results were calculated on.
+        aggregate_vector_id (str): id of the aggregate vector.
+        feature_id (str): id of the feature within the aggregate vector.
+        percentile_list (list): percentiles the results are indexed by.
+        result_list (list): list of (nodata0, percentile_value_list,
+            cdf_list) tuples where nodata0 is True if zeros were treated as
+            nodata and the lists are parallel to ``percentile_list``.
+        extra_statement_list (list): list of (sql, argument list) tuples to
+            execute in the same transaction.
+
+    Returns:
+        None.
+
+    """
+    row_list = []
+    for nodata0, percentile_value_list, cdf_list in result_list:
+        row_list.extend([
+            (raster_id, aggregate_vector_id, feature_id, int(nodata0),
+             float(percentile), float(percentile_value), float(cdf_value))
+            for percentile, percentile_value, cdf_value in zip(
+                percentile_list, percentile_value_list, cdf_list)])
+    connection = get_connection(database_path)
+    with connection:
+        connection.executemany(
+            '''
+            INSERT OR REPLACE INTO feature_percentile (
+                raster_id, aggregate_vector_id, feature_id, nodata0,
+                percentile, percentile_value, cdf_value)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', row_list)
+        for sql_string, argument_list in extra_statement_list:
+            connection.execute(sql_string, argument_list)
+
+
+def get_feature_results(
+        database_path, raster_id, aggregate_vector_id, nodata0):
+    """Return the percentile and CDF lists of every feature of a raster.
+
+    Parameters:
+        database_path (str): path to the SQLite database.
+        raster_id (str): id of raster to fetch results for.
+        aggregate_vector_id (str): id of the aggregate vector the features
+            are from, the same raster may be stored under several.
+        nodata0 (bool): if True fetch the results where zeros were treated
+            as nodata.
+
+    Returns:
+        dict mapping feature id to a (percentile_value_list, cdf_list) tuple,
+        both ordered by increasing percentile.
+
+    """
+    feature_result_map = {}
+    for feature_id, percentile_value, cdf_value in get_connection(
+            database_path).execute(
+                '''
+                SELECT feature_id, percentile_value, cdf_value
+                FROM feature_percentile
+                WHERE raster_id=? AND aggregate_vector_id=? AND nodata0=?
+                ORDER BY feature_id, percentile
+                ''', (raster_id, aggregate_vector_id, int(nodata0))):
+        percentile_value_list, cdf_list = feature_result_map.setdefault(
+            feature_id, ([], []))
+        percentile_value_list.append(percentile_value)
+        cdf_list.append(cdf_value)
+    return feature_result_map
+
+
+def get_cdf_threshold(
+        database_path, raster_id, aggregate_vector_id, cdf_fraction,
+        nodata0):
+    """Find where each feature's CDF drops below a fraction of its total.
+
+    Parameters:
+        database_path (str): path to the SQLite database.
+        raster_id (str): id of raster to query.
+        aggregate_vector_id (str): id of the aggregate vector the features
+            are from.
+        cdf_fraction (float): fraction of each feature's total value, i.e.
+            its CDF at the 0th percentile.
+        nodata0 (bool): if True query the results where zeros were treated
+            as nodata.
+
+    Returns:
+        list of (feature_id, percentile, percentile_value, cdf_value) tuples
+        for the lowest percentile of each feature whose CDF is less than
+        ``cdf_fraction`` of the total, sorted by feature id.
+
+    """
+    # SQLite takes the bare columns from the row that holds the MIN
+    return [
+        (feature_id, percentile, percentile_value, cdf_value)
+        for feature_id, percentile, percentile_value, cdf_value in
+        get_connection(database_path).execute(
+            '''
+            SELECT
+                result.feature_id, MIN(result.percentile),
+                result.percentile_value, result.cdf_value
+            FROM feature_percentile AS result
+            JOIN feature_percentile AS total ON
+                total.raster_id=result.raster_id AND
+                total.aggregate_vector_id=result.aggregate_vector_id AND
+                total.feature_id=result.feature_id AND
+                total.nodata0=result.nodata0 AND
+                total.percentile=0
+            WHERE
+                result.raster_id=? AND result.aggregate_vector_id=? AND
+                result.nodata0=? AND result.cdf_value < ? * total.cdf_value
+            GROUP BY result.feature_id
+            ORDER BY result.feature_id
+            ''', (raster_id, aggregate_vector_id, int(nodata0),
+                  cdf_fraction))]
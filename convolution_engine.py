@@ -0,0 +1,270 @@
+"""Strip based 2D convolution that picks the cheapest method per kernel.
+
+``geoprocessing.convolve_2d`` always does a full 2D convolution. Most
+kernels used here have structure that makes that unnecessary:
+
+    * box kernels (every entry equal) are two 1D running sums taken from
+      cumulative sums, the separable form of a summed area table, so the
+      cost doesn't depend on the kernel size at all,
+    * separable kernels (rank 1, e.g. Gaussians) are two 1D convolutions,
+    * anything else is a direct convolution if the kernel is small or an
+      overlap-add FFT convolution if it's large, e.g. radial kernels.
+
+Rasters are processed in full width strips of rows with enough halo rows
+above and below that every output row in the strip sees its whole kernel,
+so the base raster is read once and nothing but the target is written.
+Every method produces the same result as ``scipy.signal.convolve`` with
+``mode='same'`` and zero padding past the raster edges.
+"""
+import hashlib
+import logging
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+import numpy
+import scipy.ndimage
+import scipy.signal
+
+LOGGER = logging.getLogger(__name__)
+
+# a strip including its halo is at most this many pixels
+_LARGEST_STRIP = 2**24
+
+# kernels with at most this many entries are convolved directly
+_MAX_DIRECT_KERNEL_SIZE = 15**2
+
+# a kernel is separable if its second singular value is this small relative
+# to its first
+_SEPARABLE_TOLERANCE = 1e-6
+
+# maps md5 of kernel shape and bytes to its plan
+_KERNEL_PLAN_CACHE = {}
+
+
+def plan_kernel(kernel_array):
+    """Decide how to convolve with ``kernel_array``.
+
+    Plans are cached by the kernel's content so the factorization is only
+    done once per distinct kernel.
+
+    Parameters:
+        kernel_array (numpy.ndarray): 2D kernel.
+
+    Returns:
+        dict with the key 'method' which is one of 'box', 'separable',
+        'direct', or 'fft', 'shape' the kernel shape, and the method's
+        parameters: 'value' for box kernels, 'row_kernel' and 'col_kernel'
+        for separable kernels, and 'kernel' otherwise.
+
+    """
+    kernel_array = numpy.asarray(kernel_array, dtype=numpy.float64)
+    kernel_key = hashlib.md5(
+        str(kernel_array.shape).encode('utf-8') +
+        kernel_array.tobytes()).hexdigest()
+    if kernel_key in _KERNEL_PLAN_CACHE:
+        return _KERNEL_PLAN_CACHE[kernel_key]
+
+    plan = {'shape': kernel_array.shape}
+    if numpy.all(kernel_array == kernel_array.flat[0]):
+        plan['method'] = 'box'
+        plan['value'] = float(kernel_array.flat[0])
+    else:
+        u_array, s_array, vh_array = numpy.linalg.svd(kernel_array)
+        if len(s_array) < 2 or s_array[1] <= (
+                _SEPARABLE_TOLERANCE * s_array[0]):
+            plan['method'] = 'separable'
+            plan['row_kernel'] = u_array[:, 0] * s_array[0]
+            plan['col_kernel'] = vh_array[0, :]
+        elif kernel_array.size <= _MAX_DIRECT_KERNEL_SIZE:
+            plan['method'] = 'direct'
+            plan['kernel'] = kernel_array
+        else:
+            plan['method'] = 'fft'
+            plan['kernel'] = kernel_array
+    LOGGER.debug(
+        'convolving %s kernel with %s method', kernel_array.shape,
+        plan['method'])
+    _KERNEL_PLAN_CACHE[kernel_key] = plan
+    return plan
+
+
+def convolve_array(array, plan):
+    """Convolve a 2D array by a kernel plan with zero padding.
+
+    Parameters:
+        array (numpy.ndarray): 2D array to convolve, zeros are assumed
+            beyond its edges.
+        plan (dict): plan from ``plan_kernel``.
+
+    Returns:
+        float64 array of ``array``'s shape, the same as
+        ``scipy.signal.convolve(array, kernel, mode='same')``.
+
+    """
+    array = numpy.asarray(array, dtype=numpy.float64)
+    if plan['method'] == 'box':
+        result = _box_sum_1d(array, plan['shape'][0], 0)
+        result = _box_sum_1d(result, plan['shape'][1], 1)
+        result *= plan['value']
+        return result
+    if plan['method'] == 'separable':
+        result = array
+        for axis, kernel_1d in [
+                (0, plan['row_kernel']), (1, plan['col_kernel'])]:
+            result = scipy.ndimage.convolve1d(
+                result, kernel_1d, axis=axis, mode='constant', cval=0.0,
+                origin=(len(kernel_1d)-1)//2 - len(kernel_1d)//2)
+        return result
+    if plan['method'] == 'direct':
+        return scipy.ndimage.convolve(
+            array, plan['kernel'], mode='constant', cval=0.0, origin=[
+                (size-1)//2 - size//2 for size in plan['shape']])
+    return scipy.signal.oaconvolve(array, plan['kernel'], mode='same')
+
+
+def _box_sum_1d(array, size, axis):
+    """Sum ``size`` consecutive values along ``axis`` with zero padding.
+
+    Aligned so the result matches convolution by ``numpy.ones(size)`` with
+    ``mode='same'``.
+
+    """
+    pad_width = [(0, 0), (0, 0)]
+    pad_width[axis] = (size//2 + 1, (size-1)//2)
+    cumulative_array = numpy.cumsum(
+        numpy.pad(array, pad_width), axis=axis)
+    n = array.shape[axis]
+    return (
+        numpy.take(cumulative_array, numpy.arange(size, size+n), axis=axis) -
+        numpy.take(cumulative_array, numpy.arange(n), axis=axis))
+
+
+def iter_strips(base_raster_path_band, kernel_shape, largest_strip=None):
+    """Iterate over full width strips of a raster padded with halo rows.
+
+    Parameters:
+        base_raster_path_band (tuple): (path, band index) of raster to read.
+        kernel_shape (tuple): (rows, cols) of the kernel the strips will be
+            convolved with.
+        largest_strip (int): largest number of pixels, including halo, to
+            read at once. Defaults to ``_LARGEST_STRIP``.
+
+    Yields:
+        (offset_dict, strip_array, valid_slice) tuples. ``offset_dict`` is
+        the iterblocks style window of the output rows. ``strip_array`` is a
+        float64 array of those rows plus the halo, NaN where the halo is
+        beyond the raster. ``strip_array[valid_slice]`` are the output rows.
+
+    """
+    if largest_strip is None:
+        largest_strip = _LARGEST_STRIP
+    raster = gdal.OpenEx(base_raster_path_band[0], gdal.OF_RASTER)
+    band = raster.GetRasterBand(base_raster_path_band[1])
+    n_cols, n_rows = raster.RasterXSize, raster.RasterYSize
+    halo_above = kernel_shape[0] // 2
+    halo_below = (kernel_shape[0]-1) // 2
+    block_ysize = band.GetBlockSize()[1]
+    # whole raster blocks of rows per strip but at least one row
+    strip_rows = max(1, largest_strip // n_cols - halo_above - halo_below)
+    if strip_rows > block_ysize:
+        strip_rows -= strip_rows % block_ysize
+
+    for yoff in range(0, n_rows, strip_rows):
+        win_ysize = min(strip_rows, n_rows - yoff)
+        read_yoff = max(0, yoff - halo_above)
+        read_ysize = min(n_rows, yoff + win_ysize + halo_below) - read_yoff
+        read_array = band.ReadAsArray(
+            xoff=0, yoff=read_yoff, win_xsize=n_cols,
+            win_ysize=read_ysize).astype(numpy.float64)
+        pad_above = halo_above - (yoff - read_yoff)
+        pad_below = halo_below - (
+            read_yoff + read_ysize - (yoff + win_ysize))
+        if pad_above or pad_below:
+            read_array = numpy.pad(
+                read_array, ((pad_above, pad_below), (0, 0)),
+                constant_values=numpy.nan)
+        yield (
+            {'xoff': 0, 'yoff': yoff, 'win_xsize': n_cols,
+             'win_ysize': win_ysize},
+            read_array, slice(halo_above, halo_above + win_ysize))
+    band = None
+    raster = None
+
+
+def convolve_2d(
+        signal_path_band, kernel_path_band, target_path,
+        ignore_nodata_and_edges=False, mask_nodata=True,
+        normalize_kernel=False, target_datatype=gdal.GDT_Float64,
+        target_nodata=None,
+        raster_driver_creation_tuple=(
+            geoprocessing.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS),
+        largest_strip=None):
+    """Convolve a raster with a kernel raster.
+
+    Takes the same arguments and has the same meaning as
+    ``geoprocessing.convolve_2d`` but convolves with whichever method
+    ``plan_kernel`` picks. Signal nodata and non-finite pixels are treated
+    as 0.
+
+    Parameters:
+        signal_path_band (tuple): (path, band index) of signal raster.
+        kernel_path_band (tuple): (path, band index) of kernel raster.
+        target_path (str): path to target raster, same grid as the signal.
+        ignore_nodata_and_edges (bool): if True, divide the result by the
+            convolution of the signal's valid mask so nodata and the area
+            past the edges don't pull the result toward 0.
+        mask_nodata (bool): if True, pixels that are nodata in the signal
+            are nodata in the target.
+        normalize_kernel (bool): if True, divide the kernel by its sum.
+        target_datatype (int): GDAL type of the target.
+        target_nodata (numeric): target nodata, if None the minimum float32
+            is used.
+        raster_driver_creation_tuple (tuple): driver name and creation
+            options for the target.
+        largest_strip (int): largest number of pixels to read at once.
+
+    Returns:
+        None.
+
+    """
+    kernel_raster = gdal.OpenEx(kernel_path_band[0], gdal.OF_RASTER)
+    kernel_array = kernel_raster.GetRasterBand(
+        kernel_path_band[1]).ReadAsArray().astype(numpy.float64)
+    kernel_raster = None
+    kernel_nodata = geoprocessing.get_raster_info(kernel_path_band[0])[
+        'nodata'][kernel_path_band[1]-1]
+    if kernel_nodata is not None:
+        kernel_array[kernel_array == kernel_nodata] = 0.0
+    if normalize_kernel:
+        kernel_array /= numpy.sum(kernel_array)
+    plan = plan_kernel(kernel_array)
+
+    if target_nodata is None:
+        target_nodata = float(numpy.finfo(numpy.float32).min)
+    signal_nodata = geoprocessing.get_raster_info(signal_path_band[0])[
+        'nodata'][signal_path_band[1]-1]
+    geoprocessing.new_raster_from_base(
+        signal_path_band[0], target_path, target_datatype, [target_nodata],
+        raster_driver_creation_tuple=raster_driver_creation_tuple)
+    target_raster = gdal.OpenEx(target_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+    target_band = target_raster.GetRasterBand(1)
+
+    for offset_dict, strip_array, valid_slice in iter_strips(
+            signal_path_band, plan['shape'], largest_strip=largest_strip):
+        valid_mask = numpy.isfinite(strip_array)
+        if signal_nodata is not None:
+            valid_mask &= strip_array != signal_nodata
+        signal_array = numpy.where(valid_mask, strip_array, 0.0)
+        result = convolve_array(signal_array, plan)[valid_slice]
+        if ignore_nodata_and_edges:
+            coverage_array = convolve_array(valid_mask, plan)[valid_slice]
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                result /= coverage_array
+            result[coverage_array <= 0] = target_nodata
+        if mask_nodata:
+            result[~valid_mask[valid_slice]] = target_nodata
+        target_band.WriteArray(
+            result, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+
+    target_band = None
+    target_raster = None
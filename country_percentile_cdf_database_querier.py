@@ -1,44 +1,35 @@
 """Tracer script showing how to interact with CDF country database."""
-import bisect
-import pickle
-
-from taskgraph.Task import _execute_sqlite
+import cdf_result_store
 
 
 WORK_DATABASE_PATH = 'work_status.db'
 
-PERCENTILE_LIST = list(range(0, 101, 1))
+RASTER_ID = (
+    'realized_grazing_natnotforest_clamped0_'
+    'md5_8eeb02139f0fabf552658f7641ab7576')
+AGGREGATE_VECTOR_ID = 'world_borders'
 
 
 def main():
-    result = _execute_sqlite(
-        '''
-        SELECT
-          percentile_list, percentile0_list, cdf, cdfnodata0
-        FROM job_status
-        WHERE raster_id=? AND feature_id=?;
-        ''',
-        WORK_DATABASE_PATH, execute='execute', argument_list=[
-            'realized_grazing_natnotforest_clamped0_md5_8eeb02139f0fabf552658f7641ab7576',
-            'CHN'],
-        fetch='one')
-
-    for index, list_id in enumerate(
-            ['percentile_list', 'percentile0_list', 'cdf', 'cdfnodata0']):
-        print('%s: %s' % (list_id, pickle.loads(result[index])))
-
-    cdf_list = pickle.loads(result[3])
-    percent_of_total_value = [x/cdf_list[0] for x in cdf_list]
-    print('%s:\n%s' % ('cdf', '\n'.join([
-        '%3.d %10.2f %5.2f' % (percentile, cdf, percent_of_total_value)
-        for percentile, cdf, percent_of_total_value in
-        zip(PERCENTILE_LIST, cdf_list, percent_of_total_value)])))
-
+    feature_result_map = cdf_result_store.get_feature_results(
+        WORK_DATABASE_PATH, RASTER_ID, AGGREGATE_VECTOR_ID, False)
+    feature_nodata0_result_map = cdf_result_store.get_feature_results(
+        WORK_DATABASE_PATH, RASTER_ID, AGGREGATE_VECTOR_ID, True)
+    for list_id, value_list in [
+            ('percentile_list', feature_result_map['CHN'][0]),
+            ('percentile0_list', feature_nodata0_result_map['CHN'][0]),
+            ('cdf', feature_result_map['CHN'][1]),
+            ('cdfnodata0', feature_nodata0_result_map['CHN'][1])]:
+        print('%s: %s' % (list_id, value_list))
+
+    # the threshold of every country is one query, no per row decoding
     cdf_threshold_value = .9
-    threshold_index = bisect.bisect_left(
-        percent_of_total_value[::-1], cdf_threshold_value)
-    print('threshold val:\n%s: %s' % (
-        cdf_threshold_value, cdf_list[len(cdf_list)-threshold_index]))
+    print('threshold val:\n%s:' % cdf_threshold_value)
+    for feature_id, percentile, _, cdf_value in (
+            cdf_result_store.get_cdf_threshold(
+                WORK_DATABASE_PATH, RASTER_ID, AGGREGATE_VECTOR_ID,
+                cdf_threshold_value, True)):
+        print('%s %3.d %10.2f' % (feature_id, percentile, cdf_value))
 
 
 if __name__ == '__main__':
@@ -1,10 +1,9 @@
 """Tracer script showing how to interact with CDF country database."""
 import logging
 import os
-import pickle
 import sys
 
-from taskgraph.Task import _execute_sqlite
+import cdf_result_store
 import numpy
 
 
@@ -65,47 +64,45 @@ def main():
     except OSError:
         pass
     LOGGER.debug('building histogram/cdf')
-    raster_id_list = _execute_sqlite(
-        '''
-        SELECT raster_id
-        FROM job_status
-        GROUP BY raster_id
-        ''',
-        WORK_DATABASE_PATH, execute='execute', argument_list=[],
-        fetch='all')
-    for (raster_id,) in raster_id_list:
-        LOGGER.debug('building csv for %s', raster_id)
-        result = _execute_sqlite(
+    raster_vector_id_list = cdf_result_store.get_connection(
+        WORK_DATABASE_PATH).execute(
             '''
-            SELECT
-              feature_id, percentile_list, percentile0_list, cdf, cdfnodata0
-            FROM job_status
-            WHERE raster_id=?
-            ''',
-            WORK_DATABASE_PATH, execute='execute', argument_list=[raster_id],
-            fetch='all')
-
+            SELECT raster_id, aggregate_vector_id
+            FROM feature_percentile
+            GROUP BY raster_id, aggregate_vector_id
+            ''').fetchall()
+    for raster_id, aggregate_vector_id in raster_vector_id_list:
+        LOGGER.debug('building csv for %s %s', raster_id, aggregate_vector_id)
+        feature_result_map = cdf_result_store.get_feature_results(
+            WORK_DATABASE_PATH, raster_id, aggregate_vector_id, False)
+        feature_nodata0_result_map = cdf_result_store.get_feature_results(
+            WORK_DATABASE_PATH, raster_id, aggregate_vector_id, True)
+
+        # cdfs are stored by increasing percentile, interpolate them in
+        # increasing value order
         percentile_map = {
             feature_id: (
-                pickle.loads(percentile_list),
-                pickle.loads(percentile0_list),
-                linear_interpolate_cdf(pickle.loads(cdf)[::-1]),
-                linear_interpolate_cdf(pickle.loads(cdfnodata0)[::-1]))
-            for (feature_id, percentile_list, percentile0_list,
-                 cdf, cdfnodata0) in result
-            if None not in (
-                feature_id, percentile_list, percentile0_list, cdf, cdfnodata0)
+                feature_result_map[feature_id][0],
+                feature_nodata0_result_map[feature_id][0],
+                linear_interpolate_cdf(
+                    feature_result_map[feature_id][1][::-1]),
+                linear_interpolate_cdf(
+                    feature_nodata0_result_map[feature_id][1][::-1]))
+            for feature_id in feature_result_map
+            if feature_id in feature_nodata0_result_map
         }
 
+        # the same raster may be summarized by several aggregate vectors
+        csv_prefix = '%s_%s' % (aggregate_vector_id, raster_id)
         csv_percentile_path = os.path.join(
-            WORKSPACE_DIR, '%s_percentile.csv' % raster_id)
+            WORKSPACE_DIR, '%s_percentile.csv' % csv_prefix)
         csv_nodata0_percentile_path = os.path.join(
-            WORKSPACE_DIR, '%s_nodata0_percentile.csv' % raster_id)
+            WORKSPACE_DIR, '%s_nodata0_percentile.csv' % csv_prefix)
 
         csv_cdf_path = os.path.join(
-            WORKSPACE_DIR, '%s_cdf.csv' % raster_id)
+            WORKSPACE_DIR, '%s_cdf.csv' % csv_prefix)
         csv_nodata0_cdf_path = os.path.join(
-            WORKSPACE_DIR, '%s_nodata0_cdf.csv' % raster_id)
+            WORKSPACE_DIR, '%s_nodata0_cdf.csv' % csv_prefix)
 
         with open(csv_cdf_path, 'w') as csv_cdf_file:
             csv_cdf_file.write('%s cdfs' % raster_id)
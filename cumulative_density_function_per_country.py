@@ -9,14 +9,11 @@ import logging.handlers
 import multiprocessing
 import multiprocessing.managers
 import os
-import pathlib
-import pickle
+import queue
 import shutil
-import sqlite3
 import subprocess
 import sys
 import time
-import threading
 
 from ecoshard import geoprocessing
 from osgeo import gdal
@@ -25,6 +22,7 @@ from osgeo import osr
 import numpy
 import retrying
 from ecoshard import taskgraph
+import cdf_result_store
 
 gdal.SetCacheMax(2**30)
 gdal.UseExceptions()
@@ -104,6 +102,11 @@ WORK_DATABASE_PATH = os.path.join(CHURN_DIR, 'work_status.db')
 
 SKIP_THESE_FEATURE_IDS = ['ATA']
 
+# the stitch worker writes queued tiles when the stitch queue has been empty
+# this long or when more than this many pixels are queued
+_STITCH_IDLE_SECONDS = 5.0
+_STITCH_FLUSH_PIXELS = 2**27
+
 
 def error_callback(exception):
     LOGGER.debug("got an exception:")
@@ -117,35 +120,215 @@ def country_nodata0_op(base_array, nodata):
     return result
 
 
-def stitch_manager(
-        lock_map, cpu_semaphore, worker_pool, stitch_queue,
-        raster_id_to_global_stitch_path_map):
-    """Thread to manage jobs to fork off to stitch workers.
+def stitch_worker(stitch_queue, raster_id_to_global_stitch_path_map):
+    """Process to stitch country tiles into the global rasters.
+
+    This is the only process that writes to the global rasters. Each global
+    raster is opened once and held open for the run. Incoming tile blocks
+    are split on the global raster's block grid and queued rather than
+    written. Queued windows are flushed when the stitch queue goes idle or
+    more than ``_STITCH_FLUSH_PIXELS`` pixels are queued. A flush reads each
+    touched global block once, applies every queued window over it in
+    arrival order, and writes it back once. Tiles are marked stitched in the
+    database only after the flush that wrote them.
 
     Parameters:
-        lock_map (dict): maps global raster paths to lock objects.
-        cpu_semaphore (bounded semaphore): acquire this when sending a job
-            the job should release it
-        worker_pool (multiprocessing.Pool): send work to this pool
-        stitch_queue (JoinableQueue): stitching orders come through here.
-        raster_id_to_global_stitch_map_path (dict): used to
+        stitch_queue (Queue): payloads come in as an alert that a sub raster
+            is ready for stitching into the global raster. Payloads are of
+            the form (bin_raster_path,(raster_id, aggregate_vector_id,
+            nodataflag)) and index into `raster_id_to_global_stitch_path_map`.
+            If 'STOP', flush and shut down.
+        raster_id_to_global_stitch_path_map (dict): dictionary indexed by
+            raster id, aggregate id, and nodata flag tuple to the global
+            raster.
 
     Returns:
         None when 'STOP' comes through the stitch queue.
 
     """
-    while True:
-        payload = stitch_queue.get()
-        if payload == 'STOP':
-            return
-        LOGGER.debug('stitch manager got this payload: %s', str(payload))
-        local_tile_raster_path, raster_aggregate_nodata_id_tuple = payload
-        cpu_semaphore.acquire()
-        worker_pool.apply_async(
-            func=stitch_raster,
-            args=(
-                lock_map, cpu_semaphore, payload,
-                raster_id_to_global_stitch_path_map))
+    try:
+        # maps global raster path to a dict of its open dataset, band, block
+        # size, queued windows by block offset, and payloads it holds
+        global_stitch_map = {}
+        queued_pixel_count = 0
+        while True:
+            try:
+                payload = stitch_queue.get(timeout=_STITCH_IDLE_SECONDS)
+            except queue.Empty:
+                if queued_pixel_count > 0:
+                    _flush_stitches(global_stitch_map)
+                    queued_pixel_count = 0
+                continue
+            if payload == 'STOP':
+                _flush_stitches(global_stitch_map)
+                break
+            LOGGER.debug('stitch worker got this payload: %s', str(payload))
+            local_tile_raster_path, raster_aggregate_nodata_id_tuple = payload
+            global_stitch_raster_path = raster_id_to_global_stitch_path_map[
+                raster_aggregate_nodata_id_tuple]
+            if global_stitch_raster_path not in global_stitch_map:
+                global_raster = gdal.OpenEx(
+                    global_stitch_raster_path,
+                    gdal.OF_RASTER | gdal.OF_UPDATE)
+                global_band = global_raster.GetRasterBand(1)
+                global_stitch_map[global_stitch_raster_path] = {
+                    'raster': global_raster,
+                    'band': global_band,
+                    'block_size': global_band.GetBlockSize(),
+                    'block_window_map': {},
+                    'payload_list': [],
+                }
+            queued_pixel_count += _queue_tile_windows(
+                local_tile_raster_path,
+                global_stitch_map[global_stitch_raster_path])
+            global_stitch_map[global_stitch_raster_path][
+                'payload_list'].append(payload)
+            if queued_pixel_count > _STITCH_FLUSH_PIXELS:
+                _flush_stitches(global_stitch_map)
+                queued_pixel_count = 0
+
+        for global_stitch in global_stitch_map.values():
+            global_stitch['band'] = None
+            global_stitch['raster'] = None
+        LOGGER.debug('stitch worker done')
+    except Exception:
+        LOGGER.exception('error in stitch worker')
+        raise
+
+
+def _queue_tile_windows(local_tile_raster_path, global_stitch):
+    """Split a tile into global block windows and queue them for writing.
+
+    Parameters:
+        local_tile_raster_path (str): path to a country tile on the same grid
+            as the global raster.
+        global_stitch (dict): the global raster's entry from
+            ``stitch_worker``, windows are appended to its
+            'block_window_map'.
+
+    Returns:
+        number of tile pixels queued.
+
+    """
+    local_tile_info = geoprocessing.get_raster_info(local_tile_raster_path)
+    global_band = global_stitch['band']
+    global_inv_gt = gdal.InvGeoTransform(
+        global_stitch['raster'].GetGeoTransform())
+    local_gt = local_tile_info['geotransform']
+    global_i, global_j = [
+        int(round(val)) for val in gdal.ApplyGeoTransform(
+            global_inv_gt, local_gt[0], local_gt[3])]
+    block_xsize, block_ysize = global_stitch['block_size']
+    block_window_map = global_stitch['block_window_map']
+
+    queued_pixel_count = 0
+    for offset_dict, local_array in geoprocessing.iterblocks(
+            (local_tile_raster_path, 1)):
+        valid_mask = ~numpy.isclose(
+            local_array, local_tile_info['nodata'][0])
+        if not numpy.any(valid_mask):
+            continue
+        # clip the window to the global raster
+        x_min = max(global_i + offset_dict['xoff'], 0)
+        y_min = max(global_j + offset_dict['yoff'], 0)
+        x_max = min(
+            global_i + offset_dict['xoff'] + local_array.shape[1],
+            global_band.XSize)
+        y_max = min(
+            global_j + offset_dict['yoff'] + local_array.shape[0],
+            global_band.YSize)
+        for block_yoff in range(
+                y_min // block_ysize * block_ysize, y_max, block_ysize):
+            for block_xoff in range(
+                    x_min // block_xsize * block_xsize, x_max, block_xsize):
+                window_x_min = max(x_min, block_xoff)
+                window_y_min = max(y_min, block_yoff)
+                window_x_max = min(x_max, block_xoff + block_xsize)
+                window_y_max = min(y_max, block_yoff + block_ysize)
+                local_slice = (
+                    slice(
+                        window_y_min - global_j - offset_dict['yoff'],
+                        window_y_max - global_j - offset_dict['yoff']),
+                    slice(
+                        window_x_min - global_i - offset_dict['xoff'],
+                        window_x_max - global_i - offset_dict['xoff']))
+                window_valid_mask = valid_mask[local_slice]
+                if not numpy.any(window_valid_mask):
+                    continue
+                block_window_map.setdefault(
+                    (block_xoff, block_yoff), []).append((
+                        (slice(window_y_min - block_yoff,
+                               window_y_max - block_yoff),
+                         slice(window_x_min - block_xoff,
+                               window_x_max - block_xoff)),
+                        local_array[local_slice].copy(),
+                        window_valid_mask))
+                queued_pixel_count += window_valid_mask.size
+    return queued_pixel_count
+
+
+def _flush_stitches(global_stitch_map):
+    """Write all queued windows with one read and write per global block.
+
+    Parameters:
+        global_stitch_map (dict): maps global raster paths to the entries
+            built by ``stitch_worker``. Queued windows and payloads are
+            cleared once written.
+
+    Returns:
+        None.
+
+    """
+    for global_stitch_raster_path, global_stitch in sorted(
+            global_stitch_map.items()):
+        if not global_stitch['payload_list']:
+            continue
+        global_band = global_stitch['band']
+        block_xsize, block_ysize = global_stitch['block_size']
+        LOGGER.debug(
+            'flushing %d blocks from %d tiles into %s',
+            len(global_stitch['block_window_map']),
+            len(global_stitch['payload_list']), global_stitch_raster_path)
+        # row major order walks the file in the order GDAL stores it
+        for (block_xoff, block_yoff), window_list in sorted(
+                global_stitch['block_window_map'].items(),
+                key=lambda item: (item[0][1], item[0][0])):
+            global_array = global_band.ReadAsArray(
+                xoff=block_xoff, yoff=block_yoff,
+                win_xsize=min(block_xsize, global_band.XSize - block_xoff),
+                win_ysize=min(block_ysize, global_band.YSize - block_yoff))
+            for block_slice, local_array, valid_mask in window_list:
+                global_array[block_slice][valid_mask] = local_array[
+                    valid_mask]
+            global_band.WriteArray(
+                global_array, xoff=block_xoff, yoff=block_yoff)
+        global_band.FlushCache()
+        global_stitch['block_window_map'] = {}
+
+        # update the done database now the tiles are on disk
+        for nodata_id, stitched_field, bin_path_field in [
+                ('', 'stitched_bin', 'bin_raster_path'),
+                ('nodata0', 'stitched_bin_nodata0',
+                 'bin_nodata0_raster_path')]:
+            argument_list = [
+                (local_tile_raster_path, raster_id, aggregate_vector_id)
+                for local_tile_raster_path, (
+                    raster_id, aggregate_vector_id, payload_nodata_id) in
+                global_stitch['payload_list']
+                if payload_nodata_id == nodata_id]
+            if not argument_list:
+                continue
+            _execute_sqlite(
+                f'''
+                UPDATE job_status
+                    SET
+                      {stitched_field}=1
+                    WHERE
+                        {bin_path_field}=? AND raster_id=? AND
+                        aggregate_vector_id=?
+                ''', WORK_DATABASE_PATH, mode='modify',
+                execute='many', argument_list=argument_list)
+        global_stitch['payload_list'] = []
 
 
 def create_status_database(database_path):
@@ -169,10 +352,7 @@ def create_status_database(database_path):
             aggregate_vector_id TEXT NOT NULL,
             fieldname_id TEXT NOT NULL,
             feature_id TEXT NOT NULL,
-            percentile_list BLOB,
-            percentile0_list BLOB,
-            cdf BLOB,
-            cdfnodata0 BLOB,
+            results_stored INT NOT NULL DEFAULT 0,
             stitched_bin INT NOT NULL,
             stitched_bin_nodata0 INT NOT NULL,
             bin_raster_path TEXT,
@@ -182,12 +362,15 @@ def create_status_database(database_path):
         CREATE UNIQUE INDEX unique_job_status ON
         job_status (raster_id, aggregate_vector_id, fieldname_id, feature_id);
         """)
-    if os.path.exists(database_path):
-        os.remove(database_path)
-    connection = sqlite3.connect(database_path)
+    cdf_result_store.close_connection(database_path)
+    for path in [
+            database_path, '%s-wal' % database_path,
+            '%s-shm' % database_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    connection = cdf_result_store.get_connection(database_path)
     connection.executescript(create_database_sql)
     connection.commit()
-    connection.close()
 
 
 def feature_worker(
@@ -316,23 +499,21 @@ def feature_worker(
                       percentile_nodata0_task.get()),
                 task_name='calculate cdf for %s' % country_nodata0_raster_path)
 
-            _execute_sqlite(
-                '''
+            cdf_result_store.write_feature_results(
+                WORK_DATABASE_PATH, raster_id, aggregate_vector_id,
+                feature_id, PERCENTILE_LIST, [
+                    (False, percentile_task.get(), cdf_task.get()),
+                    (True, percentile_nodata0_task.get(),
+                     cdf_nodata0_task.get())],
+                extra_statement_list=[(
+                    '''
                     UPDATE job_status
-                    SET
-                      percentile_list=?, percentile0_list=?,
-                      cdf=?, cdfnodata0=?
+                    SET results_stored=1
                     WHERE
                         raster_id=? AND aggregate_vector_id=? AND
                         feature_id=? AND fieldname_id=?
-                ''',
-                WORK_DATABASE_PATH, execute='execute', mode='modify',
-                argument_list=[
-                    pickle.dumps(percentile_task.get()),
-                    pickle.dumps(percentile_nodata0_task.get()),
-                    pickle.dumps(cdf_task.get()),
-                    pickle.dumps(cdf_nodata0_task.get()),
-                    raster_id, aggregate_vector_id, feature_id, fieldname_id])
+                    ''', [raster_id, aggregate_vector_id, feature_id,
+                          fieldname_id])])
 
             LOGGER.debug(
                 'percentile_nodata0_task: %s', percentile_nodata0_task.get())
@@ -678,7 +859,6 @@ def main():
             raster_id_agg_vector_tuples))
 
     m_manager = multiprocessing.Manager()
-    lock_map = m_manager.dict()
     raster_id_to_global_stitch_path_map = {}
     # This loop sets up empty rasters for stitching, one per raster type
     # / aggregate id / regular/nodata
@@ -693,7 +873,6 @@ def main():
                     fieldname_id))
             global_stitch_raster_path = os.path.join(
                 WORKSPACE_DIR, '%s.tif' % global_stitch_raster_id)
-            lock_map[global_stitch_raster_path] = m_manager.Lock()
             LOGGER.debug(
                 'make a global stitch raster: %s',
                 global_stitch_raster_path)
@@ -769,7 +948,7 @@ def main():
         FROM job_status
         WHERE
             (bin_raster_path is NULL and feature_id != '_GLOBAL') OR
-            (percentile_list is NULL and feature_id = '_GLOBAL')
+            (results_stored=0 and feature_id = '_GLOBAL')
         ORDER BY feature_id
         ''', WORK_DATABASE_PATH, execute='execute', argument_list=[],
         fetch='all')
@@ -799,13 +978,10 @@ def main():
         worker_list.append(country_worker_process)
         work_queue.put('STOP')  # a sentinal per process
 
-    cpu_semaphore = m_manager.BoundedSemaphore(NCPUS*2)
-    stitch_manager_thread = threading.Thread(
-        target=stitch_manager,
-        args=(
-            lock_map, cpu_semaphore, worker_pool, stitch_queue,
-            raster_id_to_global_stitch_path_map))
-    stitch_manager_thread.start()
+    stitch_worker_process = multiprocessing.Process(
+        target=stitch_worker,
+        args=(stitch_queue, raster_id_to_global_stitch_path_map))
+    stitch_worker_process.start()
 
     LOGGER.debug('wait for workers to stop in tihs list: %s', str(worker_list))
     work_queue.join()
@@ -813,46 +989,41 @@ def main():
 
     # don't stop stitching until all the fragments have been run
     stitch_queue.put('STOP')
-    LOGGER.debug('wait for stitch_manager to complete')
-    stitch_manager_thread.join()
+    LOGGER.debug('wait for stitch_worker to complete')
+    stitch_worker_process.join()
     worker_pool.close()
     worker_pool.join()
 
     LOGGER.debug('building histogram/cdf')
-    for (raster_id, _, _), raster_path in raster_id_to_path_map.items():
+    for (raster_id, aggregate_vector_id, _), raster_path in (
+            raster_id_to_path_map.items()):
 
         LOGGER.debug('building csv for %s %s', raster_id, raster_path)
-        result = _execute_sqlite(
-            '''
-            SELECT
-              feature_id, percentile_list, percentile0_list, cdf, cdfnodata0
-            FROM job_status
-            WHERE raster_id=?;
-            ''',
-            WORK_DATABASE_PATH, execute='execute', argument_list=[raster_id],
-            fetch='all')
-
+        feature_result_map = cdf_result_store.get_feature_results(
+            WORK_DATABASE_PATH, raster_id, aggregate_vector_id, False)
+        feature_nodata0_result_map = cdf_result_store.get_feature_results(
+            WORK_DATABASE_PATH, raster_id, aggregate_vector_id, True)
         percentile_map = {
             feature_id: (
-                pickle.loads(percentile_list),
-                pickle.loads(percentile0_list),
-                pickle.loads(cdf),
-                pickle.loads(cdfnodata0))
-            for (feature_id, percentile_list, percentile0_list,
-                 cdf, cdfnodata0) in result
-            if None not in (
-                feature_id, percentile_list, percentile0_list, cdf, cdfnodata0)
+                feature_result_map[feature_id][0],
+                feature_nodata0_result_map[feature_id][0],
+                feature_result_map[feature_id][1],
+                feature_nodata0_result_map[feature_id][1])
+            for feature_id in feature_result_map
+            if feature_id in feature_nodata0_result_map
         }
 
+        # the same raster may be summarized by several aggregate vectors
+        csv_prefix = '%s_%s' % (aggregate_vector_id, raster_id)
         csv_percentile_path = os.path.join(
-            WORKSPACE_DIR, '%s_percentile.csv' % raster_id)
+            WORKSPACE_DIR, '%s_percentile.csv' % csv_prefix)
         csv_nodata0_percentile_path = os.path.join(
-            WORKSPACE_DIR, '%s_nodata0_percentile.csv' % raster_id)
+            WORKSPACE_DIR, '%s_nodata0_percentile.csv' % csv_prefix)
 
         csv_cdf_path = os.path.join(
-            WORKSPACE_DIR, '%s_cdf.csv' % raster_id)
+            WORKSPACE_DIR, '%s_cdf.csv' % csv_prefix)
         csv_nodata0_cdf_path = os.path.join(
-            WORKSPACE_DIR, '%s_nodata0_cdf.csv' % raster_id)
+            WORKSPACE_DIR, '%s_nodata0_cdf.csv' % csv_prefix)
 
         with open(csv_cdf_path, 'w') as csv_cdf_file:
             csv_cdf_file.write('%s cdfs' % raster_id)
@@ -924,111 +1095,6 @@ def calculate_cdf(raster_path, percentile_list):
     return cdf_array
 
 
-def stitch_raster(
-        lock_map, cpu_semaphore, payload, raster_id_to_global_stitch_path_map):
-    """Stitch incoming country rasters into global raster.
-
-    Parameters:
-        lock_map (dict): maps global raster paths to locks so we don't
-        cpu_semaphore (BoundedSemaphore): release this when stitch is done
-        payload (tuple): payloads come in as an alert that a sub raster
-            is ready for stitching into the global raster. Payloads are of the
-            form (bin_raster_path,(raster_id, aggregate_vector_id, nodataflag))
-            is indexed into
-            `raster_id_to_global_stitch_path_map[
-                (raster_id, aggregate_id, nodata_flag)]`.
-        raster_id_to_global_stitch_path_map (dict): dictionary indexed by
-            raster id, aggregate id, and nodata flag tuple to the global
-            raster.
-
-    """
-    local_tile_raster_path, raster_aggregate_nodata_id_tuple = payload
-    global_stitch_raster_path = raster_id_to_global_stitch_path_map[
-        raster_aggregate_nodata_id_tuple]
-
-    # get ul of tile and figure out where it goes in global
-    local_tile_info = geoprocessing.get_raster_info(
-        local_tile_raster_path)
-    global_stitch_info = geoprocessing.get_raster_info(
-        global_stitch_raster_path)
-    global_inv_gt = gdal.InvGeoTransform(
-        global_stitch_info['geotransform'])
-    local_gt = local_tile_info['geotransform']
-    global_i, global_j = gdal.ApplyGeoTransform(
-        global_inv_gt, local_gt[0], local_gt[3])
-
-    for offsect_dict, local_array in geoprocessing.iterblocks(
-            (local_tile_raster_path, 1)):
-        valid_mask = ~numpy.isclose(
-            local_array, local_tile_info['nodata'][0])
-        if valid_mask.size > 0:
-            with lock_map[global_stitch_raster_path]:
-                global_raster = gdal.OpenEx(
-                    global_stitch_raster_path, gdal.OF_RASTER | gdal.GA_Update)
-
-                LOGGER.debug(
-                    'stitching this %s into this %s',
-                    payload, global_stitch_raster_path)
-                global_band = global_raster.GetRasterBand(1)
-                local_i = global_i+offsect_dict['xoff']
-                local_j = global_j+offsect_dict['yoff']
-                global_array = global_band.ReadAsArray(
-                    xoff=local_i,
-                    yoff=local_j,
-                    win_xsize=local_array.shape[1],
-                    win_ysize=local_array.shape[0])
-                global_array[valid_mask] = local_array[valid_mask]
-                win_ysize_write, win_xsize_write = global_array.shape
-                if win_ysize_write == 0 or win_xsize_write == 0:
-                    raise ValueError(
-                        'got zeros on sizes: %d %d %s',
-                        win_ysize_write, win_xsize_write, payload)
-                if local_i + win_xsize_write >= global_band.XSize:
-                    win_xsize_write = int(global_band.XSize - local_i)
-                if local_j + win_ysize_write >= global_band.YSize:
-                    win_ysize_write = int(global_band.YSize - local_j)
-
-                global_band.WriteArray(
-                    global_array[0:win_ysize_write, 0:win_xsize_write],
-                    xoff=local_i, yoff=local_j)
-                global_band.FlushCache()
-                global_band = None
-                global_raster = None
-
-    # update the done database
-    if raster_aggregate_nodata_id_tuple[2] == '':
-        sql_string = '''
-            UPDATE job_status
-                SET
-                  stitched_bin=1
-                WHERE
-                    bin_raster_path=? AND raster_id=? AND
-                    aggregate_vector_id=?
-            '''
-    else:
-        sql_string = '''
-            UPDATE job_status
-                SET
-                  stitched_bin_nodata0=1
-                WHERE
-                    bin_nodata0_raster_path=? AND raster_id=? AND
-                    aggregate_vector_id=?
-            '''
-    LOGGER.debug(
-        'update the database with this command %s\nand these data:%s',
-        sql_string, [
-            local_tile_raster_path,
-            raster_aggregate_nodata_id_tuple[0],
-            raster_aggregate_nodata_id_tuple[1]])
-    _execute_sqlite(
-        sql_string, WORK_DATABASE_PATH, mode='modify',
-        execute='execute', argument_list=[
-            local_tile_raster_path,
-            raster_aggregate_nodata_id_tuple[0],
-            raster_aggregate_nodata_id_tuple[1]])
-    cpu_semaphore.release()
-
-
 def new_raster_from_base(
         base_raster, target_base_id, target_dir, target_datatype,
         target_nodata):
@@ -1059,6 +1125,9 @@ def _execute_sqlite(
         mode='read_only', execute='execute', fetch=None):
     """Execute SQLite command and attempt retries on a failure.
 
+    Commands run on this process's persistent connection from
+    ``cdf_result_store`` rather than opening a new connection per call.
+
     Parameters:
         sqlite_command (str): a well formatted SQLite command.
         database_path (str): path to the SQLite database to operate on.
@@ -1074,21 +1143,11 @@ def _execute_sqlite(
         result of fetch if `fetch` is not None.
 
     """
+    if mode not in ('read_only', 'modify'):
+        raise ValueError('Unknown mode: %s' % mode)
     cursor = None
-    connection = None
+    connection = cdf_result_store.get_connection(database_path)
     try:
-        if mode == 'read_only':
-            ro_uri = r'%s?mode=ro' % pathlib.Path(
-                os.path.abspath(database_path)).as_uri()
-            LOGGER.debug(
-                '%s exists: %s', ro_uri, os.path.exists(os.path.abspath(
-                    database_path)))
-            connection = sqlite3.connect(ro_uri, uri=True)
-        elif mode == 'modify':
-            connection = sqlite3.connect(database_path)
-        else:
-            raise ValueError('Unknown mode: %s' % mode)
-
         if execute == 'execute':
             cursor = connection.execute(sqlite_command, argument_list)
         elif execute == 'many':
@@ -1109,16 +1168,14 @@ def _execute_sqlite(
         if payload is not None:
             result = list(payload)
         cursor.close()
-        connection.commit()
-        connection.close()
+        if mode == 'modify':
+            connection.commit()
         return result
     except Exception:
         LOGGER.exception('Exception on _execute_sqlite: %s', sqlite_command)
         if cursor is not None:
             cursor.close()
-        if connection is not None:
-            connection.commit()
-            connection.close()
+        connection.rollback()
         raise
 
 
@@ -0,0 +1,322 @@
+"""Resumable, segmented, md5 verified downloads of ecoshards.
+
+Downloads go to ``<target>.part`` files that are kept when a transfer
+fails, so a retry asks the server for the remaining bytes with an HTTP
+``Range`` header instead of starting over. Large files on servers that
+accept ranges are split into segments fetched in parallel, each with its
+own ``.part`` file. Every HTTP connection holds one of a fixed number of
+lock file slots in a directory shared by every process that downloads, so
+download tasks running in parallel task graph workers don't open an
+unbounded number of connections between them. Ecoshard names carry the
+md5 of their content (``<name>_md5_<hash>.<ext>``), that hash is checked as
+the parts are assembled into the target, and the target only appears once
+the check passes.
+
+Like the ``download_url`` this replaces, network errors, timeouts, and
+server errors are retried without an attempt limit, backing off up to 10s
+between attempts, so a flaky connection never fails a long task graph run.
+HTTP client errors such as a 404, a server that ignores range requests, and
+md5 mismatches are not retried since another attempt would fail the same
+way.
+"""
+import concurrent.futures
+import contextlib
+import hashlib
+import http.client
+import logging
+import os
+import re
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from retrying import retry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+LOGGER = logging.getLogger(__name__)
+
+# files at least this large are split into segments if the server accepts
+# ranges
+_SEGMENT_THRESHOLD = 2**26
+
+# default number of segments a large file is split into
+_DEFAULT_N_SEGMENTS = 4
+
+# bytes read from a response at a time
+_CHUNK_SIZE = 2**20
+
+_MD5_PATTERN = re.compile(r'_md5_([0-9a-fA-F]{32})')
+
+# default number of HTTP connections open at once across every process
+# downloading with the same connection lock directory
+DEFAULT_MAX_CONNECTIONS = 8
+
+# default directory of the connection lock files, shared by every process
+# on this machine
+DEFAULT_CONNECTION_LOCK_DIR = os.path.join(
+    tempfile.gettempdir(), 'ecoshard_download_connections')
+
+# seconds to wait before trying for a free connection slot again
+_SLOT_WAIT = 0.1
+
+# HTTP errors that may succeed on another attempt
+_TRANSIENT_HTTP_CODE_SET = {408, 429}
+
+
+def expected_md5(path):
+    """Return the md5 in an ecoshard name or None if it doesn't have one."""
+    match = _MD5_PATTERN.search(os.path.basename(path))
+    if match is None:
+        return None
+    return match.group(1).lower()
+
+
+def download_url(
+        url, target_path, skip_if_target_exists=False,
+        n_segments=_DEFAULT_N_SEGMENTS, verify_md5=True,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        connection_lock_dir=DEFAULT_CONNECTION_LOCK_DIR):
+    """Download ``url`` to ``target_path``.
+
+    Parameters:
+        url (str): http(s) url to download.
+        target_path (str): path to the downloaded file, written only once
+            the whole file is downloaded and verified.
+        skip_if_target_exists (bool): if True and ``target_path`` exists,
+            don't download.
+        n_segments (int): number of segments to fetch in parallel when the
+            file is at least ``_SEGMENT_THRESHOLD`` bytes and the server
+            accepts ranges.
+        verify_md5 (bool): if True and the basename of ``url`` is an
+            ecoshard name, check the downloaded md5 against it.
+        max_connections (int): most HTTP connections open at once across
+            every download, in any process, that uses
+            ``connection_lock_dir``. Downloads sharing a directory should
+            use the same value.
+        connection_lock_dir (str): directory of the lock files that bound
+            the connections, the default is shared by every process on the
+            machine.
+
+    Returns:
+        None.
+
+    Raises:
+        ValueError if the md5 doesn't match, the partial downloads are
+        removed so the next attempt starts over. ValueError if the server
+        ignores a range request for a segment, and
+        ``urllib.error.HTTPError`` for HTTP client errors.
+
+    """
+    if skip_if_target_exists and os.path.exists(target_path):
+        return
+    md5_hash = expected_md5(url) if verify_md5 else None
+    os.makedirs(connection_lock_dir, exist_ok=True)
+    slot_path_list = [
+        os.path.join(connection_lock_dir, f'connection_{index}.lock')
+        for index in range(max_connections)]
+    file_size, accepts_ranges = _probe_url(url, slot_path_list)
+    LOGGER.info(f'downloading {url} ({file_size} bytes) to {target_path}')
+
+    if file_size is not None and accepts_ranges and (
+            n_segments > 1 and file_size >= _SEGMENT_THRESHOLD):
+        segment_size = -(-file_size // n_segments)
+        range_list = [
+            (start, min(start + segment_size, file_size))
+            for start in range(0, file_size, segment_size)]
+        part_path_list = [
+            f'{target_path}.part{index}' for index in range(len(range_list))]
+    else:
+        range_list = [(0, file_size)]
+        part_path_list = [f'{target_path}.part']
+    progress_dict = {
+        'target_path': target_path,
+        'file_size': file_size,
+        'part_path_list': part_path_list,
+        'last_time': time.time(),
+        'slot_path_list': slot_path_list,
+    }
+
+    if len(range_list) == 1:
+        _fetch_range(
+            url, part_path_list[0], 0, file_size, accepts_ranges,
+            progress_dict)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(
+                len(range_list)) as executor:
+            for future in [
+                    executor.submit(
+                        _fetch_range, url, part_path, start, end, True,
+                        progress_dict)
+                    for part_path, (start, end) in zip(
+                        part_path_list, range_list)]:
+                future.result()
+
+    _assemble_parts(part_path_list, target_path, md5_hash)
+    LOGGER.info(f'downloaded {target_path}')
+
+
+def _is_transient_error(exception):
+    """Return True if a download that raised ``exception`` should retry."""
+    if isinstance(exception, urllib.error.HTTPError):
+        return exception.code >= 500 or (
+            exception.code in _TRANSIENT_HTTP_CODE_SET)
+    return isinstance(exception, (OSError, http.client.HTTPException))
+
+
+@retry(
+    retry_on_exception=_is_transient_error, wait_exponential_multiplier=1000,
+    wait_exponential_max=10000)
+def _probe_url(url, slot_path_list):
+    """Return (size or None, whether ranges are accepted) of ``url``."""
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        with _connection_slot(slot_path_list):
+            with urllib.request.urlopen(request) as response:
+                headers = response.info()
+    except urllib.error.HTTPError as error:
+        if _is_transient_error(error):
+            raise
+        # some servers refuse HEAD, fall back to a plain streamed download
+        return None, False
+    content_length = headers.get('Content-Length')
+    return (
+        int(content_length) if content_length is not None else None,
+        headers.get('Accept-Ranges', '').lower() == 'bytes')
+
+
+@retry(
+    retry_on_exception=_is_transient_error, wait_exponential_multiplier=1000,
+    wait_exponential_max=10000)
+def _fetch_range(
+        url, part_path, start, end, accepts_ranges, progress_dict):
+    """Append the bytes [start, end) of ``url`` to ``part_path``.
+
+    Resumes from however much of the range is already in ``part_path``.
+    ``end`` is None if the size is unknown, then the response is read to
+    its end.
+
+    """
+    done_bytes = (
+        os.path.getsize(part_path) if os.path.exists(part_path) else 0)
+    if end is not None and start + done_bytes >= end:
+        return
+    request = urllib.request.Request(url)
+    if accepts_ranges and (done_bytes > 0 or start > 0 or end is not None):
+        request.add_header('Range', 'bytes=%d-%s' % (
+            start + done_bytes, '' if end is None else end - 1))
+    try:
+        with _connection_slot(progress_dict['slot_path_list']):
+            with urllib.request.urlopen(request) as response:
+                if response.status != 206:
+                    # the whole file is coming, so start this part over
+                    if start > 0:
+                        raise ValueError(f'{url} ignored a range request')
+                    done_bytes = 0
+                with open(part_path, 'ab' if done_bytes else 'wb') as (
+                        part_file):
+                    while True:
+                        data_buffer = response.read(_CHUNK_SIZE)
+                        if not data_buffer:
+                            break
+                        part_file.write(data_buffer)
+                        _log_progress(progress_dict)
+    except Exception as error:
+        if _is_transient_error(error):
+            LOGGER.exception(f'error downloading {url}, resuming')
+        raise
+    if end is not None and os.path.getsize(part_path) != end - start:
+        raise IOError(
+            f'{part_path} has {os.path.getsize(part_path)} bytes, expected '
+            f'{end - start}')
+
+
+@contextlib.contextmanager
+def _connection_slot(slot_path_list):
+    """Hold an exclusive lock on one of ``slot_path_list`` until exit.
+
+    Locks are on open files so the operating system releases them if the
+    holding process dies, a crashed task never leaks a slot.
+
+    """
+    while True:
+        for slot_path in slot_path_list:
+            slot_file = open(slot_path, 'a+b')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    slot_file.seek(0)
+                    msvcrt.locking(slot_file.fileno(), msvcrt.LK_NBLCK, 1)
+            except OSError:
+                slot_file.close()
+                continue
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(slot_file, fcntl.LOCK_UN)
+                else:
+                    slot_file.seek(0)
+                    msvcrt.locking(slot_file.fileno(), msvcrt.LK_UNLCK, 1)
+                slot_file.close()
+            return
+        time.sleep(_SLOT_WAIT)
+
+
+def _assemble_parts(part_path_list, target_path, md5_hash):
+    """Move or concatenate parts into ``target_path`` checking their md5.
+
+    A single part is hashed and renamed, several parts are hashed as they
+    are concatenated so each byte is read once.
+
+    """
+    md5 = hashlib.md5()
+    if len(part_path_list) == 1:
+        working_path = part_path_list[0]
+        target_file = None
+    else:
+        working_path = f'{target_path}.assemble'
+        target_file = open(working_path, 'wb')
+    for part_path in part_path_list:
+        with open(part_path, 'rb') as part_file:
+            while True:
+                data_buffer = part_file.read(_CHUNK_SIZE)
+                if not data_buffer:
+                    break
+                md5.update(data_buffer)
+                if target_file is not None:
+                    target_file.write(data_buffer)
+    if target_file is not None:
+        target_file.close()
+    if md5_hash is not None and md5.hexdigest() != md5_hash:
+        for path in set(part_path_list + [working_path]):
+            os.remove(path)
+        raise ValueError(
+            f'{target_path} has md5 {md5.hexdigest()}, expected {md5_hash}')
+    os.replace(working_path, target_path)
+    for part_path in part_path_list:
+        if part_path != working_path:
+            os.remove(part_path)
+
+
+def _log_progress(progress_dict):
+    """Log the bytes in a download's parts at most every 5 seconds."""
+    if time.time() - progress_dict['last_time'] < 5.0:
+        return
+    progress_dict['last_time'] = time.time()
+    total_bytes = sum([
+        os.path.getsize(part_path)
+        for part_path in progress_dict['part_path_list']
+        if os.path.exists(part_path)])
+    if progress_dict['file_size']:
+        LOGGER.info(
+            f'{progress_dict["target_path"]}: {total_bytes} bytes '
+            f'{total_bytes/progress_dict["file_size"]*100:.2f}% complete')
+    else:
+        LOGGER.info(f'{progress_dict["target_path"]}: {total_bytes} bytes')
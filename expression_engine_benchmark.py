@@ -0,0 +1,118 @@
+"""Benchmark raster_calculations_core expression engines on a synthetic stack.
+
+Times the current ``symbolic.evaluate_raster_calculator_expression`` path
+against the compiled engine (``'engine': 'compiled'``) for a handful of
+expressions taken from the CNC driver scripts and checks that both engines
+produce the same raster.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ecoshard import geoprocessing
+from ecoshard.geoprocessing import symbolic
+from osgeo import gdal
+from osgeo import osr
+import numpy
+import raster_calculations_core
+
+gdal.SetCacheMax(2**26)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=(
+        '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
+        ' [%(funcName)s:%(lineno)d] %(message)s'),
+    stream=sys.stdout)
+LOGGER = logging.getLogger(__name__)
+
+EXPRESSION_LIST = [
+    '(raster1>0)*(raster2>0)',
+    'raster1*(raster2<2)*(raster2)',
+    '(raster1<190)*(raster2<41)*(raster3>40)*raster4 + '
+    '(raster1>190)*(raster1<210)*(raster2<41)*(raster3>40)*raster4 + '
+    '(raster2>40)*raster1 + (raster2<41)*(raster3<41)*raster1',
+    '(raster1/486980 + raster2/3319921 + raster3/132654) / 3',
+]
+
+NODATA = -1.0
+
+
+def _make_synthetic_stack(workspace_dir, n_rows, n_cols, nodata_fraction):
+    """Write four float32 rasters with random values and nodata holes."""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    rng = numpy.random.default_rng(1)
+    symbol_to_path_band_map = {}
+    for index in range(1, 5):
+        array = rng.uniform(0, 250, (n_rows, n_cols)).astype(numpy.float32)
+        array[rng.random((n_rows, n_cols)) < nodata_fraction] = NODATA
+        raster_path = os.path.join(workspace_dir, f'raster{index}.tif')
+        geoprocessing.numpy_array_to_raster(
+            array, NODATA, (1/360, -1/360), (-180, 90), srs.ExportToWkt(),
+            raster_path)
+        symbol_to_path_band_map[f'raster{index}'] = (raster_path, 1)
+    return symbol_to_path_band_map
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=(
+        'Compare the symbolic and compiled expression engines.'))
+    parser.add_argument(
+        '--n_rows', type=int, default=8192, help='rows of synthetic rasters')
+    parser.add_argument(
+        '--n_cols', type=int, default=8192, help='cols of synthetic rasters')
+    parser.add_argument(
+        '--nodata_fraction', type=float, default=0.3,
+        help='fraction of each synthetic raster that is nodata')
+    args = parser.parse_args()
+
+    workspace_dir = tempfile.mkdtemp(dir='.', prefix='engine_benchmark_')
+    try:
+        symbol_to_path_band_map = _make_synthetic_stack(
+            workspace_dir, args.n_rows, args.n_cols, args.nodata_fraction)
+        print('engine,seconds,expression')
+        for expression_index, expression in enumerate(EXPRESSION_LIST):
+            symbolic_raster_path = os.path.join(
+                workspace_dir, f'symbolic_{expression_index}.tif')
+            start_time = time.time()
+            symbolic.evaluate_raster_calculator_expression(
+                expression, symbol_to_path_band_map, NODATA,
+                symbolic_raster_path, default_nan=NODATA, default_inf=NODATA)
+            print(f'symbolic,{time.time()-start_time:.2f},{expression}')
+
+            compiled_raster_path = os.path.join(
+                workspace_dir, f'compiled_{expression_index}.tif')
+            start_time = time.time()
+            raster_calculations_core._evaluate_aligned_expression_group([{
+                'expression': expression,
+                'symbol_to_path_band_map': symbol_to_path_band_map,
+                'target_nodata': NODATA,
+                'target_raster_path': compiled_raster_path,
+                'target_datatype': gdal.GDT_Float32,
+                'default_nan': NODATA,
+                'default_inf': NODATA,
+                'engine': 'compiled',
+                }], raster_calculations_core._FUSED_LARGEST_BLOCK)
+            print(f'compiled,{time.time()-start_time:.2f},{expression}')
+
+            for (_, symbolic_array), (_, compiled_array) in zip(
+                    geoprocessing.iterblocks((symbolic_raster_path, 1)),
+                    geoprocessing.iterblocks((compiled_raster_path, 1))):
+                if not numpy.allclose(
+                        symbolic_array, compiled_array, rtol=1e-5):
+                    LOGGER.error(
+                        'engines disagree on "%s" in %s and %s', expression,
+                        symbolic_raster_path, compiled_raster_path)
+                    break
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Benchmark mult_rasters_by_columns evaluators on a synthetic lasso table.
+
+Writes a stack of synthetic rasters and a random lasso table of interaction
+terms over them, then times the per block RPN interpreter
+(``raster_rpn_calculator_op`` through ``geoprocessing.raster_calculator``)
+against the compiled plan (``rpn_plan_raster_calculator``) and checks that
+both produce the same raster.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+from osgeo import osr
+import mult_rasters_by_columns
+import numpy
+import pandas
+
+gdal.SetCacheMax(2**26)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=(
+        '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
+        ' [%(funcName)s:%(lineno)d] %(message)s'),
+    stream=sys.stdout)
+LOGGER = logging.getLogger(__name__)
+logging.getLogger('mult_rasters_by_columns').setLevel(logging.INFO)
+
+NODATA = -1.0
+TARGET_NODATA = float(numpy.finfo(numpy.float32).min)
+
+
+def _make_synthetic_stack(
+        workspace_dir, n_rasters, n_rows, n_cols, nodata_fraction):
+    """Write float32 rasters with random values and nodata holes."""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    rng = numpy.random.default_rng(1)
+    raster_id_to_path_nodata_map = {}
+    for index in range(n_rasters):
+        array = rng.uniform(0, 2, (n_rows, n_cols)).astype(numpy.float32)
+        array[rng.random((n_rows, n_cols)) < nodata_fraction] = NODATA
+        raster_id = f'raster{index}'
+        raster_path = os.path.join(workspace_dir, f'{raster_id}.tif')
+        geoprocessing.numpy_array_to_raster(
+            array, NODATA, (1/360, -1/360), (-180, 90), srs.ExportToWkt(),
+            raster_path)
+        raster_id_to_path_nodata_map[raster_id] = (raster_path, NODATA)
+    return raster_id_to_path_nodata_map
+
+
+def _make_synthetic_lasso_table(raster_id_list, n_terms):
+    """Random table of 1 to 3 factor terms, some squared, and an intercept."""
+    rng = numpy.random.default_rng(2)
+    row_list = [(mult_rasters_by_columns.INTERCEPT_COLUMN_ID, 0.5)]
+    for _ in range(n_terms):
+        factor_list = rng.choice(
+            raster_id_list, rng.integers(1, 4), replace=False)
+        row_list.append((
+            '*'.join([
+                f'{raster_id}^2' if rng.random() < 0.3 else raster_id
+                for raster_id in factor_list]),
+            float(rng.normal(0, 0.1))))
+    return pandas.DataFrame(row_list)
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=(
+        'Compare the interpreted and compiled lasso RPN evaluators.'))
+    parser.add_argument(
+        '--n_rasters', type=int, default=50, help='number of rasters')
+    parser.add_argument(
+        '--n_terms', type=int, default=200, help='number of table terms')
+    parser.add_argument(
+        '--n_rows', type=int, default=4096, help='rows of synthetic rasters')
+    parser.add_argument(
+        '--n_cols', type=int, default=4096, help='cols of synthetic rasters')
+    parser.add_argument(
+        '--nodata_fraction', type=float, default=0.01,
+        help='fraction of each synthetic raster that is nodata')
+    parser.add_argument(
+        '--n_threads', type=int, default=multiprocessing.cpu_count(),
+        help='threads for the compiled evaluator')
+    parser.add_argument(
+        '--zero_nodata', action='store_true',
+        help='treat nodata as 0 as with mult_rasters_by_columns --zero_nodata')
+    args = parser.parse_args()
+
+    workspace_dir = tempfile.mkdtemp(dir='.', prefix='lasso_benchmark_')
+    try:
+        raster_id_to_path_nodata_map = _make_synthetic_stack(
+            workspace_dir, args.n_rasters, args.n_rows, args.n_cols,
+            args.nodata_fraction)
+        lasso_df = _make_synthetic_lasso_table(
+            sorted(raster_id_to_path_nodata_map), args.n_terms)
+        rpn_stack = mult_rasters_by_columns.build_rpn_stack(lasso_df)
+
+        print('engine,seconds')
+        start_time = time.time()
+        rpn_plan = mult_rasters_by_columns.compile_rpn_plan(rpn_stack)
+        print(f'compile,{time.time()-start_time:.4f}')
+
+        # the interpreter looks rasters up by their index in the args list
+        raster_id_list = rpn_plan['raster_id_list']
+        raster_path_band_list = []
+        for raster_id in raster_id_list:
+            raster_path, nodata = raster_id_to_path_nodata_map[raster_id]
+            raster_path_band_list.extend([(raster_path, 1), (nodata, 'raw')])
+        raster_path_band_list.extend([
+            (TARGET_NODATA, 'raw'), (rpn_stack, 'raw'),
+            ({raster_id: {'index': index} for index, raster_id in enumerate(
+                raster_id_list)}, 'raw'),
+            (args.zero_nodata, 'raw')])
+        interpreted_raster_path = os.path.join(
+            workspace_dir, 'interpreted.tif')
+        start_time = time.time()
+        geoprocessing.raster_calculator(
+            raster_path_band_list,
+            mult_rasters_by_columns.raster_rpn_calculator_op,
+            interpreted_raster_path, gdal.GDT_Float32, TARGET_NODATA)
+        print(f'interpreted,{time.time()-start_time:.2f}')
+
+        compiled_raster_path = os.path.join(workspace_dir, 'compiled.tif')
+        start_time = time.time()
+        mult_rasters_by_columns.rpn_plan_raster_calculator(
+            rpn_plan, raster_id_to_path_nodata_map, compiled_raster_path,
+            TARGET_NODATA, args.zero_nodata, args.n_threads)
+        print(f'compiled,{time.time()-start_time:.2f}')
+
+        for (_, interpreted_array), (_, compiled_array) in zip(
+                geoprocessing.iterblocks((interpreted_raster_path, 1)),
+                geoprocessing.iterblocks((compiled_raster_path, 1))):
+            if not numpy.allclose(
+                    interpreted_array, compiled_array, rtol=1e-4,
+                    atol=1e-4):
+                LOGGER.error(
+                    'evaluators disagree in %s and %s',
+                    interpreted_raster_path, compiled_raster_path)
+                break
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
-"""Average arbitrary set of rasters."""
+"""Sum value rasters under the masks listed in an .ini file."""
 from datetime import datetime
 import argparse
+import collections
 import logging
+import math
 import os
 import sys
 
 from ecoshard import geoprocessing
 from ecoshard import taskgraph
+from osgeo import gdal
 import numpy
 
 
@@ -19,6 +22,9 @@ logging.basicConfig(
 LOGGER = logging.getLogger(__name__)
 logging.getLogger('ecoshard.taskgraph').setLevel(logging.WARNING)
 
+# largest number of pixels read per raster at once
+_LARGEST_BLOCK = 2**22
+
 
 def parse_ini(path):
     valid_keys = {'mask_raster', 'value_raster'}
@@ -51,36 +57,206 @@ def parse_ini(path):
     return data
 
 
-def align_and_resize_raster_stack(base_raster_path_list, aligned_raster_path_list):
-    target_pixel_size = geoprocessing.get_raster_info(
-        base_raster_path_list[0])['pixel_size']
+def mask_and_sum(mask_raster_path, value_raster_path):
+    """Sum a value raster inside and outside of a mask.
 
-    geoprocessing.align_and_resize_raster_stack(
-        base_raster_path_list, aligned_raster_path_list, ['near'] * len(aligned_raster_path_list),
-        target_pixel_size, 'union')
+    Parameters:
+        mask_raster_path (str): path to a raster that is > 0 where values
+            are to be summed.
+        value_raster_path (str): path to the raster of values.
 
+    Returns:
+        (masked sum, full sum) of the valid value pixels, see
+        ``mask_and_sum_by_value_raster``.
 
-def mask_and_sum(mask_raster_path, value_raster_path):
-    value_nodata = geoprocessing.get_raster_info(
-        value_raster_path)['nodata'][0]
-    path_list = [mask_raster_path, value_raster_path]
-
-    masked_running_sum = 0
-    for _, (mask_array, value_array) in geoprocessing.iterblocks(
-            [(path, 1) for path in path_list],
-            skip_sparse=True, allow_different_blocksize=True):
-        valid_mask = (mask_array > 0) & ~numpy.isnan(value_array)
-        if value_nodata is not None:
-            valid_mask &= (value_array != value_nodata)
-        masked_running_sum += numpy.sum(value_array[valid_mask])
-    full_running_sum = 0
-    for _, value_array in geoprocessing.iterblocks(
-            [(path_list[1], 1)], skip_sparse=True, allow_different_blocksize=True):
-        valid_mask = ~numpy.isnan(value_array)
+    """
+    masked_sum_list, full_sum = mask_and_sum_by_value_raster(
+        value_raster_path, [mask_raster_path])
+    return masked_sum_list[0], full_sum
+
+
+def mask_and_sum_by_value_raster(
+        value_raster_path, mask_raster_path_list,
+        largest_block=_LARGEST_BLOCK):
+    """Sum one value raster under several masks in a single pass.
+
+    The value raster is sampled onto the grid of the first mask at its
+    pixel size over the union of the mask and value extents, as
+    ``align_and_resize_raster_stack`` with 'near' resampling would, but
+    windows of that grid are mapped to windows of each raster and read
+    directly so nothing is written to disk. Every mask must share that
+    grid, i.e. the same pixel size and the same union with the value
+    raster. Block sums are float64 pairwise sums and the block sums are
+    added with ``math.fsum`` so sums of billions of pixels stay exact to
+    float64 precision.
+
+    Parameters:
+        value_raster_path (str): path to the raster of values, its nodata
+            and NaN pixels are skipped.
+        mask_raster_path_list (list): paths to rasters that are > 0 where
+            values are to be summed, in the same projection as the value
+            raster.
+        largest_block (int): largest number of pixels to read from a raster
+            at once. Grid windows shrink by the number of pixels a raster
+            finer than the grid has under each grid pixel.
+
+    Returns:
+        (masked_sum_list, full_sum) where ``masked_sum_list`` holds the sum
+        of the values under each mask and ``full_sum`` the sum of all the
+        values on the grid.
+
+    """
+    value_info = geoprocessing.get_raster_info(value_raster_path)
+    value_nodata = value_info['nodata'][0]
+    mask_info_list = [
+        geoprocessing.get_raster_info(path)
+        for path in mask_raster_path_list]
+    grid = _target_grid(mask_info_list[0], value_info)
+    for mask_raster_path, mask_info in zip(
+            mask_raster_path_list[1:], mask_info_list[1:]):
+        if _target_grid(mask_info, value_info) != grid:
+            raise ValueError(
+                f'{mask_raster_path} does not align to the same grid as '
+                f'{mask_raster_path_list[0]}')
+    pixel_width, pixel_height, n_cols = grid[2:5]
+
+    value_raster = gdal.OpenEx(value_raster_path, gdal.OF_RASTER)
+    value_band = value_raster.GetRasterBand(1)
+    mask_raster_list = [
+        gdal.OpenEx(path, gdal.OF_RASTER) for path in mask_raster_path_list]
+    mask_band_list = [
+        raster.GetRasterBand(1) for raster in mask_raster_list]
+
+    # a raster finer than the grid is read at its own resolution under
+    # each grid window, so shrink the windows to keep those reads in budget
+    source_pixels_per_grid_pixel = max([1.0] + [
+        (pixel_width / abs(raster_info['pixel_size'][0])) * (
+            pixel_height / abs(raster_info['pixel_size'][1]))
+        for raster_info in [value_info] + mask_info_list])
+    window_pixels = max(1, int(largest_block / source_pixels_per_grid_pixel))
+    cols_per_window = min(n_cols, window_pixels)
+    rows_per_window = max(1, window_pixels // cols_per_window)
+
+    masked_partial_sum_list = [[] for _ in mask_raster_path_list]
+    full_partial_sum_list = []
+    for col_x_array, row_y_array in _grid_windows(
+            grid, cols_per_window, rows_per_window):
+        value_array, value_extent_mask = _read_mapped_window(
+            value_band, value_info, col_x_array, row_y_array)
+        if value_array is None:
+            continue
+        valid_mask = ~numpy.isnan(value_array) if numpy.issubdtype(
+            value_array.dtype, numpy.floating) else numpy.ones(
+                value_array.shape, dtype=bool)
         if value_nodata is not None:
-            valid_mask &= (value_array != value_nodata)
-        full_running_sum += numpy.sum(value_array[valid_mask])
-    return masked_running_sum, full_running_sum
+            valid_mask &= value_array != value_nodata
+        if value_extent_mask is not None:
+            valid_mask &= value_extent_mask
+        value_array = numpy.where(
+            valid_mask, value_array.astype(numpy.float64), 0.0)
+        full_partial_sum_list.append(numpy.sum(value_array))
+
+        for mask_index, (mask_band, mask_info) in enumerate(
+                zip(mask_band_list, mask_info_list)):
+            mask_array, mask_extent_mask = _read_mapped_window(
+                mask_band, mask_info, col_x_array, row_y_array)
+            if mask_array is None:
+                continue
+            in_mask = mask_array > 0
+            if mask_extent_mask is not None:
+                in_mask &= mask_extent_mask
+            masked_partial_sum_list[mask_index].append(
+                numpy.sum(value_array, where=in_mask))
+
+    value_band = None
+    value_raster = None
+    mask_band_list = None
+    mask_raster_list = None
+    return (
+        [math.fsum(partial_sum_list)
+         for partial_sum_list in masked_partial_sum_list],
+        math.fsum(full_partial_sum_list))
+
+
+def _target_grid(mask_info, value_info):
+    """Grid a mask and value raster are summed on.
+
+    Returns:
+        (x origin, y origin, pixel width, pixel height, n_cols, n_rows) of
+        the union of both extents at the mask's pixel size.
+
+    """
+    bounding_box = geoprocessing.merge_bounding_box_list(
+        [mask_info['bounding_box'], value_info['bounding_box']], 'union')
+    pixel_width = abs(mask_info['pixel_size'][0])
+    pixel_height = abs(mask_info['pixel_size'][1])
+    return (
+        bounding_box[0], bounding_box[3], pixel_width, pixel_height,
+        int(round((bounding_box[2] - bounding_box[0]) / pixel_width)),
+        int(round((bounding_box[3] - bounding_box[1]) / pixel_height)))
+
+
+def _grid_windows(grid, cols_per_window, rows_per_window):
+    """Yield the (x array, y array) of pixel centers of each grid window."""
+    grid_x0, grid_y0, pixel_width, pixel_height, n_cols, n_rows = grid
+    for row_offset in range(0, n_rows, rows_per_window):
+        row_y_array = grid_y0 - (numpy.arange(
+            row_offset, min(n_rows, row_offset+rows_per_window)) + 0.5) * (
+                pixel_height)
+        for col_offset in range(0, n_cols, cols_per_window):
+            col_x_array = grid_x0 + (numpy.arange(
+                col_offset, min(n_cols, col_offset+cols_per_window)) + 0.5) * (
+                    pixel_width)
+            yield col_x_array, row_y_array
+
+
+def _read_mapped_window(band, raster_info, col_x_array, row_y_array):
+    """Read a raster at the nearest pixel to a window of grid centers.
+
+    Parameters:
+        band (gdal.Band): band to read.
+        raster_info (dict): ``get_raster_info`` of the band's raster.
+        col_x_array (numpy.ndarray): x coordinate of each window column.
+        row_y_array (numpy.ndarray): y coordinate of each window row.
+
+    Returns:
+        (array, extent_mask) of the window's shape. ``extent_mask`` is
+        False where a grid pixel is outside of the raster, or None if
+        every pixel is inside. (None, None) if the window doesn't overlap
+        the raster at all.
+
+    """
+    geotransform = raster_info['geotransform']
+    n_cols, n_rows = raster_info['raster_size']
+    col_index = numpy.floor(
+        (col_x_array - geotransform[0]) / geotransform[1]).astype(
+            numpy.int64)
+    row_index = numpy.floor(
+        (row_y_array - geotransform[3]) / geotransform[5]).astype(
+            numpy.int64)
+    valid_cols = (col_index >= 0) & (col_index < n_cols)
+    valid_rows = (row_index >= 0) & (row_index < n_rows)
+    if not valid_cols.any() or not valid_rows.any():
+        return None, None
+    col_min = int(col_index[valid_cols].min())
+    col_max = int(col_index[valid_cols].max())
+    row_min = int(row_index[valid_rows].min())
+    row_max = int(row_index[valid_rows].max())
+    source_array = band.ReadAsArray(
+        xoff=col_min, yoff=row_min, win_xsize=col_max-col_min+1,
+        win_ysize=row_max-row_min+1)
+    if valid_cols.all() and valid_rows.all() and (
+            source_array.shape == (row_index.size, col_index.size)):
+        # same pixel size and inside the raster, a plain window read
+        return source_array, None
+    array = numpy.zeros(
+        (row_index.size, col_index.size), dtype=source_array.dtype)
+    extent_mask = numpy.zeros(array.shape, dtype=bool)
+    target_index = numpy.ix_(valid_rows, valid_cols)
+    array[target_index] = source_array[numpy.ix_(
+        row_index[valid_rows] - row_min, col_index[valid_cols] - col_min)]
+    extent_mask[target_index] = True
+    return array, extent_mask
 
 
 if __name__ == '__main__':
@@ -103,36 +279,33 @@ value_raster = path/to/idn_flood_value_restoration.tif
 
     configuration = parse_ini(args.diff_conf_path)
     task_graph = taskgraph.TaskGraph('.', os.cpu_count(), 10.0)
-    task_map = {}
+    # sections that sum the same value raster on the same grid share a
+    # single pass over it
+    section_group_map = collections.defaultdict(list)
     for key, file_lookup in configuration.items():
-        local_workspace = os.path.join('mask_and_sum_workspace', key)
-        os.makedirs(local_workspace, exist_ok=True)
-
-        base_raster_path_list = [
-            file_lookup['mask_raster'], file_lookup['value_raster']]
-        aligned_raster_path_list = [
-            os.path.join(local_workspace, os.path.basename(path))
-            for path in base_raster_path_list]
-
-        align_task = task_graph.add_task(
-            func=align_and_resize_raster_stack,
-            args=(base_raster_path_list, aligned_raster_path_list),
-            target_path_list=aligned_raster_path_list,
-            task_name=f'align for {key}')
+        grid = _target_grid(
+            geoprocessing.get_raster_info(file_lookup['mask_raster']),
+            geoprocessing.get_raster_info(file_lookup['value_raster']))
+        section_group_map[(file_lookup['value_raster'], grid)].append(key)
 
+    task_map = {}
+    for (value_raster_path, _), key_list in section_group_map.items():
         task = task_graph.add_task(
-            func=mask_and_sum,
-            args=aligned_raster_path_list,
-            dependent_task_list=[align_task],
+            func=mask_and_sum_by_value_raster,
+            args=(value_raster_path, [
+                configuration[key]['mask_raster'] for key in key_list]),
             store_result=True,
-            task_name=f'sum {key}')
-        task_map[key] = task
+            task_name=f'sum {", ".join(key_list)}')
+        for index, key in enumerate(key_list):
+            task_map[key] = (task, index)
 
     table_path = f"{os.path.splitext(os.path.basename(args.diff_conf_path))[0]}_{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}.csv"
     with open(table_path, 'w') as file:
         file.write('sum_id,masked summed value,raw summed value\n')
-        for key, task in task_map.items():
-            masked_running_sum, full_running_sum = task.get()
+        for key in configuration:
+            task, index = task_map[key]
+            masked_sum_list, full_running_sum = task.get()
+            masked_running_sum = masked_sum_list[index]
             LOGGER.debug(f'writing {key},{masked_running_sum},{full_running_sum}')
             file.write(f'{key},{masked_running_sum},{full_running_sum}\n')
 
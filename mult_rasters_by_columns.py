@@ -1,9 +1,22 @@
-"""Demo of how to use pandas to multiply one table by another."""
+"""Demo of how to use pandas to multiply one table by another.
+
+Rasters are either warped to aligned copies first or, with
+``--stream_warp``, read through warped VRTs so each block is resampled as it
+is read and no aligned copies are written. The lasso table is parsed into an
+RPN stack which is compiled once into a plan: the stack is expanded into a
+sum of coefficient * product terms, like terms are merged, powers of each
+raster are computed once per block, and products shared by several terms
+are computed once and reused. Blocks are evaluated in a thread pool with
+every term accumulated in place into one float32 buffer.
+"""
 import argparse
+import collections
+import concurrent.futures
 import logging
 import multiprocessing
 import os
 import sys
+import threading
 
 from ecoshard import geoprocessing
 from osgeo import gdal
@@ -22,6 +35,12 @@ OPERATOR_FN = {
 }
 N_CPUS = multiprocessing.cpu_count()
 
+# bytes of block buffers each evaluation thread may hold, used to size blocks
+_PLAN_MEMORY_PER_THREAD = 2**28
+
+# per thread cache of open rasters so windows don't reopen them
+_THREAD_LOCAL = threading.local()
+
 logging.basicConfig(
     level=logging.DEBUG,
     format=(
@@ -58,9 +77,9 @@ def raster_rpn_calculator_op(*args_list):
     info_dict = args_list[n+2]
     zero_nodata = args_list[n+3]
     if zero_nodata:
-        valid_mask = numpy.zeros(args_list[0].shape, dtype=numpy.bool)
+        valid_mask = numpy.zeros(args_list[0].shape, dtype=bool)
     else:
-        valid_mask = numpy.ones(args_list[0].shape, dtype=numpy.bool)
+        valid_mask = numpy.ones(args_list[0].shape, dtype=bool)
     # build up valid mask where all pixel stacks are defined
     for index in range(0, n, 2):
         nodata_value = args_list[index+1]
@@ -99,44 +118,19 @@ def raster_rpn_calculator_op(*args_list):
             f'accumulator_stack not empty: {accumulator_stack}')
     return result
 
-if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser(description='mult by columns script')
-    parser.add_argument(
-        '--lasso_table_path', type=str, required=True,
-        help='path to lasso table')
-    parser.add_argument(
-        '--data_dir', type=str, required=True,
-        help='path to directory containing rasters in lasso table path')
-    parser.add_argument(
-        '--workspace_dir', type=str, required=True,
-        help=(
-            'path to output directory, will contain "result.tif" after '
-            'completion'))
-    parser.add_argument(
-        '--bounding_box', type=float, nargs=4,
-        help=(
-            "manual bounding box in the form of four consecutive floats: "
-            "min_lng, min_lat, max_lng, max_lat, ex: "
-            "-180.0, -58.3, 180.0, 81.5"))
-    parser.add_argument(
-        '--pixel_size', type=float,
-        help="desired target pixel size in raster units")
-    parser.add_argument(
-        '--zero_nodata', action='store_true',
-        help=(
-            'if present, treat nodata values as 0, if absent any nodata '
-            'pixel in a stack will cause the output pixel to be nodata'))
-    parser.add_argument(
-        '--target_nodata', type=float, default=numpy.finfo('float32').min,
-        help='desired target nodata value')
+def build_rpn_stack(lasso_df):
+    """Build a reverse polish notation stack from a lasso table.
 
-    args = parser.parse_args()
+    Parameters:
+        lasso_df (pandas.DataFrame): headerless table whose first column is
+            either ``INTERCEPT_COLUMN_ID`` or a term like ``a*b^2`` and whose
+            second column is the coefficient.
 
-    LOGGER.info('parse lasso table path and build expression')
-    lasso_table_path = args.lasso_table_path
-    lasso_df = pandas.read_csv(lasso_table_path, header=None)
+    Returns:
+        list of symbols, numbers, and operators in ``OPERATOR_FN``.
 
+    """
     # built a reverse polish notation stack for the operations and their order
     # that they need to be executed in
     rpn_stack = []
@@ -175,13 +169,392 @@ if __name__ == '__main__':
             first_term = False
         else:
             rpn_stack.append('+')
+    return rpn_stack
+
 
+def compile_rpn_plan(rpn_stack):
+    """Compile an RPN stack into a plan for ``evaluate_rpn_plan``.
+
+    The stack is evaluated symbolically into a polynomial, a map of
+    monomials to coefficients where a monomial is a sorted tuple of
+    (raster id, power) factors. Because the factors are sorted, terms that
+    share leading factors share a prefix, and every prefix of two or more
+    factors that appears in more than one term is computed once per block.
+
+    Parameters:
+        rpn_stack (list): stack from ``build_rpn_stack``.
+
+    Returns:
+        dict with the keys
+            'raster_id_list': every raster id referenced by the stack,
+            'intercept': the constant term,
+            'power_list': (raster id, power) factors with a power other
+                than 1 to compute once per block,
+            'product_list': (prefix, parent prefix, factor) in the order to
+                compute the shared prefixes, each is its parent times factor,
+            'term_list': (coefficient, prefix, factor list) where the term
+                is the coefficient times the longest shared prefix (or the
+                first factor) times the remaining factors.
+
+    """
+    raster_id_set = set()
+    accumulator_stack = []
+    for val in rpn_stack:
+        if val in OPERATOR_FN:
+            operand_b = accumulator_stack.pop()
+            operand_a = accumulator_stack.pop()
+            if val == '+':
+                accumulator_stack.append(_add_polynomials(
+                    operand_a, operand_b))
+            elif val == '*':
+                accumulator_stack.append(_multiply_polynomials(
+                    operand_a, operand_b))
+            else:
+                accumulator_stack.append(_power_polynomial(
+                    operand_a, operand_b))
+        elif isinstance(val, str):
+            raster_id_set.add(val)
+            accumulator_stack.append({((val, 1),): 1.0})
+        else:
+            accumulator_stack.append({(): float(val)})
+    if len(accumulator_stack) != 1:
+        raise RuntimeError(
+            f'accumulator_stack not empty: {accumulator_stack}')
+    polynomial = accumulator_stack[0]
+
+    monomial_list = sorted(
+        monomial for monomial, coefficient in polynomial.items()
+        if monomial and coefficient != 0)
+    prefix_count = collections.Counter(
+        monomial[:prefix_len] for monomial in monomial_list
+        for prefix_len in range(2, len(monomial)+1))
+    shared_prefix_set = set(
+        prefix for prefix, count in prefix_count.items() if count > 1)
+
+    term_list = []
+    for monomial in monomial_list:
+        prefix_len = max(
+            [prefix_len for prefix_len in range(2, len(monomial)+1)
+             if monomial[:prefix_len] in shared_prefix_set], default=1)
+        term_list.append((
+            polynomial[monomial], monomial[:prefix_len],
+            list(monomial[prefix_len:])))
+
+    return {
+        'raster_id_list': sorted(raster_id_set),
+        'intercept': polynomial.get((), 0.0),
+        'power_list': sorted(set(
+            factor for monomial in monomial_list for factor in monomial
+            if factor[1] != 1)),
+        'product_list': [
+            (prefix, prefix[:-1], prefix[-1])
+            for prefix in sorted(shared_prefix_set, key=len)],
+        'term_list': term_list,
+    }
+
+
+def _add_polynomials(polynomial_a, polynomial_b):
+    """Return the sum of two {monomial: coefficient} polynomials."""
+    result = dict(polynomial_a)
+    for monomial, coefficient in polynomial_b.items():
+        result[monomial] = result.get(monomial, 0.0) + coefficient
+    return result
+
+
+def _multiply_monomials(monomial_a, monomial_b):
+    """Return the product of two sorted (raster id, power) tuples."""
+    power_map = collections.defaultdict(int)
+    for raster_id, power in monomial_a + monomial_b:
+        power_map[raster_id] += power
+    return tuple(sorted(
+        (raster_id, power) for raster_id, power in power_map.items()
+        if power != 0))
+
+
+def _multiply_polynomials(polynomial_a, polynomial_b):
+    """Return the product of two {monomial: coefficient} polynomials."""
+    result = {}
+    for monomial_a, coefficient_a in polynomial_a.items():
+        for monomial_b, coefficient_b in polynomial_b.items():
+            monomial = _multiply_monomials(monomial_a, monomial_b)
+            result[monomial] = (
+                result.get(monomial, 0.0) + coefficient_a * coefficient_b)
+    return result
+
+
+def _power_polynomial(polynomial, exponent_polynomial):
+    """Raise a polynomial to a constant integer power."""
+    if set(exponent_polynomial) != {()} or (
+            exponent_polynomial[()] != int(exponent_polynomial[()])):
+        raise ValueError(
+            f'exponents must be integer constants, got {exponent_polynomial}')
+    exponent = int(exponent_polynomial[()])
+    if exponent < 0:
+        if len(polynomial) != 1:
+            raise ValueError(
+                f'can only take a negative power of a single term, got '
+                f'{polynomial}')
+        ((monomial, coefficient),) = polynomial.items()
+        return {
+            tuple((raster_id, power*exponent) for raster_id, power in
+                  monomial): coefficient**exponent}
+    result = {(): 1.0}
+    for _ in range(exponent):
+        result = _multiply_polynomials(result, polynomial)
+    return result
+
+
+def evaluate_rpn_plan(
+        plan, array_map, nodata_map, target_nodata, zero_nodata):
+    """Evaluate a compiled plan on one block.
+
+    Parameters:
+        plan (dict): plan from ``compile_rpn_plan``.
+        array_map (dict): maps each raster id in the plan to its block.
+        nodata_map (dict): maps each raster id to its nodata value or None.
+        target_nodata (float): value of result pixels that are not valid.
+        zero_nodata (bool): if True nodata is treated as 0 and a pixel is
+            valid if any input is, otherwise a pixel is valid only if every
+            input is.
+
+    Returns:
+        float32 array of the block's shape.
+
+    """
+    shape = array_map[plan['raster_id_list'][0]].shape
+    if zero_nodata:
+        valid_mask = numpy.zeros(shape, dtype=bool)
+    else:
+        valid_mask = numpy.ones(shape, dtype=bool)
+    # one float32 copy of each raster with nodata set to 0 so no term
+    # overflows on nodata values that are masked out anyway
+    factor_map = {}
+    for raster_id in plan['raster_id_list']:
+        base_array = array_map[raster_id]
+        value_array = base_array.astype(numpy.float32)
+        nodata = nodata_map[raster_id]
+        if nodata is not None:
+            local_valid_mask = base_array != base_array.dtype.type(nodata)
+            if zero_nodata:
+                valid_mask |= local_valid_mask
+            else:
+                valid_mask &= local_valid_mask
+            value_array[~local_valid_mask] = 0.0
+        factor_map[(raster_id, 1)] = value_array
+
+    with numpy.errstate(all='ignore'):
+        for raster_id, power in plan['power_list']:
+            factor_map[(raster_id, power)] = numpy.power(
+                factor_map[(raster_id, 1)], numpy.float32(power))
+        product_map = {}
+        for prefix, parent_prefix, factor in plan['product_list']:
+            product_map[prefix] = numpy.multiply(
+                product_map[parent_prefix] if len(parent_prefix) > 1
+                else factor_map[parent_prefix[0]], factor_map[factor])
+
+        result = numpy.full(shape, plan['intercept'], dtype=numpy.float32)
+        term_array = numpy.empty(shape, dtype=numpy.float32)
+        for coefficient, prefix, factor_list in plan['term_list']:
+            numpy.multiply(
+                product_map[prefix] if len(prefix) > 1
+                else factor_map[prefix[0]], numpy.float32(coefficient),
+                out=term_array)
+            for factor in factor_list:
+                numpy.multiply(term_array, factor_map[factor], out=term_array)
+            numpy.add(result, term_array, out=result)
+    result[~valid_mask] = target_nodata
+    return result
+
+
+def rpn_plan_raster_calculator(
+        plan, raster_id_to_path_nodata_map, target_raster_path,
+        target_nodata, zero_nodata, n_threads):
+    """Evaluate a compiled plan over rasters on a shared grid.
+
+    Parameters:
+        plan (dict): plan from ``compile_rpn_plan``.
+        raster_id_to_path_nodata_map (dict): maps each raster id to a
+            (path, nodata) tuple, the rasters share a grid.
+        target_raster_path (str): path to float32 result raster, created on
+            the grid of the first raster.
+        target_nodata (float): nodata of the result.
+        zero_nodata (bool): as in ``evaluate_rpn_plan``.
+        n_threads (int): number of threads reading and evaluating blocks.
+
+    Returns:
+        None.
+
+    """
+    base_raster_path = raster_id_to_path_nodata_map[
+        plan['raster_id_list'][0]][0]
+    geoprocessing.new_raster_from_base(
+        base_raster_path, target_raster_path, gdal.GDT_Float32,
+        [target_nodata])
+    # size blocks so a thread's inputs, powers, shared products, result, and
+    # term buffer fit in its memory budget
+    n_buffers = (
+        len(plan['raster_id_list']) + len(plan['power_list']) +
+        len(plan['product_list']) + 2)
+    largest_block = max(
+        2**16, _PLAN_MEMORY_PER_THREAD // (n_buffers * 4))
+    offset_dict_list = list(geoprocessing.iterblocks(
+        (base_raster_path, 1), largest_block=largest_block,
+        offset_only=True))
+
+    target_raster = gdal.OpenEx(
+        target_raster_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+    target_band = target_raster.GetRasterBand(1)
+    n_threads = max(1, n_threads)
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        pending_future_set = set()
+        for window_index, offset_dict in enumerate(offset_dict_list):
+            pending_future_set.add(executor.submit(
+                _evaluate_rpn_plan_window, plan,
+                raster_id_to_path_nodata_map, offset_dict, target_nodata,
+                zero_nodata))
+            # only a few blocks ahead of the writer so memory stays bounded
+            if len(pending_future_set) >= 2 * n_threads:
+                done_future_set, pending_future_set = (
+                    concurrent.futures.wait(
+                        pending_future_set,
+                        return_when=concurrent.futures.FIRST_COMPLETED))
+                for future in done_future_set:
+                    _write_window(target_band, *future.result())
+                LOGGER.info(
+                    f'{(window_index+1)/len(offset_dict_list)*100:.2f}% '
+                    f'of blocks scheduled')
+        for future in concurrent.futures.as_completed(pending_future_set):
+            _write_window(target_band, *future.result())
+    target_band = None
+    target_raster = None
+
+
+def _evaluate_rpn_plan_window(
+        plan, raster_id_to_path_nodata_map, offset_dict, target_nodata,
+        zero_nodata):
+    """Read one window of every raster and evaluate ``plan`` on it."""
+    array_map = {
+        raster_id: _read_window(
+            raster_id_to_path_nodata_map[raster_id][0], offset_dict)
+        for raster_id in plan['raster_id_list']}
+    nodata_map = {
+        raster_id: raster_id_to_path_nodata_map[raster_id][1]
+        for raster_id in plan['raster_id_list']}
+    return offset_dict, evaluate_rpn_plan(
+        plan, array_map, nodata_map, target_nodata, zero_nodata)
+
+
+def _read_window(raster_path, offset_dict):
+    """Read a window of band 1 with this thread's handle to the raster."""
+    if not hasattr(_THREAD_LOCAL, 'band_map'):
+        _THREAD_LOCAL.band_map = {}
+    if raster_path not in _THREAD_LOCAL.band_map:
+        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+        _THREAD_LOCAL.band_map[raster_path] = (
+            raster, raster.GetRasterBand(1))
+    return _THREAD_LOCAL.band_map[raster_path][1].ReadAsArray(**offset_dict)
+
+
+def build_warped_vrt(
+        raster_path, target_pixel_size, target_bounding_box, nodata,
+        target_vrt_path):
+    """Write a warped VRT of a raster on the target grid.
+
+    Nothing is resampled until a window of the VRT is read, so reading the
+    VRT window by window streams the warp instead of writing an aligned
+    copy of the raster.
+
+    Parameters:
+        raster_path (str): path to source raster.
+        target_pixel_size (tuple): (x, y) target pixel size.
+        target_bounding_box (list): [minx, miny, maxx, maxy] of the target.
+        nodata (numeric): nodata of the source, used for pixels outside of
+            it, may be None.
+        target_vrt_path (str): path to the VRT to create.
+
+    Returns:
+        None.
+
+    """
+    warp_options = {
+        'format': 'VRT',
+        'outputBounds': target_bounding_box,
+        'xRes': abs(target_pixel_size[0]),
+        'yRes': abs(target_pixel_size[1]),
+        'resampleAlg': 'near',
+    }
+    if nodata is not None:
+        warp_options['srcNodata'] = nodata
+        warp_options['dstNodata'] = nodata
+    gdal.Warp(
+        target_vrt_path, raster_path, options=gdal.WarpOptions(
+            **warp_options))
+
+
+def _write_window(target_band, offset_dict, result):
+    """Write an evaluated window to the target band."""
+    target_band.WriteArray(
+        result, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='mult by columns script')
+    parser.add_argument(
+        '--lasso_table_path', type=str, required=True,
+        help='path to lasso table')
+    parser.add_argument(
+        '--data_dir', type=str, required=True,
+        help='path to directory containing rasters in lasso table path')
+    parser.add_argument(
+        '--workspace_dir', type=str, required=True,
+        help=(
+            'path to output directory, will contain "result.tif" after '
+            'completion'))
+    parser.add_argument(
+        '--bounding_box', type=float, nargs=4,
+        help=(
+            "manual bounding box in the form of four consecutive floats: "
+            "min_lng, min_lat, max_lng, max_lat, ex: "
+            "-180.0, -58.3, 180.0, 81.5"))
+    parser.add_argument(
+        '--pixel_size', type=float,
+        help="desired target pixel size in raster units")
+    parser.add_argument(
+        '--zero_nodata', action='store_true',
+        help=(
+            'if present, treat nodata values as 0, if absent any nodata '
+            'pixel in a stack will cause the output pixel to be nodata'))
+    parser.add_argument(
+        '--target_nodata', type=float, default=numpy.finfo('float32').min,
+        help='desired target nodata value')
+    parser.add_argument(
+        '--n_threads', type=int, default=N_CPUS,
+        help='number of threads reading and evaluating blocks')
+    parser.add_argument(
+        '--stream_warp', action='store_true', help=(
+            'read every raster through a warped VRT on the target grid '
+            'instead of writing aligned copies first'))
+    parser.add_argument(
+        '--warp_cache_mb', type=int, help=(
+            'with --stream_warp, MB of GDAL block cache to hold source '
+            'blocks that neighboring windows warp from'))
+
+    args = parser.parse_args()
+
+    LOGGER.info('parse lasso table path and build expression')
+    lasso_table_path = args.lasso_table_path
+    lasso_df = pandas.read_csv(lasso_table_path, header=None)
+
+    rpn_stack = build_rpn_stack(lasso_df)
     LOGGER.debug(rpn_stack)
 
-    # find the unique symbols in the expression
-    raster_id_list = [
-        x for x in set(rpn_stack)-set(OPERATOR_FN)
-        if not isinstance(x, (int, float))]
+    # compile the stack once, the plan holds the unique symbols too
+    rpn_plan = compile_rpn_plan(rpn_stack)
+    raster_id_list = rpn_plan['raster_id_list']
+    LOGGER.info(
+        f'{len(rpn_plan["term_list"])} terms over {len(raster_id_list)} '
+        f'rasters with {len(rpn_plan["product_list"])} shared products')
 
     LOGGER.debug(raster_id_list)
 
@@ -231,59 +604,62 @@ if __name__ == '__main__':
     LOGGER.info(f'target pixel size: {target_pixel_size}')
     LOGGER.info(f'target bounding box: {target_bounding_box}')
 
-    LOGGER.debug('align rasters, this might take a while')
-    task_graph = taskgraph.TaskGraph(args.workspace_dir, N_CPUS, 5.0)
-    align_dir = os.path.join(args.workspace_dir, 'aligned_rasters')
-    try:
-        os.makedirs(align_dir)
-    except OSError:
-        pass
-
-    # align rasters and cast to list because we'll rewrite
-    # raster_id_to_path_map object
-    for raster_id in raster_id_to_info_map:
-        raster_path = raster_id_to_info_map[raster_id]['path']
-        raster_basename = os.path.splitext(os.path.basename(raster_path))[0]
-        aligned_raster_path = os.path.join(
-            align_dir,
-            f'{raster_basename}_{target_bounding_box}_{target_pixel_size}.tif')
-        raster_id_to_info_map[raster_id]['aligned_path'] = \
-            aligned_raster_path
-        task_graph.add_task(
-            func=geoprocessing.warp_raster,
-            args=(
-                raster_path, target_pixel_size, aligned_raster_path,
-                'near'),
-            kwargs={
-                'target_bb': target_bounding_box,
-                'working_dir': args.workspace_dir
-            })
-
-    LOGGER.info('construct raster calculator raster path band list')
-    raster_path_band_list = []
-    LOGGER.debug(raster_id_list)
-    LOGGER.debug(raster_id_to_info_map)
-    for index, raster_id in enumerate(raster_id_list):
-        raster_path_band_list.append(
-            (raster_id_to_info_map[raster_id]['aligned_path'], 1))
-        raster_path_band_list.append(
-            (raster_id_to_info_map[raster_id]['nodata'], 'raw'))
-        if index != raster_id_to_info_map[raster_id]['index']:
-            raise RuntimeError(f"indexes dont match: {index} {raster_id} {raster_id_to_info_map}")
-
-    raster_path_band_list.append((args.target_nodata, 'raw'))
-    raster_path_band_list.append((rpn_stack, 'raw'))
-    raster_path_band_list.append((raster_id_to_info_map, 'raw'))
-    raster_path_band_list.append((args.zero_nodata, 'raw'))
-    LOGGER.debug(rpn_stack)
-
-    # wait for rasters to align
-    task_graph.close()
-    task_graph.join()
+    if args.stream_warp:
+        if args.warp_cache_mb:
+            gdal.SetCacheMax(args.warp_cache_mb * 2**20)
+        vrt_dir = os.path.join(args.workspace_dir, 'warped_vrts')
+        os.makedirs(vrt_dir, exist_ok=True)
+        for raster_info in raster_id_to_info_map.values():
+            raster_basename = os.path.splitext(
+                os.path.basename(raster_info['path']))[0]
+            vrt_path = os.path.join(
+                vrt_dir,
+                f'{raster_basename}_{target_bounding_box}_'
+                f'{target_pixel_size}.vrt')
+            build_warped_vrt(
+                raster_info['path'], target_pixel_size, target_bounding_box,
+                raster_info['nodata'], vrt_path)
+            raster_info['aligned_path'] = vrt_path
+    else:
+        LOGGER.debug('align rasters, this might take a while')
+        task_graph = taskgraph.TaskGraph(args.workspace_dir, N_CPUS, 5.0)
+        align_dir = os.path.join(args.workspace_dir, 'aligned_rasters')
+        try:
+            os.makedirs(align_dir)
+        except OSError:
+            pass
+
+        # align rasters and cast to list because we'll rewrite
+        # raster_id_to_path_map object
+        for raster_id in raster_id_to_info_map:
+            raster_path = raster_id_to_info_map[raster_id]['path']
+            raster_basename = os.path.splitext(
+                os.path.basename(raster_path))[0]
+            aligned_raster_path = os.path.join(
+                align_dir,
+                f'{raster_basename}_{target_bounding_box}_'
+                f'{target_pixel_size}.tif')
+            raster_id_to_info_map[raster_id]['aligned_path'] = \
+                aligned_raster_path
+            task_graph.add_task(
+                func=geoprocessing.warp_raster,
+                args=(
+                    raster_path, target_pixel_size, aligned_raster_path,
+                    'near'),
+                kwargs={
+                    'target_bb': target_bounding_box,
+                    'working_dir': args.workspace_dir
+                })
+
+        # wait for rasters to align
+        task_graph.close()
+        task_graph.join()
 
     result_path = os.path.join(args.workspace_dir, 'result.tif')
-    LOGGER.debug(raster_path_band_list)
-    geoprocessing.raster_calculator(
-        raster_path_band_list, raster_rpn_calculator_op, result_path,
-        gdal.GDT_Float32, float(args.target_nodata))
+    rpn_plan_raster_calculator(
+        rpn_plan, {
+            raster_id: (raster_info['aligned_path'], raster_info['nodata'])
+            for raster_id, raster_info in raster_id_to_info_map.items()},
+        result_path, float(args.target_nodata), args.zero_nodata,
+        args.n_threads)
     LOGGER.debug('all done')
@@ -5,6 +5,7 @@ Count non-zero non-nodata pixels in raster, get percentile values, and sum
 above each percentile to build the CDF.
 """
 import argparse
+import concurrent.futures
 import pickle
 import tempfile
 import glob
@@ -13,6 +14,7 @@ import os
 import shutil
 import logging
 import multiprocessing
+import time
 
 from ecoshard import taskgraph
 from ecoshard import geoprocessing
@@ -70,6 +72,7 @@ def main():
             args=(
                 raster_path, percentiles_list, percentile_working_dir,
                 result_pickle_path),
+            kwargs={'n_workers': max(1, N_CPUS // len(raster_path_list))},
             target_path_list=[result_pickle_path],
             task_name='%s percentile' % raster_path)
 
@@ -99,7 +102,8 @@ def main():
 
 
 def calculate_percentile(
-        raster_path, percentiles_list, workspace_dir, result_pickle_path):
+        raster_path, percentiles_list, workspace_dir, result_pickle_path,
+        n_workers=1):
     """Calculate the percentile cutoffs of a given raster. Store in json.
 
     Parameters:
@@ -114,6 +118,9 @@ def calculate_percentile(
                 in the same position in `percentile_list`.
             "percentile_sums_list" -- sum of all values up to the given
                 percentile in the same position in `percentile_list`.
+        n_workers (int): number of threads that sum block windows in
+            parallel. Threads are used rather than processes because this
+            function runs inside taskgraph's daemonic worker processes.
 
     Returns:
         None.
@@ -133,14 +140,19 @@ def calculate_percentile(
     LOGGER.debug('intermediate result_dict: %s', str(result_dict))
     LOGGER.debug('processing percentile sums for %s', raster_path)
     nodata_value = geoprocessing.get_raster_info(raster_path)['nodata'][0]
-    for _, block_data in geoprocessing.iterblocks((raster_path, 1)):
-        nodata_mask = numpy.isclose(block_data, nodata_value)
-        # this loop makes the block below a lot simpler
-        for index, percentile_value in enumerate(
-                result_dict['percentile_values_list']):
-            mask = (block_data > percentile_value) & (~nodata_mask)
-            result_dict['percentile_sum_list'][index] += (
-                numpy.sum(block_data[mask]))
+    offset_dict_list = list(geoprocessing.iterblocks(
+        (raster_path, 1), offset_only=True))
+    n_chunks = max(1, min(len(offset_dict_list), n_workers * 4))
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+        future_list = [
+            executor.submit(
+                _sum_above_percentiles_in_windows, raster_path,
+                offset_dict_list[chunk_index::n_chunks], nodata_value,
+                result_dict['percentile_values_list'])
+            for chunk_index in range(n_chunks)]
+        percentile_sum_array = numpy.sum(
+            [future.result() for future in future_list], axis=0)
+    result_dict['percentile_sum_list'] = percentile_sum_array.tolist()
 
     LOGGER.debug(
         'pickling percentile results of %s to %s', raster_path,
@@ -150,6 +162,93 @@ def calculate_percentile(
     shutil.rmtree(churn_dir)
 
 
+def sum_above_percentiles(block_data, nodata_value, percentile_value_list):
+    """Sum the valid values of a block above each percentile value.
+
+    The valid values are sorted once and summed cumulatively so each
+    threshold is a binary search into the cumulative sum, O(n log n) for
+    the block rather than a mask and sum per threshold.
+
+    Parameters:
+        block_data (numpy.ndarray): array of raster values.
+        nodata_value (numeric): nodata value of ``block_data`` or None.
+        percentile_value_list (list): threshold values.
+
+    Returns:
+        float64 array with the sum of the valid values strictly greater
+        than each threshold, in the same order as
+        ``percentile_value_list``.
+
+    """
+    # NaN and -inf are never above a threshold, and would make every
+    # cumulative sum NaN, so they are dropped with nodata
+    valid_mask = block_data > -numpy.inf
+    if nodata_value is not None:
+        valid_mask &= ~numpy.isclose(block_data, nodata_value)
+    sorted_array = numpy.sort(block_data[valid_mask], axis=None)
+    # cumulative_sum[i] is the sum of the i smallest values
+    cumulative_sum = numpy.concatenate(
+        ([0.0], numpy.cumsum(sorted_array, dtype=numpy.float64)))
+    n_at_or_below = numpy.searchsorted(
+        sorted_array, percentile_value_list, side='right')
+    return cumulative_sum[-1] - cumulative_sum[n_at_or_below]
+
+
+def _sum_above_percentiles_in_windows(
+        raster_path, offset_dict_list, nodata_value, percentile_value_list):
+    """Reduce ``sum_above_percentiles`` over a list of block windows."""
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    percentile_sum_array = numpy.zeros(len(percentile_value_list))
+    for offset_dict in offset_dict_list:
+        percentile_sum_array += sum_above_percentiles(
+            band.ReadAsArray(**offset_dict), nodata_value,
+            percentile_value_list)
+    band = None
+    raster = None
+    return percentile_sum_array
+
+
+def benchmark_sum_above_percentiles(n_pixels=2**22, n_percentiles=101):
+    """Compare the per-threshold mask loop to the sorted cumulative sum.
+
+    Parameters:
+        n_pixels (int): number of pixels in the synthetic block.
+        n_percentiles (int): number of evenly spaced percentiles.
+
+    Returns:
+        None.
+
+    """
+    nodata_value = -1.0
+    block_data = numpy.random.default_rng(0).lognormal(
+        size=n_pixels).astype(numpy.float32)
+    block_data[::7] = nodata_value
+    percentile_value_list = numpy.percentile(
+        block_data[block_data != nodata_value],
+        numpy.linspace(0, 100, n_percentiles))
+
+    start_time = time.time()
+    nodata_mask = numpy.isclose(block_data, nodata_value)
+    loop_sum_list = []
+    for percentile_value in percentile_value_list:
+        mask = (block_data > percentile_value) & (~nodata_mask)
+        loop_sum_list.append(numpy.sum(block_data[mask], dtype=numpy.float64))
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    sorted_sum_array = sum_above_percentiles(
+        block_data, nodata_value, percentile_value_list)
+    sorted_time = time.time() - start_time
+
+    LOGGER.info(
+        'k=%d n=%d: mask loop %.3fs, sorted cumulative sum %.3fs, '
+        'speedup %.1fx, max relative difference %.2e', n_percentiles,
+        n_pixels, loop_time, sorted_time, loop_time / sorted_time,
+        numpy.max(numpy.abs(sorted_sum_array - loop_sum_list) / numpy.maximum(
+            numpy.abs(loop_sum_list), 1e-12)))
+
+
 if __name__ == '__main__':
     file_logger = logging.FileHandler('percentile_cdf_log.txt')
     file_logger.setLevel(logging.DEBUG)
@@ -158,6 +257,13 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Run CDF pipeline')
     parser.add_argument(
         '--n_cpus', dest='n_cpus', type=int, default=N_CPUS)
+    parser.add_argument(
+        '--benchmark', action='store_true', help=(
+            'time the percentile sum step on a synthetic block for k=101 '
+            'instead of running the pipeline'))
     args = parser.parse_args()
     N_CPUS = args.n_cpus
-    main()
+    if args.benchmark:
+        benchmark_sum_above_percentiles()
+    else:
+        main()
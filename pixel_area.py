@@ -0,0 +1,209 @@
+"""Per pixel area of rasters and area weighted reductions.
+
+The area of a geographic (lat/lng) pixel only depends on its row, so the
+area of a whole raster is a single column of ``n_rows`` values. That column
+is calculated with numpy from the WGS84 ellipsoid and cached per
+(geotransform, n_rows). The reductions here multiply each block by its
+slice of the column as the block is read, so no per pixel area raster is
+written to disk. Projected rasters use the constant area of their pixels.
+All areas are in m^2.
+"""
+import functools
+import logging
+
+from ecoshard import geoprocessing
+from osgeo import osr
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+# WGS84 ellipsoid semi major and semi minor axes in meters
+_SEMI_MAJOR_AXIS = 6378137
+_SEMI_MINOR_AXIS = 6356752.3142
+
+
+def area_of_pixel(pixel_size, center_lat):
+    """Calculate m^2 area of a wgs84 square pixel.
+
+    Adapted from: https://gis.stackexchange.com/a/127327/2397
+
+    Parameters:
+        pixel_size (float): length of side of pixel in degrees.
+        center_lat (float or numpy.ndarray): latitude of the center of the
+            pixel. Note this value +/- half the `pixel-size` must not exceed
+            90/-90 degrees latitude or an invalid area will be calculated.
+
+    Returns:
+        Area of square pixel of side length `pixel_size` centered at
+        `center_lat` in m^2, an array if `center_lat` is an array.
+
+    """
+    center_lat = numpy.asarray(center_lat, dtype=numpy.float64)
+    return numpy.abs(pixel_size / 360. * (
+        _authalic_band_area(center_lat+pixel_size/2) -
+        _authalic_band_area(center_lat-pixel_size/2)))
+
+
+def _authalic_band_area(lat):
+    """Area in m^2 of the ellipsoid between the equator and ``lat``, x2pi."""
+    e = numpy.sqrt(1 - (_SEMI_MINOR_AXIS/_SEMI_MAJOR_AXIS)**2)
+    sin_lat = numpy.sin(numpy.radians(lat))
+    zm = 1 - e*sin_lat
+    zp = 1 + e*sin_lat
+    return numpy.pi * _SEMI_MINOR_AXIS**2 * (
+        numpy.log(zp/zm) / (2*e) + sin_lat / (zp*zm))
+
+
+@functools.lru_cache(maxsize=32)
+def _geographic_area_column(geotransform, n_rows):
+    """Return the read only (n_rows, 1) m^2 pixel area column of a grid."""
+    row_edge_lat = geotransform[3] + geotransform[5] * numpy.arange(
+        n_rows+1, dtype=numpy.float64)
+    area_column = numpy.abs(abs(geotransform[1]) / 360. * numpy.diff(
+        _authalic_band_area(row_edge_lat))).reshape((n_rows, 1))
+    area_column.flags.writeable = False
+    return area_column
+
+
+def get_area_column(raster_path):
+    """Return the per row pixel area of a raster.
+
+    Parameters:
+        raster_path (str): path to a geographic or projected raster.
+
+    Returns:
+        read only (n_rows, 1) float64 array whose row ``i`` is the m^2 area
+        of a pixel in row ``i`` of the raster. Geographic columns are cached
+        per (geotransform, n_rows).
+
+    """
+    raster_info = geoprocessing.get_raster_info(raster_path)
+    n_rows = raster_info['raster_size'][1]
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromWkt(raster_info['projection_wkt'])
+    if raster_srs.IsProjected():
+        area_column = numpy.full(
+            (n_rows, 1), abs(
+                raster_info['pixel_size'][0] * raster_info['pixel_size'][1]) *
+            raster_srs.GetLinearUnits()**2)
+        area_column.flags.writeable = False
+        return area_column
+    return _geographic_area_column(
+        tuple(raster_info['geotransform']), n_rows)
+
+
+def area_weighted_sum(base_raster_path_band):
+    """Sum of every valid pixel value times its area.
+
+    Parameters:
+        base_raster_path_band (tuple): (path, band index) of values.
+
+    Returns:
+        sum of value * m^2 area over the pixels that are not nodata or NaN.
+
+    """
+    area_column = get_area_column(base_raster_path_band[0])
+    nodata = geoprocessing.get_raster_info(base_raster_path_band[0])[
+        'nodata'][base_raster_path_band[1]-1]
+    area_sum = 0.0
+    for offset_dict, base_array in geoprocessing.iterblocks(
+            base_raster_path_band):
+        area_array = numpy.broadcast_to(_block_area_column(
+            area_column, offset_dict), base_array.shape)
+        valid_mask = _valid_mask(base_array, nodata)
+        area_sum += numpy.sum(
+            base_array[valid_mask].astype(numpy.float64) *
+            area_array[valid_mask])
+    return area_sum
+
+
+def mask_area(mask_raster_path_band, mask_value=1):
+    """Area of the pixels equal to ``mask_value``.
+
+    Parameters:
+        mask_raster_path_band (tuple): (path, band index) of mask raster.
+        mask_value (numeric): pixel value to count as inside the mask.
+
+    Returns:
+        m^2 area of the pixels equal to ``mask_value``.
+
+    """
+    area_column = get_area_column(mask_raster_path_band[0])
+    area_sum = 0.0
+    for offset_dict, mask_array in geoprocessing.iterblocks(
+            mask_raster_path_band):
+        # count masked pixels per row so only a row sum times the area
+        # column is needed
+        area_sum += float(numpy.sum(
+            numpy.count_nonzero(mask_array == mask_value, axis=1) *
+            _block_area_column(area_column, offset_dict)[:, 0]))
+    return area_sum
+
+
+def zone_areas(
+        zone_raster_path_band, mask_raster_path_band=None, mask_value=None):
+    """Area of each integer zone, optionally only under a mask.
+
+    Parameters:
+        zone_raster_path_band (tuple): (path, band index) of a non-negative
+            integer zone raster, zone nodata pixels are skipped.
+        mask_raster_path_band (tuple): if not None, (path, band index) of a
+            raster on the same grid as the zones; only its valid pixels are
+            counted.
+        mask_value (numeric): if not None and ``mask_raster_path_band`` is
+            given, only pixels of the mask equal to this are counted.
+
+    Returns:
+        dict mapping each zone id to its m^2 area.
+
+    """
+    area_column = get_area_column(zone_raster_path_band[0])
+    zone_nodata = geoprocessing.get_raster_info(zone_raster_path_band[0])[
+        'nodata'][zone_raster_path_band[1]-1]
+    if mask_raster_path_band is not None:
+        mask_nodata = geoprocessing.get_raster_info(
+            mask_raster_path_band[0])['nodata'][mask_raster_path_band[1]-1]
+        block_iterator = geoprocessing.iterblocks(
+            [zone_raster_path_band, mask_raster_path_band])
+    else:
+        block_iterator = (
+            (offset_dict, (zone_array, None)) for offset_dict, zone_array in
+            geoprocessing.iterblocks(zone_raster_path_band))
+
+    zone_area_array = numpy.zeros(0, dtype=numpy.float64)
+    for offset_dict, (zone_array, mask_array) in block_iterator:
+        valid_mask = _valid_mask(zone_array, zone_nodata)
+        if mask_array is not None:
+            if mask_value is not None:
+                valid_mask &= mask_array == mask_value
+            else:
+                valid_mask &= _valid_mask(mask_array, mask_nodata)
+        area_array = numpy.broadcast_to(_block_area_column(
+            area_column, offset_dict), zone_array.shape)
+        block_zone_area_array = numpy.bincount(
+            zone_array[valid_mask].astype(numpy.int64),
+            weights=area_array[valid_mask])
+        if block_zone_area_array.size > zone_area_array.size:
+            zone_area_array = numpy.concatenate((
+                zone_area_array, numpy.zeros(
+                    block_zone_area_array.size - zone_area_array.size)))
+        zone_area_array[:block_zone_area_array.size] += block_zone_area_array
+    return {
+        int(zone_id): float(zone_area_array[zone_id])
+        for zone_id in numpy.flatnonzero(zone_area_array)}
+
+
+def _block_area_column(area_column, offset_dict):
+    """Slice of ``area_column`` for the rows of one iterblocks block."""
+    return area_column[
+        offset_dict['yoff']:offset_dict['yoff']+offset_dict['win_ysize']]
+
+
+def _valid_mask(array, nodata):
+    """Return the mask of ``array`` that is neither ``nodata`` nor NaN."""
+    valid_mask = numpy.ones(array.shape, dtype=bool)
+    if nodata is not None:
+        valid_mask &= array != nodata
+    if numpy.issubdtype(array.dtype, numpy.floating):
+        valid_mask &= ~numpy.isnan(array)
+    return valid_mask
@@ -1,17 +1,117 @@
 """Record pixel values where points overlap the raster."""
 import argparse
 import glob
+import logging
+import multiprocessing
 import os
+import sys
 
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+import numpy
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=(
+        '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
+        ' [%(funcName)s:%(lineno)d] %(message)s'),
+    stream=sys.stdout)
+LOGGER = logging.getLogger(__name__)
+
+
+def sample_raster(raster_path, point_srs_wkt, x_array, y_array):
+    """Sample a raster at many points with one read per touched block.
+
+    All points are reprojected in a single call, converted to pixel
+    coordinates with numpy, grouped by the raster block they fall in, and
+    each touched block is read once with its values gathered by fancy
+    indexing.
+
+    Parameters:
+        raster_path (str): path to single band raster to sample.
+        point_srs_wkt (str): projection of ``x_array``/``y_array`` as WKT.
+        x_array (numpy.ndarray): x coordinates of the points.
+        y_array (numpy.ndarray): y coordinates of the points.
+
+    Returns:
+        tuple of (value_array, in_range_array), a float64 array the size of
+        ``x_array`` with the pixel value under each point and a boolean
+        array that is True where the point lies over the raster.
+
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    point_srs = osr.SpatialReference()
+    point_srs.ImportFromWkt(point_srs_wkt)
+    point_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromWkt(raster.GetProjection())
+    raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    point_to_raster_transform = osr.CoordinateTransformation(
+        point_srs, raster_srs)
+    transformed_array = numpy.array(
+        point_to_raster_transform.TransformPoints(
+            numpy.column_stack((x_array, y_array)).tolist()))
+    inv_gt = gdal.InvGeoTransform(raster.GetGeoTransform())
+    col_array = numpy.floor(
+        inv_gt[0] + inv_gt[1] * transformed_array[:, 0] +
+        inv_gt[2] * transformed_array[:, 1])
+    row_array = numpy.floor(
+        inv_gt[3] + inv_gt[4] * transformed_array[:, 0] +
+        inv_gt[5] * transformed_array[:, 1])
+
+    value_array = numpy.full(x_array.shape, numpy.nan)
+    in_range_array = (
+        (col_array >= 0) & (col_array < raster.RasterXSize) &
+        (row_array >= 0) & (row_array < raster.RasterYSize))
+    in_range_index_array = numpy.nonzero(in_range_array)[0]
+    col_array = col_array[in_range_index_array].astype(numpy.int64)
+    row_array = row_array[in_range_index_array].astype(numpy.int64)
+
+    block_xsize, block_ysize = band.GetBlockSize()
+    block_col_array = col_array // block_xsize
+    block_row_array = row_array // block_ysize
+    # sort points so every block's points are contiguous
+    sort_order = numpy.lexsort((block_col_array, block_row_array))
+    block_key_array = (
+        block_row_array[sort_order] *
+        ((raster.RasterXSize + block_xsize - 1) // block_xsize) +
+        block_col_array[sort_order])
+    _, block_start_array = numpy.unique(block_key_array, return_index=True)
+    for start, end in zip(
+            block_start_array,
+            list(block_start_array[1:]) + [len(sort_order)]):
+        point_index_array = sort_order[start:end]
+        xoff = block_col_array[point_index_array[0]] * block_xsize
+        yoff = block_row_array[point_index_array[0]] * block_ysize
+        block_array = band.ReadAsArray(
+            xoff=int(xoff), yoff=int(yoff),
+            win_xsize=int(min(block_xsize, raster.RasterXSize - xoff)),
+            win_ysize=int(min(block_ysize, raster.RasterYSize - yoff)))
+        value_array[in_range_index_array[point_index_array]] = block_array[
+            row_array[point_index_array] - yoff,
+            col_array[point_index_array] - xoff]
+    LOGGER.info(
+        'sampled %d of %d points from %d blocks of %s',
+        len(in_range_index_array), len(x_array), len(block_start_array),
+        raster_path)
+    return value_array, in_range_array
+
+
+def _sample_raster_worker(args):
+    """Unpack ``args`` for ``sample_raster`` in a worker process."""
+    return sample_raster(*args)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Pixel picker.')
     parser.add_argument('raster_path', help='path to sample raster')
     parser.add_argument('point_vector_path', help='path to point vector')
+    parser.add_argument(
+        '--n_workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of rasters to sample in parallel')
     args = parser.parse_args()
 
     point_vector = gdal.OpenEx(args.point_vector_path, gdal.OF_VECTOR)
@@ -36,52 +136,62 @@ if __name__ == '__main__':
         base_layer_field_name_list.append(field_defn.GetName())
         target_layer.CreateField(field_defn)
 
-    for raster_path in glob.glob(args.raster_path):
-        basename = os.path.splitext(os.path.basename(raster_path))[0]
+    raster_path_list = glob.glob(args.raster_path)
+    basename_list = [
+        os.path.splitext(os.path.basename(raster_path))[0]
+        for raster_path in raster_path_list]
+    for basename in basename_list:
         target_layer.CreateField(ogr.FieldDefn(basename, ogr.OFTReal))
 
-    fid_to_feature_map = {}
-
-    for raster_path in glob.glob(args.raster_path):
-        basename = os.path.splitext(os.path.basename(raster_path))[0]
-        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
-        band = raster.GetRasterBand(1)
-        raster_srs_wkt = raster.GetProjection()
-        raster_srs = osr.SpatialReference()
-        raster_srs.ImportFromWkt(raster_srs_wkt)
-
-        raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
-
-        gt = raster.GetGeoTransform()
-        inv_gt = gdal.InvGeoTransform(gt)
-
-        point_to_raster_transform = osr.CoordinateTransformation(
-            point_srs, raster_srs)
-        point_layer.ResetReading()
-        for point in point_layer:
-            point_fid = point.GetFID()
-            point_geom = point.GetGeometryRef()
-            base_point_geom = point_geom.Clone()
-            val = point_geom.Transform(point_to_raster_transform)
-            result = gdal.ApplyGeoTransform(
-                inv_gt, point_geom.GetX(), point_geom.GetY())
-            print(f'{base_point_geom} converted to {point_geom} found at {result}')
-            if (result[0] >= 0 and result[0] < raster.RasterXSize and
-                    result[1] >= 0 and result[1] < raster.RasterYSize):
-                print('its in range')
-                if point_fid not in fid_to_feature_map:
-                    feature_defn = target_layer.GetLayerDefn()
-                    feature = ogr.Feature(feature_defn)
-                    feature.SetGeometry(base_point_geom.Clone())
-                    for base_field_name in base_layer_field_name_list:
-                        feature.SetField(
-                            base_field_name, point.GetField(base_field_name))
-                    fid_to_feature_map[point_fid] = feature
-                pixel_value = band.ReadAsArray(
-                    result[0], result[1], 1, 1)[0][0]
-                print(f'{result[0]} {result[1]}, {pixel_value}')
-                fid_to_feature_map[point_fid].SetField(
-                    basename, float(pixel_value))
-
-    for feature in fid_to_feature_map.values():
+    # one pass over the points to pull coordinates and attributes
+    point_geom_list = []
+    point_field_list = []
+    x_list = []
+    y_list = []
+    point_layer.ResetReading()
+    for point in point_layer:
+        point_geom = point.GetGeometryRef()
+        point_geom_list.append(point_geom.Clone())
+        point_field_list.append([
+            point.GetField(base_field_name)
+            for base_field_name in base_layer_field_name_list])
+        x_list.append(point_geom.GetX())
+        y_list.append(point_geom.GetY())
+    x_array = numpy.array(x_list)
+    y_array = numpy.array(y_list)
+    point_srs_wkt = point_srs.ExportToWkt()
+
+    with multiprocessing.Pool(
+            max(1, min(args.n_workers, len(raster_path_list)))) as pool:
+        sample_result_list = pool.map(_sample_raster_worker, [
+            (raster_path, point_srs_wkt, x_array, y_array)
+            for raster_path in raster_path_list])
+
+    # only points that lie over at least one raster are written
+    value_matrix = numpy.array([
+        value_array for value_array, _ in sample_result_list]).reshape(
+            (len(raster_path_list), len(x_array)))
+    in_range_matrix = numpy.array([
+        in_range_array for _, in_range_array in sample_result_list]).reshape(
+            (len(raster_path_list), len(x_array)))
+    in_any_raster_array = numpy.any(in_range_matrix, axis=0)
+    feature_defn = target_layer.GetLayerDefn()
+    target_layer.StartTransaction()
+    for point_index in numpy.nonzero(in_any_raster_array)[0]:
+        feature = ogr.Feature(feature_defn)
+        feature.SetGeometry(point_geom_list[point_index])
+        for base_field_name, field_value in zip(
+                base_layer_field_name_list, point_field_list[point_index]):
+            feature.SetField(base_field_name, field_value)
+        for basename, pixel_value, in_range in zip(
+                basename_list, value_matrix[:, point_index],
+                in_range_matrix[:, point_index]):
+            if in_range:
+                feature.SetField(basename, float(pixel_value))
         target_layer.CreateFeature(feature)
+    target_layer.CommitTransaction()
+    LOGGER.info(
+        'wrote %d points to %s', numpy.count_nonzero(in_any_raster_array),
+        target_vector_path)
+    target_layer = None
+    target_vector = None
@@ -1,18 +1,27 @@
 """Process a raster calculator plain text expression."""
+import ast
+import collections
+import concurrent.futures
+import glob
 import hashlib
 import logging
+import multiprocessing
 import os
 import pickle
 import re
-import tempfile
+import shutil
 import time
-import urllib.request
 
 from ecoshard import geoprocessing
 from ecoshard.geoprocessing import symbolic
 from osgeo import gdal
-from retrying import retry
+import ecoshard_download
 import numpy
+import streaming_percentile
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 
 LOGGER = logging.getLogger(__name__)
@@ -21,6 +30,80 @@ gdal.SetCacheMax(2**26)
 
 RASTER_CALCULATIONS_WORKSPACE = 'raster_calculations_workspace_not_for_humans'
 
+# largest number of pixels read per input raster when several expressions
+# share one pass over the blocks of an aligned grid
+_FUSED_LARGEST_BLOCK = 2**22
+
+# functions that may be called inside a fused expression
+_EXPRESSION_FUNCTION_MAP = {
+    'abs': numpy.abs,
+    'exp': numpy.exp,
+    'log': numpy.log,
+    'sqrt': numpy.sqrt,
+    'max': numpy.maximum,
+    'min': numpy.minimum,
+}
+
+# aligned rasters are cached in this subdirectory of the workspace and
+# shared by every expression that needs the same warp
+_WARP_CACHE_DIRNAME = 'warp_cache'
+_WARP_CACHE_MAX_BYTES = 2**37
+
+# pickle of an expression's aligned input paths in its churn directory
+_PROCESSED_RASTER_LIST_FILENAME = 'processed_raster_list.pickle'
+
+# targets of sparse expressions are created with SPARSE_OK so blocks that
+# are never written are never allocated in the file and read as nodata
+_SPARSE_GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
+    geoprocessing.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS[1]) +
+    ('SPARSE_OK=TRUE',))
+
+# number of threads used by the 'compiled' engine when numexpr is not
+# installed and blocks are evaluated in numpy row strips
+_COMPILED_ENGINE_N_THREADS = multiprocessing.cpu_count()
+
+# operator symbols the 'compiled' engine can emit into a kernel
+_PLAN_OPERATOR_MAP = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Pow: '**',
+    ast.Mod: '%',
+    ast.BitAnd: '&',
+    ast.BitOr: '|',
+    ast.USub: '-',
+    ast.UAdd: '+',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Eq: '==',
+    ast.NotEq: '!=',
+}
+
+# numpy equivalents of the functions available inside a plan kernel
+_PLAN_FUNCTION_MAP = {
+    'where': numpy.where,
+    'abs': numpy.abs,
+    'exp': numpy.exp,
+    'log': numpy.log,
+    'sqrt': numpy.sqrt,
+}
+
+_NUMPY_TO_GDAL_TYPE = {
+    numpy.dtype(numpy.uint8): gdal.GDT_Byte,
+    numpy.dtype(numpy.int16): gdal.GDT_Int16,
+    numpy.dtype(numpy.uint16): gdal.GDT_UInt16,
+    numpy.dtype(numpy.int32): gdal.GDT_Int32,
+    numpy.dtype(numpy.uint32): gdal.GDT_UInt32,
+    numpy.dtype(numpy.float32): gdal.GDT_Float32,
+    numpy.dtype(numpy.float64): gdal.GDT_Float64,
+}
+_GDAL_TO_NUMPY_TYPE = {
+    gdal_type: numpy_type
+    for numpy_type, gdal_type in _NUMPY_TO_GDAL_TYPE.items()}
+
 # from taskgraph.Task import _normalize_path
 
 # class AttrArray(numpy.ndarray):
@@ -102,7 +185,8 @@ RASTER_CALCULATIONS_WORKSPACE = 'raster_calculations_workspace_not_for_humans'
 #         largest_block=largest_block))
 
 
-def evaluate_calculation(args, task_graph, workspace_dir):
+def evaluate_calculation(
+        args, task_graph, workspace_dir, dependent_task_list=None):
     """Evaluate raster calculator expression object.
 
     Parameters:
@@ -128,16 +212,375 @@ def evaluate_calculation(args, task_graph, workspace_dir):
             different sizes will raise a ValueError.
         args['target_datatype'] (gdal int): either None or gdal datatype
             for desired target raster calculation
+        args['engine'] (str): if 'compiled' the expression is parsed once,
+            constant folded, common subexpressions are hoisted into
+            temporaries, and each block is evaluated with a fused
+            multithreaded kernel (numexpr if it is installed, otherwise
+            numpy over row strips in a thread pool) with the nodata mask
+            folded in. If not defined the expression is evaluated with
+            ``symbolic.evaluate_raster_calculator_expression``.
+        args['warp_cache_max_bytes'] (int): if defined, the disk budget of
+            the workspace's shared cache of aligned rasters. Inputs that
+            need to be reprojected or resized are warped once per unique
+            (input, projection, pixel size, resample method, bounding box)
+            into that cache and reused by later expressions and runs.
+            When the cache is over budget the least recently used entries
+            are removed along with the expression workspace links to them,
+            and those expressions realign their inputs if they run again.
+        args['sparse'] (bool): if True and the expression is plain
+            arithmetic, it is evaluated block by block and blocks where
+            every pixel has a nodata input, including blocks that are
+            unallocated in a sparse input GeoTIFF, are neither computed nor
+            written. The target is created with SPARSE_OK=TRUE so skipped
+            blocks are never materialised and read back as
+            ``target_nodata``, which must not be None. The number of
+            skipped blocks is logged.
         workspace_dir (str): path to a directory that can be used to store
             intermediate values.
+        dependent_task_list (list): if not None, tasks that must finish
+            before any input is read, e.g. the tasks creating inputs that
+            are targets of other expressions.
 
     Returns:
-        None.
+        Task that writes ``args['target_raster_path']``.
 
     """
     args_copy = args.copy()
+    (symbol_to_path_band_map, processed_raster_list_file_path,
+     preprocess_task) = _schedule_preprocess(
+        args_copy, task_graph, workspace_dir,
+        dependent_task_list=dependent_task_list)
+
+    evaluate_expression_task = task_graph.add_task(
+        func=_evaluate_expression,
+        args=(
+            processed_raster_list_file_path, symbol_to_path_band_map,
+            args_copy, workspace_dir),
+        target_path_list=[args['target_raster_path']],
+        dependent_task_list=[preprocess_task],
+        task_name='%s -> %s' % (
+            args['expression'],
+            os.path.basename(args['target_raster_path'])))
+
+    build_overview = (
+        'build_overview' in args and args['build_overview'])
+    if build_overview:
+        overview_path = '%s.ovr' % (
+            args['target_raster_path'])
+        task_graph.add_task(
+            func=build_overviews,
+            args=(args['target_raster_path'],),
+            dependent_task_list=[evaluate_expression_task],
+            target_path_list=[overview_path],
+            task_name='overview for %s' % args['target_raster_path'])
+    return evaluate_expression_task
+
+
+def evaluate_calculation_list(
+        calculation_list, task_graph, workspace_dir,
+        largest_block=_FUSED_LARGEST_BLOCK, memory_budget_bytes=None):
+    """Evaluate a list of raster calculator expression objects as a DAG.
+
+    An expression depends on another if one of its symbol paths is the
+    other's ``target_raster_path``, so expressions can be listed in any
+    order and consume each other's results without joining the task graph
+    in between. Expressions are grouped into levels where each level only
+    depends on earlier ones, and every expression's evaluation only waits
+    on the expressions it reads.
+
+    Every expression is downloaded and preprocessed exactly as in
+    ``evaluate_calculation``. The plain arithmetic expressions of a level
+    that read the same other expressions' targets and download the same
+    urls are evaluated in fused tasks, so an expression is never held back
+    by a slower producer or download it doesn't read. Those tasks group the
+    expressions by aligned grid and walk the blocks of each group once,
+    reading every distinct input raster a single time per block and writing
+    all of the group's outputs from that in-memory block. Expressions that
+    need special handling (``percentile(...)`` or ``mask(raster, ...)``)
+    fall back to ``evaluate_calculation``.
+
+    Evaluation tasks are limited by an estimate of their block memory: a
+    fused task is split if it would exceed ``memory_budget_bytes`` on its
+    own, and a task waits for the oldest running tasks to finish while
+    starting it would exceed the budget.
+
+    Parameters:
+        calculation_list (list): list of expression dictionaries of the
+            form documented in ``evaluate_calculation``.
+        task_graph (TaskGraph): taskgraph object to schedule work on.
+        workspace_dir (str): path to a directory that can be used to store
+            intermediate values.
+        largest_block (int): largest number of pixels to hold in memory per
+            input raster when walking the blocks of a grid.
+        memory_budget_bytes (int): estimated bytes of blocks evaluation
+            tasks may hold at once, if None half of the physical memory.
+
+    Returns:
+        dict mapping each target raster path to the task that writes it.
+
+    Raises:
+        ValueError if two expressions have the same target or if the
+        expressions depend on each other in a cycle.
+
+    """
+    if memory_budget_bytes is None:
+        memory_budget_bytes = _default_memory_budget()
+    dependency_index_list = _calculation_dependencies(calculation_list)
+    level_list = _calculation_levels(dependency_index_list)
+
+    target_task_list = [None] * len(calculation_list)
+    # (task, estimated bytes) of scheduled evaluations, oldest first
+    running_task_list = collections.deque()
+    running_bytes = 0
+
+    def _memory_dependencies(task_bytes):
+        """Pop the oldest evaluations until ``task_bytes`` fits."""
+        nonlocal running_bytes
+        memory_task_list = []
+        while running_task_list and (
+                running_bytes + task_bytes > memory_budget_bytes):
+            oldest_task, oldest_bytes = running_task_list.popleft()
+            running_bytes -= oldest_bytes
+            memory_task_list.append(oldest_task)
+        return memory_task_list
+
+    for level_index_list in level_list:
+        fused_index_list = []
+        for index in level_index_list:
+            args = calculation_list[index]
+            producer_task_list = [
+                target_task_list[dependency_index]
+                for dependency_index in dependency_index_list[index]]
+            if _is_fusable_expression(args['expression']):
+                fused_index_list.append(index)
+                continue
+            task_bytes = _estimate_block_bytes([args], largest_block)
+            target_task_list[index] = evaluate_calculation(
+                args, task_graph, workspace_dir,
+                dependent_task_list=(
+                    producer_task_list + _memory_dependencies(task_bytes)))
+            running_task_list.append((target_task_list[index], task_bytes))
+            running_bytes += task_bytes
+
+        # only fuse expressions that wait on the same producers and downloads
+        dependency_group_map = {}
+        for index in fused_index_list:
+            url_list = sorted(set([
+                path for path in calculation_list[index][
+                    'symbol_to_path_map'].values()
+                if isinstance(path, str) and path.startswith(
+                    ('http://', 'https://'))]))
+            dependency_group_map.setdefault(
+                (tuple(dependency_index_list[index]), tuple(url_list)),
+                []).append(index)
+        batch_list = [
+            batch_index_list
+            for group_index_list in dependency_group_map.values()
+            for batch_index_list in _split_by_memory(
+                group_index_list, calculation_list, largest_block,
+                memory_budget_bytes)]
+
+        for batch_index_list in batch_list:
+            batch_args_list = [
+                calculation_list[index] for index in batch_index_list]
+            task_bytes = _estimate_block_bytes(batch_args_list, largest_block)
+            memory_task_list = _memory_dependencies(task_bytes)
+            fused_args_list = []
+            processed_raster_list_file_path_list = []
+            symbol_to_path_band_map_list = []
+            preprocess_task_list = []
+            for index, args in zip(batch_index_list, batch_args_list):
+                args_copy = args.copy()
+                (symbol_to_path_band_map, processed_raster_list_file_path,
+                 preprocess_task) = _schedule_preprocess(
+                    args_copy, task_graph, workspace_dir,
+                    dependent_task_list=[
+                        target_task_list[dependency_index]
+                        for dependency_index in dependency_index_list[
+                            index]])
+                fused_args_list.append(args_copy)
+                processed_raster_list_file_path_list.append(
+                    processed_raster_list_file_path)
+                symbol_to_path_band_map_list.append(symbol_to_path_band_map)
+                preprocess_task_list.append(preprocess_task)
+
+            evaluate_batch_task = task_graph.add_task(
+                func=_evaluate_expression_batch,
+                args=(
+                    processed_raster_list_file_path_list,
+                    symbol_to_path_band_map_list, fused_args_list),
+                kwargs={'largest_block': largest_block},
+                target_path_list=[
+                    args['target_raster_path'] for args in fused_args_list],
+                dependent_task_list=preprocess_task_list + memory_task_list,
+                task_name='fused evaluation of %d expressions' % len(
+                    fused_args_list))
+            running_task_list.append((evaluate_batch_task, task_bytes))
+            running_bytes += task_bytes
+
+            for index, args in zip(batch_index_list, fused_args_list):
+                target_task_list[index] = evaluate_batch_task
+                if 'build_overview' in args and args['build_overview']:
+                    overview_path = '%s.ovr' % args['target_raster_path']
+                    task_graph.add_task(
+                        func=build_overviews,
+                        args=(args['target_raster_path'],),
+                        dependent_task_list=[evaluate_batch_task],
+                        target_path_list=[overview_path],
+                        task_name='overview for %s' % (
+                            args['target_raster_path']))
+
+    return {
+        args['target_raster_path']: task
+        for args, task in zip(calculation_list, target_task_list)}
+
+
+def _calculation_dependencies(calculation_list):
+    """Find which expressions read the targets of other expressions.
+
+    Parameters:
+        calculation_list (list): list of expression dictionaries.
+
+    Returns:
+        list parallel to ``calculation_list`` of sorted lists of the
+        indexes of the expressions each one depends on.
+
+    Raises:
+        ValueError if two expressions have the same target.
+
+    """
+    target_to_index_map = {}
+    for index, args in enumerate(calculation_list):
+        target_key = os.path.normcase(os.path.abspath(
+            args['target_raster_path']))
+        if target_key in target_to_index_map:
+            raise ValueError(
+                f'{args["target_raster_path"]} is the target of more than '
+                f'one expression')
+        target_to_index_map[target_key] = index
+
+    dependency_index_list = []
+    for index, args in enumerate(calculation_list):
+        dependency_index_set = set()
+        for path in args['symbol_to_path_map'].values():
+            if not isinstance(path, str) or path.startswith(
+                    ('http://', 'https://')):
+                continue
+            dependency_index = target_to_index_map.get(
+                os.path.normcase(os.path.abspath(path)))
+            if dependency_index is not None and dependency_index != index:
+                dependency_index_set.add(dependency_index)
+        dependency_index_list.append(sorted(dependency_index_set))
+    return dependency_index_list
+
+
+def _calculation_levels(dependency_index_list):
+    """Group expressions into levels that only depend on earlier levels.
+
+    Parameters:
+        dependency_index_list (list): from ``_calculation_dependencies``.
+
+    Returns:
+        list of lists of expression indexes, level ``i`` holds the
+        expressions whose longest chain of dependencies has length ``i``.
+
+    Raises:
+        ValueError if the dependencies contain a cycle.
+
+    """
+    n_dependencies_list = [
+        len(dependencies) for dependencies in dependency_index_list]
+    dependent_index_list = [[] for _ in dependency_index_list]
+    for index, dependencies in enumerate(dependency_index_list):
+        for dependency_index in dependencies:
+            dependent_index_list[dependency_index].append(index)
+
+    level_list = []
+    ready_index_list = [
+        index for index, n_dependencies in enumerate(n_dependencies_list)
+        if n_dependencies == 0]
+    n_leveled = 0
+    while ready_index_list:
+        level_list.append(ready_index_list)
+        n_leveled += len(ready_index_list)
+        next_index_list = []
+        for index in ready_index_list:
+            for dependent_index in dependent_index_list[index]:
+                n_dependencies_list[dependent_index] -= 1
+                if n_dependencies_list[dependent_index] == 0:
+                    next_index_list.append(dependent_index)
+        ready_index_list = sorted(next_index_list)
+    if n_leveled != len(dependency_index_list):
+        raise ValueError(
+            'expressions depend on each other in a cycle: ' + ', '.join([
+                str(index) for index, n_dependencies in enumerate(
+                    n_dependencies_list) if n_dependencies > 0]))
+    return level_list
+
+
+def _estimate_block_bytes(args_list, largest_block):
+    """Estimate the block memory of evaluating expressions together.
+
+    Every distinct input and every target holds one block of at most
+    ``largest_block`` pixels, counted at 8 bytes a pixel.
+
+    """
+    input_set = set()
+    for args in args_list:
+        input_set.update([
+            path for path in args['symbol_to_path_map'].values()
+            if isinstance(path, str)])
+    return largest_block * 8 * (len(input_set) + len(args_list))
+
+
+def _split_by_memory(
+        index_list, calculation_list, largest_block, memory_budget_bytes):
+    """Split expression indexes into batches that fit the memory budget."""
+    batch_list = []
+    batch_index_list = []
+    for index in index_list:
+        if batch_index_list and _estimate_block_bytes([
+                calculation_list[batch_index]
+                for batch_index in batch_index_list + [index]],
+                largest_block) > memory_budget_bytes:
+            batch_list.append(batch_index_list)
+            batch_index_list = []
+        batch_index_list.append(index)
+    if batch_index_list:
+        batch_list.append(batch_index_list)
+    return batch_list
+
+
+def _default_memory_budget():
+    """Return half of the physical memory, or 8GB if it's unknown."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (AttributeError, ValueError, OSError):
+        return 2**33
+
+
+def _schedule_preprocess(
+        args, task_graph, workspace_dir, dependent_task_list=None):
+    """Schedule the download and alignment tasks for an expression.
+
+    Parameters:
+        args (dict): expression dictionary as defined in
+            ``evaluate_calculation``.
+        task_graph (TaskGraph): taskgraph object to schedule work on.
+        workspace_dir (str): path to a directory that can be used to store
+            intermediate values.
+        dependent_task_list (list): if not None, tasks that must finish
+            before the rasters are preprocessed.
+
+    Returns:
+        tuple of (symbol_to_path_band_map, processed_raster_list_file_path,
+        preprocess_task) where the map is each symbol to the (path, band) of
+        its unprocessed raster, the file path is the pickle that will hold
+        the processed raster list, and the task is the one that creates it.
+
+    """
     expression_id = os.path.splitext(
-        os.path.basename(args_copy['target_raster_path']))[0]
+        os.path.basename(args['target_raster_path']))[0]
     expression_workspace_path = os.path.join(workspace_dir, expression_id)
     expression_ecoshard_path = os.path.join(
         expression_workspace_path, 'ecoshard')
@@ -148,7 +591,7 @@ def evaluate_calculation(args, task_graph, workspace_dir):
     # process ecoshards if necessary
     symbol_to_path_band_map = {}
     download_task_list = []
-    for symbol, path in args_copy['symbol_to_path_map'].items():
+    for symbol, path in args['symbol_to_path_map'].items():
         if isinstance(path, str) and (
                 path.startswith('http://') or path.startswith('https://')):
             # download to local file
@@ -179,7 +622,7 @@ def evaluate_calculation(args, task_graph, workspace_dir):
         pass
 
     processed_raster_list_file_path = os.path.join(
-        process_raster_churn_dir, 'processed_raster_list.pickle')
+        process_raster_churn_dir, _PROCESSED_RASTER_LIST_FILENAME)
     LOGGER.debug(symbol_to_path_band_map)
 
     target_projection_wkt = None
@@ -194,6 +637,9 @@ def evaluate_calculation(args, task_graph, workspace_dir):
     bounding_box_mode = 'intersection'
     if 'bounding_box_mode' in args:
         bounding_box_mode = args['bounding_box_mode']
+    warp_cache_max_bytes = _WARP_CACHE_MAX_BYTES
+    if 'warp_cache_max_bytes' in args:
+        warp_cache_max_bytes = args['warp_cache_max_bytes']
     preprocess_task = task_graph.add_task(
         func=_preprocess_rasters,
         args=(
@@ -203,33 +649,17 @@ def evaluate_calculation(args, task_graph, workspace_dir):
             'target_projection_wkt': target_projection_wkt,
             'target_pixel_size': target_pixel_size,
             'resample_method': resample_method,
-            'bounding_box_mode': bounding_box_mode},
-        dependent_task_list=download_task_list,
+            'bounding_box_mode': bounding_box_mode,
+            'warp_cache_dir': os.path.join(workspace_dir, _WARP_CACHE_DIRNAME),
+            'warp_cache_max_bytes': warp_cache_max_bytes},
+        dependent_task_list=download_task_list + list(
+            dependent_task_list or []),
         target_path_list=[processed_raster_list_file_path],
         task_name='preprocess rasters for %s' % args['target_raster_path'])
 
-    evaluate_expression_task = task_graph.add_task(
-        func=_evaluate_expression,
-        args=(
-            processed_raster_list_file_path, symbol_to_path_band_map,
-            args_copy, workspace_dir),
-        target_path_list=[args['target_raster_path']],
-        dependent_task_list=[preprocess_task],
-        task_name='%s -> %s' % (
-            args['expression'],
-            os.path.basename(args['target_raster_path'])))
-
-    build_overview = (
-        'build_overview' in args and args['build_overview'])
-    if build_overview:
-        overview_path = '%s.ovr' % (
-            args['target_raster_path'])
-        task_graph.add_task(
-            func=build_overviews,
-            args=(args['target_raster_path'],),
-            dependent_task_list=[evaluate_expression_task],
-            target_path_list=[overview_path],
-            task_name='overview for %s' % args['target_raster_path'])
+    return (
+        symbol_to_path_band_map, processed_raster_list_file_path,
+        preprocess_task)
 
 
 def _evaluate_expression(
@@ -268,25 +698,50 @@ def _evaluate_expression(
         target_datatype = args['target_datatype']
 
     expression = args['expression']
-    # search for percentile functions
-    match_obj = re.match(
-        r'(.*)(percentile\(([^,]*), ([^)]*)\))(.*)', expression)
-    if match_obj:
-        base_raster_path_band = args['symbol_to_path_band_map'][
-            match_obj.group(3)]
-        percentile_threshold = float(match_obj.group(4))
-        working_sort_directory = tempfile.mkdtemp(dir=workspace_dir)
+    # resolve every percentile(symbol, p) call with one streaming pass
+    percentile_match_list = list(re.finditer(
+        r'percentile\(\s*([A-Za-z_]\w*)\s*,\s*([^)]+)\)', expression))
+    if percentile_match_list:
+        path_band_to_percentile_list_map = collections.defaultdict(list)
+        for match_obj in percentile_match_list:
+            path_band_to_percentile_list_map[
+                args['symbol_to_path_band_map'][match_obj.group(1)]].append(
+                    float(match_obj.group(2)))
         LOGGER.debug(
-            'doing percentile of %s to %s', base_raster_path_band,
-            percentile_threshold)
-        percentile_val = geoprocessing.raster_band_percentile(
-            base_raster_path_band, working_sort_directory,
-            [percentile_threshold])[0]
-        expression = '%s%f%s' % (
-            match_obj.group(1), percentile_val, match_obj.group(5))
+            'doing percentiles %s', dict(path_band_to_percentile_list_map))
+        path_band_to_value_list_map = (
+            streaming_percentile.raster_band_percentiles(
+                path_band_to_percentile_list_map))
+        for match_obj in reversed(percentile_match_list):
+            path_band = args['symbol_to_path_band_map'][match_obj.group(1)]
+            percentile_val = path_band_to_value_list_map[path_band][
+                path_band_to_percentile_list_map[path_band].index(
+                    float(match_obj.group(2)))]
+            if percentile_val is None:
+                raise ValueError(
+                    f'{match_obj.group(0)} is undefined because '
+                    f'{path_band[0]} has no valid pixels')
+            expression = '%s(%r)%s' % (
+                expression[:match_obj.start()], percentile_val,
+                expression[match_obj.end():])
         LOGGER.debug('new expression: %s', expression)
 
-    if not expression.startswith('mask(raster'):
+    engine = args.get('engine', None)
+    sparse = args.get('sparse', False)
+    if (engine == 'compiled' or sparse) and _is_fusable_expression(
+            expression):
+        _evaluate_aligned_expression_group([{
+            'expression': expression,
+            'symbol_to_path_band_map': args['symbol_to_path_band_map'],
+            'target_nodata': args['target_nodata'],
+            'target_raster_path': args['target_raster_path'],
+            'target_datatype': target_datatype,
+            'default_nan': default_nan,
+            'default_inf': default_inf,
+            'engine': engine,
+            'sparse': sparse,
+            }], _FUSED_LARGEST_BLOCK)
+    elif not expression.startswith('mask(raster'):
         symbolic.evaluate_raster_calculator_expression(
             expression, args['symbol_to_path_band_map'],
             args['target_nodata'], args['target_raster_path'],
@@ -313,6 +768,725 @@ def _evaluate_expression(
             args['target_raster_path'], invert)
 
 
+def _is_fusable_expression(expression):
+    """Return True if ``expression`` can be evaluated in a fused pass."""
+    if 'percentile(' in expression or expression.startswith('mask(raster'):
+        return False
+    try:
+        _compile_expression(expression)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+
+def _compile_expression(expression):
+    """Compile a plain arithmetic expression for blockwise evaluation.
+
+    Parameters:
+        expression (str): arithmetic expression of symbols and numbers using
+            python operators, comparisons, and the functions defined in
+            ``_EXPRESSION_FUNCTION_MAP``.
+
+    Returns:
+        tuple of (symbol_list, code) where ``symbol_list`` is the sorted list
+        of free symbols in the expression and ``code`` is a code object that
+        can be passed to ``eval`` with those symbols defined.
+
+    Raises:
+        ValueError if the expression uses anything other than arithmetic,
+        comparisons, and the allowed functions.
+
+    """
+    expression_tree = ast.parse(expression.strip(), mode='eval')
+    symbol_set = set()
+    for node in ast.walk(expression_tree):
+        if isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or
+                    node.func.id not in _EXPRESSION_FUNCTION_MAP or
+                    node.keywords):
+                raise ValueError(
+                    f'unsupported function call in "{expression}"')
+        elif isinstance(node, ast.Name):
+            if node.id not in _EXPRESSION_FUNCTION_MAP:
+                symbol_set.add(node.id)
+        elif isinstance(node, ast.Compare) and len(node.ops) > 1:
+            # python would reduce a chain with `and`, which fails on arrays
+            raise ValueError(
+                f'chained comparison in "{expression}" is not supported')
+        elif not isinstance(node, (
+                ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare,
+                ast.Constant, ast.Load, ast.operator, ast.unaryop,
+                ast.cmpop)):
+            raise ValueError(
+                f'unsupported syntax {type(node).__name__} in '
+                f'"{expression}"')
+    return sorted(symbol_set), compile(expression_tree, '<expression>', 'eval')
+
+
+def _evaluate_expression_batch(
+        processed_raster_list_file_path_list, symbol_to_path_band_map_list,
+        args_list, largest_block=_FUSED_LARGEST_BLOCK):
+    """Evaluate many expressions, one block pass per aligned grid.
+
+    Parameters:
+        processed_raster_list_file_path_list (list): list of paths to the
+            pickle files written by ``_preprocess_rasters``, one per
+            expression in ``args_list``.
+        symbol_to_path_band_map_list (list): list of the unprocessed symbol
+            to (path, band) maps, one per expression in ``args_list``.
+        args_list (list): list of expression dictionaries as defined in
+            ``evaluate_calculation``.
+        largest_block (int): largest number of pixels to read per input
+            raster per block.
+
+    Returns:
+        None.
+
+    """
+    grid_to_calculation_list = collections.defaultdict(list)
+    for processed_raster_list_file_path, symbol_to_path_band_map, args in zip(
+            processed_raster_list_file_path_list,
+            symbol_to_path_band_map_list, args_list):
+        with open(processed_raster_list_file_path, 'rb') as (
+                processed_raster_list_file):
+            processed_raster_path_list = pickle.load(
+                processed_raster_list_file)
+        processed_symbol_to_path_band_map = {
+            symbol: (raster_path, symbol_to_path_band_map[symbol][1])
+            for symbol, raster_path in zip(
+                symbol_to_path_band_map, processed_raster_path_list)}
+        raster_info = geoprocessing.get_raster_info(
+            processed_raster_path_list[0])
+        grid_key = (
+            tuple(raster_info['geotransform']),
+            tuple(raster_info['raster_size']),
+            raster_info['projection_wkt'])
+        grid_to_calculation_list[grid_key].append({
+            'expression': args['expression'],
+            'symbol_to_path_band_map': processed_symbol_to_path_band_map,
+            'target_nodata': args['target_nodata'],
+            'target_raster_path': args['target_raster_path'],
+            'target_datatype': args.get('target_datatype', None),
+            'default_nan': args.get('default_nan', None),
+            'default_inf': args.get('default_inf', None),
+            'engine': args.get('engine', None),
+            'sparse': args.get('sparse', False),
+            })
+
+    for calculation_list in grid_to_calculation_list.values():
+        LOGGER.info(
+            'fused pass over %d expressions: %s', len(calculation_list),
+            ', '.join([
+                os.path.basename(calculation['target_raster_path'])
+                for calculation in calculation_list]))
+        _evaluate_aligned_expression_group(calculation_list, largest_block)
+
+
+def _evaluate_aligned_expression_group(calculation_list, largest_block):
+    """Evaluate expressions over rasters that share one aligned grid.
+
+    Each distinct input (path, band) is read once per block and its nodata
+    mask is computed once per block; every expression is then evaluated
+    against that in-memory block and written to its own target raster.
+    Sparse expressions skip blocks that have no valid pixel, inputs that
+    only sparse expressions skip in a block are not read at all.
+
+    Parameters:
+        calculation_list (list): list of dictionaries with the keys
+            'expression', 'symbol_to_path_band_map', 'target_nodata',
+            'target_raster_path', 'target_datatype', 'default_nan', and
+            'default_inf', and optionally 'engine' and 'sparse'. All rasters
+            referenced by the symbol maps must share the same grid.
+            Targets without a 'target_datatype' take the numpy result type
+            of their inputs.
+        largest_block (int): largest number of pixels to read per input
+            raster per block.
+
+    Returns:
+        None.
+
+    Raises:
+        ValueError if a 'target_nodata' is None but an input of its
+        expression has nodata.
+
+    """
+    path_band_list = sorted(set([
+        path_band
+        for calculation in calculation_list
+        for path_band in calculation['symbol_to_path_band_map'].values()]))
+    reference_raster_path = path_band_list[0][0]
+
+    raster_map = {}
+    band_map = {}
+    nodata_map = {}
+    numpy_type_map = {}
+    for path_band in path_band_list:
+        if path_band[0] not in raster_map:
+            raster_map[path_band[0]] = gdal.OpenEx(
+                path_band[0], gdal.OF_RASTER)
+        band_map[path_band] = raster_map[path_band[0]].GetRasterBand(
+            path_band[1])
+        raster_info = geoprocessing.get_raster_info(path_band[0])
+        nodata_map[path_band] = raster_info['nodata'][path_band[1]-1]
+        numpy_type_map[path_band] = raster_info['numpy_type']
+
+    target_list = []
+    for calculation in calculation_list:
+        symbol_list, code = _compile_expression(calculation['expression'])
+        missing_symbol_list = [
+            symbol for symbol in symbol_list
+            if symbol not in calculation['symbol_to_path_band_map']]
+        if missing_symbol_list:
+            raise ValueError(
+                f'symbols {missing_symbol_list} in '
+                f'"{calculation["expression"]}" have no raster defined')
+        nodata_path_band_list = [
+            calculation['symbol_to_path_band_map'][symbol]
+            for symbol in symbol_list
+            if nodata_map[calculation['symbol_to_path_band_map'][
+                symbol]] is not None]
+        if calculation['target_nodata'] is None and nodata_path_band_list:
+            raise ValueError(
+                f'`target_nodata` is undefined (None) for '
+                f'"{calculation["expression"]}" but its inputs '
+                f'{nodata_path_band_list} have nodata values')
+        if calculation['target_datatype'] is not None:
+            target_numpy_type = _GDAL_TO_NUMPY_TYPE[
+                calculation['target_datatype']]
+        else:
+            # the same rule as symbolic.evaluate_raster_calculator_expression
+            # so either engine writes the same type
+            target_numpy_type = numpy.result_type(*[
+                numpy_type_map[calculation['symbol_to_path_band_map'][
+                    symbol]] for symbol in symbol_list] or [numpy.float32])
+        if target_numpy_type not in _NUMPY_TO_GDAL_TYPE:
+            target_numpy_type = numpy.dtype(numpy.float64)
+        sparse = calculation.get('sparse', False)
+        if sparse and calculation['target_nodata'] is None:
+            LOGGER.warning(
+                'unwritten blocks of %s would read as 0 since it has no '
+                'nodata, evaluating every block',
+                calculation['target_raster_path'])
+            sparse = False
+        geoprocessing.new_raster_from_base(
+            reference_raster_path, calculation['target_raster_path'],
+            _NUMPY_TO_GDAL_TYPE[target_numpy_type],
+            [calculation['target_nodata']],
+            raster_driver_creation_tuple=(
+                _SPARSE_GTIFF_CREATION_TUPLE_OPTIONS if sparse else
+                geoprocessing.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS))
+        target_raster = gdal.OpenEx(
+            calculation['target_raster_path'], gdal.OF_RASTER | gdal.OF_UPDATE)
+        expression_plan = None
+        if calculation.get('engine', None) == 'compiled':
+            try:
+                expression_plan = _build_expression_plan(
+                    calculation['expression'])
+            except ValueError:
+                LOGGER.exception(
+                    'could not compile "%s", evaluating it uncompiled',
+                    calculation['expression'])
+        target_list.append({
+            'symbol_list': symbol_list,
+            'code': code,
+            'plan': expression_plan,
+            'numpy_type': target_numpy_type,
+            'raster': target_raster,
+            'band': target_raster.GetRasterBand(1),
+            'stats': [numpy.inf, -numpy.inf, 0.0, 0.0, 0],
+            'sparse': sparse,
+            'path_band_set': set(
+                calculation['symbol_to_path_band_map'][symbol]
+                for symbol in symbol_list),
+            'n_skipped': 0,
+            })
+
+    n_blocks = 0
+    for offset_dict in geoprocessing.iterblocks(
+            (reference_raster_path, 1), offset_only=True,
+            largest_block=largest_block):
+        n_blocks += 1
+        # a sparse target is skipped if any of its inputs is entirely
+        # nodata here, checked from the GeoTIFF's block allocation first
+        empty_path_band_set = set()
+        if any(target['sparse'] for target in target_list):
+            empty_path_band_set = set(
+                path_band for path_band in path_band_list
+                if _is_empty_window(
+                    band_map[path_band], nodata_map[path_band],
+                    offset_dict))
+        active_list = []
+        for calculation, target in zip(calculation_list, target_list):
+            if target['sparse'] and (
+                    target['path_band_set'] & empty_path_band_set):
+                target['n_skipped'] += 1
+            else:
+                active_list.append((calculation, target))
+        if not active_list:
+            continue
+
+        array_map = {}
+        valid_mask_map = {}
+        for path_band in set().union(*[
+                target['path_band_set'] for _, target in active_list]):
+            array_map[path_band] = band_map[path_band].ReadAsArray(
+                **offset_dict)
+
+        for calculation, target in active_list:
+            symbol_to_path_band_map = calculation['symbol_to_path_band_map']
+            if target['plan'] is not None:
+                if target['sparse'] and not _any_valid_pixel([
+                        (array_map[path_band], nodata_map[path_band])
+                        for path_band in target['path_band_set']]):
+                    target['n_skipped'] += 1
+                    continue
+                # the compiled plan folds nodata masking into its kernel
+                result = _evaluate_expression_plan(
+                    target['plan'], {
+                        symbol: array_map[symbol_to_path_band_map[symbol]]
+                        for symbol in target['symbol_list']},
+                    {symbol: nodata_map[symbol_to_path_band_map[symbol]]
+                     for symbol in target['symbol_list']},
+                    calculation['target_nodata'], target['numpy_type'],
+                    calculation['default_nan'], calculation['default_inf'])
+                target['band'].WriteArray(
+                    result, xoff=offset_dict['xoff'],
+                    yoff=offset_dict['yoff'])
+                _update_running_stats(
+                    target['stats'], result, calculation['target_nodata'])
+                continue
+
+            for symbol in target['symbol_list']:
+                path_band = symbol_to_path_band_map[symbol]
+                if path_band in valid_mask_map:
+                    continue
+                if nodata_map[path_band] is not None:
+                    valid_mask_map[path_band] = ~numpy.isclose(
+                        array_map[path_band], nodata_map[path_band])
+                else:
+                    valid_mask_map[path_band] = None
+            if target['sparse']:
+                valid_mask = None
+                for path_band in target['path_band_set']:
+                    if valid_mask_map[path_band] is not None:
+                        valid_mask = (
+                            valid_mask_map[path_band] if valid_mask is None
+                            else valid_mask & valid_mask_map[path_band])
+                if valid_mask is not None and not numpy.any(valid_mask):
+                    target['n_skipped'] += 1
+                    continue
+            result = _evaluate_masked_block(
+                target['code'], calculation['expression'], {
+                    symbol: array_map[symbol_to_path_band_map[symbol]]
+                    for symbol in target['symbol_list']},
+                [valid_mask_map[symbol_to_path_band_map[symbol]]
+                 for symbol in target['symbol_list']],
+                (offset_dict['win_ysize'], offset_dict['win_xsize']),
+                calculation['target_nodata'], target['numpy_type'],
+                calculation['default_nan'], calculation['default_inf'])
+            target['band'].WriteArray(
+                result, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+            _update_running_stats(
+                target['stats'], result, calculation['target_nodata'])
+
+    for calculation, target in zip(calculation_list, target_list):
+        if target['sparse']:
+            LOGGER.info(
+                'skipped %d of %d blocks of %s that had no valid pixels',
+                target['n_skipped'], n_blocks,
+                calculation['target_raster_path'])
+        raster_min, raster_max, running_sum, running_sum_sq, count = (
+            target['stats'])
+        if count > 0:
+            mean = running_sum / count
+            stdev = numpy.sqrt(max(running_sum_sq / count - mean**2, 0.0))
+            target['band'].SetStatistics(
+                float(raster_min), float(raster_max), mean, stdev)
+        target['band'].FlushCache()
+        target['band'] = None
+        target['raster'] = None
+    band_map = None
+    raster_map = None
+
+
+def _is_empty_window(band, nodata, offset_dict):
+    """Return True if a window of ``band`` is unallocated and so nodata.
+
+    Unallocated blocks of a sparse GeoTIFF read as nodata only if the band
+    has a nodata value, otherwise they read as 0 and are valid.
+
+    """
+    if nodata is None:
+        return False
+    try:
+        coverage_status, _ = band.GetDataCoverageStatus(
+            offset_dict['xoff'], offset_dict['yoff'],
+            offset_dict['win_xsize'], offset_dict['win_ysize'])
+    except (AttributeError, RuntimeError):
+        # drivers or GDAL versions without coverage information
+        return False
+    return coverage_status == gdal.GDAL_DATA_COVERAGE_STATUS_EMPTY
+
+
+def _any_valid_pixel(array_nodata_list):
+    """Return True if some pixel is valid in every (array, nodata) pair.
+
+    Validity matches the compiled plan's mask, a pixel is nodata only if it
+    equals its nodata exactly or both are NaN.
+
+    """
+    valid_mask = None
+    for array, nodata in array_nodata_list:
+        if nodata is None:
+            continue
+        if numpy.isnan(nodata):
+            input_valid_mask = ~numpy.isnan(array)
+        else:
+            input_valid_mask = array != nodata
+        if valid_mask is None:
+            valid_mask = input_valid_mask
+        else:
+            valid_mask &= input_valid_mask
+    return valid_mask is None or bool(numpy.any(valid_mask))
+
+
+def _evaluate_masked_block(
+        code, expression, symbol_to_array_map, valid_mask_list, shape,
+        target_nodata, target_numpy_type, default_nan, default_inf):
+    """Evaluate a compiled expression over one block of input arrays.
+
+    Parameters:
+        code (code): compiled expression from ``_compile_expression``.
+        expression (str): the original expression, used for error messages.
+        symbol_to_array_map (dict): maps each symbol to its block array.
+        valid_mask_list (list): list of boolean arrays that are True where
+            an input is valid, or None if that input has no nodata.
+        shape (tuple): shape of the block.
+        target_nodata (numeric): value to write where any input is nodata.
+        target_numpy_type (numpy.dtype): type of the result array.
+        default_nan (numeric): if not None, replaces NaN results.
+        default_inf (numeric): if not None, replaces infinite results.
+
+    Returns:
+        result array of ``shape`` and ``target_numpy_type``.
+
+    """
+    if target_nodata is None:
+        # only allowed if no input has nodata, so every pixel is written
+        result = numpy.empty(shape, dtype=target_numpy_type)
+    else:
+        result = numpy.full(shape, target_nodata, dtype=target_numpy_type)
+    valid_mask = numpy.ones(shape, dtype=bool)
+    for input_valid_mask in valid_mask_list:
+        if input_valid_mask is not None:
+            valid_mask &= input_valid_mask
+    if not numpy.any(valid_mask):
+        return result
+
+    local_map = {
+        symbol: array[valid_mask]
+        for symbol, array in symbol_to_array_map.items()}
+    with numpy.errstate(all='ignore'):
+        value_array = numpy.asarray(eval(
+            code, {'__builtins__': {}, **_EXPRESSION_FUNCTION_MAP},
+            local_map))
+    if numpy.issubdtype(value_array.dtype, numpy.floating):
+        nan_mask = numpy.isnan(value_array)
+        if numpy.any(nan_mask):
+            if default_nan is None:
+                raise ValueError(
+                    f'Encountered NaN in "{expression}" but `default_nan` '
+                    'is None.')
+            value_array[nan_mask] = default_nan
+        inf_mask = numpy.isinf(value_array)
+        if numpy.any(inf_mask):
+            if default_inf is None:
+                raise ValueError(
+                    f'Encountered inf in "{expression}" but `default_inf` '
+                    'is None.')
+            value_array[inf_mask] = default_inf
+    result[valid_mask] = value_array
+    return result
+
+
+def _build_expression_plan(expression):
+    """Compile ``expression`` into a constant folded, CSE'd kernel plan.
+
+    The expression is parsed once, subtrees made only of constants are
+    folded to a single constant, and every subexpression that occurs more
+    than once is hoisted into a temporary that is evaluated once per block.
+
+    Parameters:
+        expression (str): expression accepted by ``_compile_expression``.
+
+    Returns:
+        dict with the keys 'symbol_list' (sorted free symbols), 'step_list'
+        (ordered list of (temporary name, kernel source, code) tuples), and
+        'value' (tuple of kernel source and code for the final value).
+        Kernel sources only use syntax that numexpr and numpy both accept.
+
+    Raises:
+        ValueError if the expression uses an operator the plan can't emit.
+
+    """
+    symbol_list, _ = _compile_expression(expression)
+    expression_node = _fold_constants(
+        ast.parse(expression.strip(), mode='eval').body)
+    subexpression_count = collections.Counter([
+        ast.dump(node) for node in ast.walk(expression_node)
+        if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call))])
+
+    step_list = []
+    step_name_map = {}
+
+    def _hoist(source):
+        """Add ``source`` as a temporary step and return its name."""
+        step_name = '_step%d' % len(step_list)
+        step_list.append(
+            (step_name, source, compile(source, '<kernel>', 'eval')))
+        return step_name
+
+    def _emit(node):
+        """Return kernel source for ``node``, hoisting shared subtrees."""
+        if isinstance(node, ast.Constant):
+            return repr(node.value)
+        if isinstance(node, ast.Name):
+            return node.id
+        node_key = ast.dump(node)
+        if node_key in step_name_map:
+            return step_name_map[node_key]
+        if isinstance(node, ast.BinOp):
+            source = '(%s %s %s)' % (
+                _emit(node.left), _plan_operator(node.op, expression),
+                _emit(node.right))
+        elif isinstance(node, ast.UnaryOp):
+            source = '(%s%s)' % (
+                _plan_operator(node.op, expression), _emit(node.operand))
+        elif isinstance(node, ast.Compare):
+            source = '(%s %s %s)' % (
+                _emit(node.left), _plan_operator(node.ops[0], expression),
+                _emit(node.comparators[0]))
+        else:
+            argument_list = [_emit(argument) for argument in node.args]
+            if node.func.id in ('max', 'min'):
+                if len(argument_list) != 2:
+                    raise ValueError(
+                        f'{node.func.id} takes two arguments in '
+                        f'"{expression}"')
+                # both arguments appear twice in the kernel
+                argument_list = [
+                    argument if argument.isidentifier() else
+                    _hoist(argument) for argument in argument_list]
+                source = 'where(%s %s %s, %s, %s)' % (
+                    argument_list[0], '>' if node.func.id == 'max' else '<',
+                    argument_list[1], argument_list[0], argument_list[1])
+            else:
+                source = '%s(%s)' % (node.func.id, ', '.join(argument_list))
+        if subexpression_count[node_key] > 1:
+            source = _hoist(source)
+            step_name_map[node_key] = source
+        return source
+
+    value_source = _emit(expression_node)
+    return {
+        'symbol_list': symbol_list,
+        'step_list': step_list,
+        'value': (value_source, compile(value_source, '<kernel>', 'eval')),
+        }
+
+
+def _plan_operator(op, expression):
+    """Return kernel source for ``op`` or raise ValueError."""
+    if type(op) not in _PLAN_OPERATOR_MAP:
+        raise ValueError(
+            f'operator {type(op).__name__} in "{expression}" is not '
+            'supported by the compiled engine')
+    return _PLAN_OPERATOR_MAP[type(op)]
+
+
+def _fold_constants(node):
+    """Return ``node`` with every constant-only subtree evaluated."""
+    if isinstance(node, ast.BinOp):
+        node = ast.BinOp(
+            left=_fold_constants(node.left), op=node.op,
+            right=_fold_constants(node.right))
+        child_list = [node.left, node.right]
+    elif isinstance(node, ast.UnaryOp):
+        node = ast.UnaryOp(op=node.op, operand=_fold_constants(node.operand))
+        child_list = [node.operand]
+    elif isinstance(node, ast.Compare):
+        node = ast.Compare(
+            left=_fold_constants(node.left), ops=node.ops,
+            comparators=[
+                _fold_constants(comparator)
+                for comparator in node.comparators])
+        child_list = [node.left] + node.comparators
+    elif isinstance(node, ast.Call):
+        return ast.Call(
+            func=node.func, args=[
+                _fold_constants(argument) for argument in node.args],
+            keywords=[])
+    else:
+        return node
+
+    if not all([isinstance(child, ast.Constant) for child in child_list]):
+        return node
+    try:
+        value = eval(compile(
+            ast.fix_missing_locations(ast.Expression(body=node)),
+            '<constant>', 'eval'), {'__builtins__': {}})
+    except (ArithmeticError, TypeError, ValueError):
+        # leave it for the kernel to evaluate the same way numpy would
+        return node
+    if not numpy.isfinite(value):
+        return node
+    return ast.Constant(value=value)
+
+
+def _evaluate_expression_plan(
+        plan, symbol_to_array_map, symbol_to_nodata_map, target_nodata,
+        target_numpy_type, default_nan, default_inf):
+    """Evaluate a compiled expression plan over one block.
+
+    The expression is evaluated over the whole block in one kernel per
+    plan step and the valid mask of every input is built by a single
+    kernel, rather than gathering the valid pixels of each input first.
+
+    Parameters:
+        plan (dict): plan from ``_build_expression_plan``.
+        symbol_to_array_map (dict): maps each symbol to its block array.
+        symbol_to_nodata_map (dict): maps each symbol to its nodata value or
+            None if it has no nodata.
+        target_nodata (numeric): value to write where any input is nodata.
+        target_numpy_type (numpy.dtype): type of the result array.
+        default_nan (numeric): if not None, replaces NaN results.
+        default_inf (numeric): if not None, replaces infinite results.
+
+    Returns:
+        result array of the block's shape and ``target_numpy_type``.
+
+    """
+    local_map = dict(symbol_to_array_map)
+    valid_term_list = []
+    for symbol, nodata in symbol_to_nodata_map.items():
+        if nodata is None:
+            continue
+        if numpy.isnan(nodata):
+            valid_term_list.append('(%s == %s)' % (symbol, symbol))
+        else:
+            local_map['_nodata_%s' % symbol] = nodata
+            valid_term_list.append('(%s != _nodata_%s)' % (symbol, symbol))
+    valid_source = None
+    valid_code = None
+    if valid_term_list:
+        valid_source = ' & '.join(valid_term_list)
+        valid_code = compile(valid_source, '<kernel>', 'eval')
+
+    shape = next(iter(symbol_to_array_map.values())).shape
+    result = numpy.empty(shape, dtype=target_numpy_type)
+    if numexpr is not None or shape[0] < _COMPILED_ENGINE_N_THREADS:
+        # numexpr already splits each kernel across its own thread pool
+        _evaluate_plan_strip(
+            plan, local_map, (valid_source, valid_code), result,
+            target_nodata, default_nan, default_inf)
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(
+            _COMPILED_ENGINE_N_THREADS) as executor:
+        future_list = []
+        for row_index_array in numpy.array_split(
+                numpy.arange(shape[0]), _COMPILED_ENGINE_N_THREADS):
+            row_slice = slice(row_index_array[0], row_index_array[-1]+1)
+            future_list.append(executor.submit(
+                _evaluate_plan_strip, plan, {
+                    name: (
+                        value[row_slice] if isinstance(value, numpy.ndarray)
+                        else value)
+                    for name, value in local_map.items()},
+                (valid_source, valid_code), result[row_slice],
+                target_nodata, default_nan, default_inf))
+        for future in future_list:
+            future.result()
+    return result
+
+
+def _evaluate_plan_strip(
+        plan, local_map, valid_kernel, result, target_nodata, default_nan,
+        default_inf):
+    """Evaluate ``plan`` into ``result`` for one strip of a block.
+
+    Parameters:
+        plan (dict): plan from ``_build_expression_plan``.
+        local_map (dict): maps symbol and nodata names to the strip's arrays
+            and nodata values, temporaries are added to it.
+        valid_kernel (tuple): (source, code) of the valid mask kernel, both
+            None if no input has nodata.
+        result (numpy.ndarray): array to write the strip's result to.
+        target_nodata (numeric): value to write where any input is nodata.
+        default_nan (numeric): if not None, replaces NaN results.
+        default_inf (numeric): if not None, replaces infinite results.
+
+    Returns:
+        None.
+
+    """
+    local_map = dict(local_map)
+    with numpy.errstate(all='ignore'):
+        for step_name, step_source, step_code in plan['step_list']:
+            local_map[step_name] = _evaluate_kernel(
+                step_source, step_code, local_map)
+        value_array = numpy.broadcast_to(_evaluate_kernel(
+            plan['value'][0], plan['value'][1], local_map), result.shape)
+
+    if valid_kernel[0] is not None:
+        valid_mask = _evaluate_kernel(
+            valid_kernel[0], valid_kernel[1], local_map)
+        result[:] = target_nodata
+        numpy.copyto(result, value_array, where=valid_mask, casting='unsafe')
+    else:
+        valid_mask = None
+        numpy.copyto(result, value_array, casting='unsafe')
+
+    if not numpy.issubdtype(value_array.dtype, numpy.floating):
+        return
+    for invalid_function, default_value, label in [
+            (numpy.isnan, default_nan, 'NaN'),
+            (numpy.isinf, default_inf, 'inf')]:
+        invalid_mask = invalid_function(value_array)
+        if valid_mask is not None:
+            invalid_mask &= valid_mask
+        if not numpy.any(invalid_mask):
+            continue
+        if default_value is None:
+            raise ValueError(
+                f'Encountered {label} in calculation but `default_'
+                f'{label.lower()}` is None.')
+        result[invalid_mask] = default_value
+
+
+def _evaluate_kernel(source, code, local_map):
+    """Evaluate one kernel with numexpr if installed, numpy otherwise."""
+    if numexpr is not None:
+        return numexpr.evaluate(source, local_dict=local_map)
+    return eval(code, {'__builtins__': {}, **_PLAN_FUNCTION_MAP}, local_map)
+
+
+def _update_running_stats(stats, array, nodata):
+    """Accumulate [min, max, sum, sum of squares, count] of valid values."""
+    if nodata is not None:
+        valid_array = array[~numpy.isclose(array, nodata)]
+    else:
+        valid_array = array.ravel()
+    if valid_array.size == 0:
+        return
+    stats[0] = min(stats[0], numpy.min(valid_array))
+    stats[1] = max(stats[1], numpy.max(valid_array))
+    valid_array = valid_array.astype(numpy.float64)
+    stats[2] += numpy.sum(valid_array)
+    stats[3] += numpy.sum(valid_array**2)
+    stats[4] += valid_array.size
+
+
 def mask_raster_by_array(
         raster_path_band, mask_array, target_raster_path, invert=False):
     """Mask the given raster path/band by a set of integers.
@@ -413,7 +1587,8 @@ def _preprocess_rasters(
         base_raster_path_list, churn_dir,
         target_processed_raster_list_file_path, target_projection_wkt=None,
         target_pixel_size=None, resample_method='near',
-        bounding_box_mode='intersection'):
+        bounding_box_mode='intersection', warp_cache_dir=None,
+        warp_cache_max_bytes=_WARP_CACHE_MAX_BYTES):
     """Process base raster path list so it can be used in raster calcs.
 
     Parameters:
@@ -442,6 +1617,12 @@ def _preprocess_rasters(
             target projection coordinate system.  Depending
             on the value, output extents are defined as the union,
             intersection, or the explicit bounding box.
+        warp_cache_dir (str): if not None, a directory shared between
+            expressions where aligned rasters are cached by input identity
+            and warp parameters so identical warps are only done once.
+        warp_cache_max_bytes (int): disk budget of ``warp_cache_dir``, least
+            recently used warps and the links to them are removed when it
+            is exceeded.
 
     Return:
         ``None``
@@ -512,7 +1693,13 @@ def _preprocess_rasters(
         operand_raster_path_list = [
             os.path.join(churn_dir, os.path.basename(path)) for path in
             base_raster_path_list]
-        if not same_pixel_sizes or not same_raster_sizes:
+        if (not same_pixel_sizes or not same_raster_sizes) and (
+                warp_cache_dir is not None):
+            _align_with_warp_cache(
+                base_raster_path_list, operand_raster_path_list,
+                resample_method, target_pixel_size, bounding_box_mode,
+                target_projection_wkt, warp_cache_dir, warp_cache_max_bytes)
+        elif not same_pixel_sizes or not same_raster_sizes:
             geoprocessing.align_and_resize_raster_stack(
                 base_raster_path_list, operand_raster_path_list,
                 [resample_method]*len(base_raster_path_list),
@@ -533,31 +1720,206 @@ def _preprocess_rasters(
         pickle.dump(result, result_file)
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000)
+def _align_with_warp_cache(
+        base_raster_path_list, target_raster_path_list, resample_method,
+        target_pixel_size, bounding_box_mode, target_projection_wkt,
+        warp_cache_dir, warp_cache_max_bytes):
+    """Align a raster stack, reusing identical warps from a shared cache.
+
+    This produces the same stack as
+    ``geoprocessing.align_and_resize_raster_stack`` but warps each raster
+    individually into ``warp_cache_dir`` under a key made from the input
+    raster's identity and the warp parameters. A warp that is already in
+    the cache is hard linked to its target rather than recomputed, so the
+    same input warped to the same grid is done once per workspace no matter
+    how many expressions or runs request it.
+
+    Parameters:
+        base_raster_path_list (list): list of rasters to align.
+        target_raster_path_list (list): list of paths to write the aligned
+            rasters to, parallel to ``base_raster_path_list``.
+        resample_method (str): GDAL resample method used for every raster.
+        target_pixel_size (tuple): target (x, y) pixel size.
+        bounding_box_mode (str/list): "union", "intersection", or an
+            explicit [minx, miny, maxx, maxy] in the target projection.
+        target_projection_wkt (str): target projection, if None the
+            projection of the first raster is used.
+        warp_cache_dir (str): directory that holds the cached warps.
+        warp_cache_max_bytes (int): after warping, least recently used
+            cache entries are removed until the cache and any targets that
+            had to be copied because the filesystem can't link are below
+            this size. Targets are expected to be in one churn directory
+            per expression under a common parent, links to an evicted
+            entry in those directories are removed too.
+
+    Returns:
+        None.
+
+    """
+    os.makedirs(warp_cache_dir, exist_ok=True)
+    base_info_list = [
+        geoprocessing.get_raster_info(path)
+        for path in base_raster_path_list]
+    if target_projection_wkt is None:
+        target_projection_wkt = base_info_list[0]['projection_wkt']
+
+    if bounding_box_mode in ('union', 'intersection'):
+        bounding_box_list = []
+        for raster_info in base_info_list:
+            if raster_info['projection_wkt'] != target_projection_wkt:
+                bounding_box_list.append(
+                    geoprocessing.transform_bounding_box(
+                        raster_info['bounding_box'],
+                        raster_info['projection_wkt'],
+                        target_projection_wkt))
+            else:
+                bounding_box_list.append(raster_info['bounding_box'])
+        target_bounding_box = geoprocessing.merge_bounding_box_list(
+            bounding_box_list, bounding_box_mode)
+    else:
+        target_bounding_box = list(bounding_box_mode)
+
+    used_cache_path_set = set()
+    copied_bytes = 0
+    for base_raster_path, target_raster_path in zip(
+            base_raster_path_list, target_raster_path_list):
+        warp_key = '%s|%s|%s|%s|%s' % (
+            _raster_fingerprint(base_raster_path), target_projection_wkt,
+            [float(val) for val in target_pixel_size], resample_method,
+            [float(val) for val in target_bounding_box])
+        cache_raster_path = os.path.join(
+            warp_cache_dir, '%s_%s.tif' % (
+                os.path.splitext(os.path.basename(base_raster_path))[0],
+                hashlib.md5(warp_key.encode('utf-8')).hexdigest()))
+        used_cache_path_set.add(cache_raster_path)
+        if os.path.exists(cache_raster_path):
+            LOGGER.info(
+                'reusing cached warp of %s: %s', base_raster_path,
+                cache_raster_path)
+            # refresh the access time so this entry is evicted last
+            os.utime(cache_raster_path)
+        else:
+            # warp to a unique path and move into place so concurrent
+            # expressions asking for the same warp never see a partial file
+            working_raster_path = '%s.%d.tmp' % (
+                cache_raster_path, os.getpid())
+            geoprocessing.warp_raster(
+                base_raster_path, target_pixel_size, working_raster_path,
+                resample_method, target_bb=target_bounding_box,
+                target_projection_wkt=target_projection_wkt)
+            os.replace(working_raster_path, cache_raster_path)
+
+        if os.path.exists(target_raster_path):
+            os.remove(target_raster_path)
+        try:
+            os.link(cache_raster_path, target_raster_path)
+        except OSError:
+            shutil.copyfile(cache_raster_path, target_raster_path)
+            copied_bytes += os.path.getsize(target_raster_path)
+
+    _evict_warp_cache(
+        warp_cache_dir, warp_cache_max_bytes, used_cache_path_set,
+        os.path.dirname(os.path.dirname(target_raster_path_list[0])),
+        extra_bytes=copied_bytes)
+
+
+def _raster_fingerprint(raster_path):
+    """Return a string that changes when ``raster_path``'s content does.
+
+    Ecoshards carry the md5 of their content in the filename, that is used
+    when present so renamed or copied ecoshards share cache entries.
+    Otherwise the normalized path, file size, and modification time are used.
+
+    """
+    md5_match = re.search(r'_md5_([0-9a-f]{32})', raster_path)
+    if md5_match:
+        return 'md5_%s' % md5_match.group(1)
+    raster_stat = os.stat(raster_path)
+    return '%s_%d_%d' % (
+        os.path.normcase(os.path.abspath(raster_path)), raster_stat.st_size,
+        raster_stat.st_mtime_ns)
+
+
+def _evict_warp_cache(
+        warp_cache_dir, max_bytes, keep_path_set, churn_root_dir,
+        extra_bytes=0):
+    """Remove least recently used warps until the cache fits ``max_bytes``.
+
+    Aligned targets are hard links to their cache entries, so removing an
+    entry alone frees no disk. The links to an evicted entry in the churn
+    directories under ``churn_root_dir`` are removed with it, along with
+    the processed raster list pickle in those directories so the task that
+    wrote it realigns its inputs if the expression is evaluated again.
+
+    Parameters:
+        warp_cache_dir (str): directory holding cached warps.
+        max_bytes (int): size budget of the cache in bytes.
+        keep_path_set (set): cached raster paths that must not be removed.
+        churn_root_dir (str): directory whose subdirectories may hold hard
+            links to cache entries.
+        extra_bytes (int): bytes of copies of cache entries made outside of
+            the cache that count against ``max_bytes``.
+
+    Returns:
+        None.
+
+    """
+    cache_entry_list = []
+    total_bytes = extra_bytes
+    for cache_raster_path in glob.glob(
+            os.path.join(warp_cache_dir, '*.tif')):
+        try:
+            raster_stat = os.stat(cache_raster_path)
+        except FileNotFoundError:
+            # another process evicted it first
+            continue
+        cache_entry_list.append((
+            raster_stat.st_mtime, raster_stat.st_size, cache_raster_path,
+            (raster_stat.st_dev, raster_stat.st_ino)))
+        total_bytes += raster_stat.st_size
+    if total_bytes <= max_bytes:
+        return
+
+    # find the links to cache entries only once eviction is needed
+    inode_to_link_path_list = collections.defaultdict(list)
+    for link_path in glob.glob(os.path.join(churn_root_dir, '*', '*')):
+        try:
+            link_stat = os.stat(link_path)
+        except FileNotFoundError:
+            continue
+        if link_stat.st_nlink > 1:
+            inode_to_link_path_list[
+                (link_stat.st_dev, link_stat.st_ino)].append(link_path)
+
+    for _, entry_bytes, cache_raster_path, inode in sorted(
+            cache_entry_list):
+        if total_bytes <= max_bytes:
+            break
+        if cache_raster_path in keep_path_set:
+            continue
+        LOGGER.info('evicting %s from warp cache', cache_raster_path)
+        remove_path_list = [
+            cache_raster_path, '%s.aux.xml' % cache_raster_path]
+        for link_path in inode_to_link_path_list[inode]:
+            remove_path_list.extend([
+                link_path, '%s.aux.xml' % link_path, os.path.join(
+                    os.path.dirname(link_path),
+                    _PROCESSED_RASTER_LIST_FILENAME)])
+        for path in remove_path_list:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total_bytes -= entry_bytes
+
+
 def download_url(url, target_path, skip_if_target_exists=False):
-    """Download `url` to `target_path`."""
-    try:
-        if skip_if_target_exists and os.path.exists(target_path):
-            return
-        with open(target_path, 'wb') as target_file:
-            with urllib.request.urlopen(url) as url_stream:
-                meta = url_stream.info()
-                file_size = int(meta["Content-Length"])
-                LOGGER.info(
-                    "Downloading: %s Bytes: %s" % (target_path, file_size))
-
-                downloaded_so_far = 0
-                block_size = 2**20
-                while True:
-                    data_buffer = url_stream.read(block_size)
-                    if not data_buffer:
-                        break
-                    downloaded_so_far += len(data_buffer)
-                    target_file.write(data_buffer)
-                    status = r"%10d  [%3.2f%%]" % (
-                        downloaded_so_far, downloaded_so_far * 100. /
-                        file_size)
-                    LOGGER.info(status)
-    except:
-        LOGGER.exception("Exception encountered, trying again.")
-        raise
+    """Download `url` to `target_path`.
+
+    Downloads resume after failures, large files are fetched in parallel
+    segments, and ecoshard names are checked against the downloaded md5,
+    see ``ecoshard_download.download_url``.
+
+    """
+    ecoshard_download.download_url(
+        url, target_path, skip_if_target_exists=skip_if_target_exists)
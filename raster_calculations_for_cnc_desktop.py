@@ -179,9 +179,9 @@ def main():
         },
     ]
 
-    for calculation in calculation_list:
-        raster_calculations_core.evaluate_calculation(
-            calculation, TASK_GRAPH, WORKSPACE_DIR)
+    # expressions that read other targets wait for them, no join needed
+    raster_calculations_core.evaluate_calculation_list(
+        calculation_list, TASK_GRAPH, WORKSPACE_DIR)
 
     TASK_GRAPH.join()
     TASK_GRAPH.close()
@@ -1,24 +1,29 @@
 """Entry point for raster stats."""
 import glob
-import time
-import itertools
+import multiprocessing
 import os
+import shutil
 import tempfile
-import struct
 import argparse
 import sys
 import logging
-import heapq
-import math
 
 import pygeoprocessing
 import numpy
-from osgeo import gdal
 
 LOGGER = logging.getLogger(__name__)
 
 _BLOCK_SIZE = 2**20
-_LARGEST_STRUCT_PACK = 1024
+
+# valid pixels are sorted in memory in runs of at most this many values
+_RUN_SIZE = 2**26
+
+# selection stops narrowing the runs once this few candidates are left and
+# partitions them in memory
+_SELECT_IN_MEMORY_SIZE = 2**20
+
+# default number of bins of the histogram that approximates percentiles
+_N_HISTOGRAM_BINS = 2**16
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -30,229 +35,430 @@ LOGGER = logging.getLogger(__name__)
 
 
 def calculate_raster_stats(
-        glob_pattern_list, output_csv_path, percentiles=None):
+        glob_pattern_list, output_csv_path, percentiles=None,
+        n_workers=multiprocessing.cpu_count(),
+        n_histogram_bins=_N_HISTOGRAM_BINS, exact_percentiles=False):
     """Calculate raster stats.
 
+    Every raster is read once to calculate its min, max, mean, stdev, valid
+    pixel count, and a histogram that approximates its percentiles. If
+    ``exact_percentiles`` is set, a second pass reads only the pixels in the
+    histogram bins that hold the requested percentiles to find their exact
+    values. Rasters are processed in parallel and a row is written to the
+    CSV as each one finishes, so rows are in completion order.
+
     Parameters:
         glob_pattern_list (list): path to list of raster paths or glob
             patterns.
-        percentile (list): list of desired percentiles.
+        output_csv_path (str): path to the CSV table to write.
+        percentiles (list): list of desired percentiles.
+        n_workers (int): number of rasters to process in parallel.
+        n_histogram_bins (int): number of histogram bins used to
+            approximate percentiles.
+        exact_percentiles (bool): if True, refine the approximate
+            percentiles to the exact pixel values.
 
     Returns:
-        dict of raster stats
-            -max, min, mean, user defined percentiles, mode, stdev, percent
-             nodata.
-            -if int, table & count of values.
+        None.
 
     """
-    info_callback = _make_logger_callback(
-        "Warp %.1f%% complete %s")
-    output_csv_file = open(output_csv_path, 'w')
-    output_csv_file.write('raster path,min,max,mean,stdev,%s\n' % ','.join([
-        str(x)+'th percentile' for x in sorted(percentiles)]))
-    for raster_path in [
-            path for glob_pattern in glob_pattern_list
-            for path in glob.glob(glob_pattern)]:
-        LOGGER.info('processing %s', raster_path)
-        raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
-        band = raster.GetRasterBand(1)
-        band.ComputeStatistics(0, info_callback, None)
-        min_val, max_val, mean, stdev = band.GetStatistics(0, 0)
-        info_string = '\nRaster stats:\n*************\n'
-        info_string += '  min: %s\n' % min_val
-        info_string += '  max: %s\n' % max_val
-        info_string += ' mean: %s\n' % mean
-        info_string += 'stdev: %s\n' % stdev
-        output_csv_file.write('%s,%s,%s,%s,%s' % (
-            raster_path, min_val, max_val, mean, stdev))
-        LOGGER.info("intermediate result for %s:\n%s", raster_path, info_string)
-        if percentiles:
-            total_valid = 0
-            nodata = band.GetNoDataValue()
-            datatype = band.DataType
-            if datatype in (gdal.GDT_Byte, gdal.GDT_Int16, gdal.GDT_Int32):
-                datatype_id = 'i'
-            elif datatype in (gdal.GDT_Float32,):
-                datatype_id = 'f'
-            else:
-                raise ValueError("can't process stats for this raster type")
-
-            band = None
-            raster = None
-            LOGGER.debug("calculating number of non-nodata pixels")
-            for _, data_block in pygeoprocessing.iterblocks((raster_path, 1)):
-                total_valid += numpy.count_nonzero(
-                    ~numpy.isclose(data_block, nodata))
-            sorted_raster_iterator = _sort_to_disk(raster_path, datatype_id)
-            current_offset = 0
-            LOGGER.info("calculating percentiles")
-            for percentile in sorted(percentiles):
-                LOGGER.info("calculating percentile %d", percentile)
-                skip_size = int(
-                    (int(percentile)/100.0*total_valid) - current_offset)
-                current_offset += skip_size+1
-                if current_offset >= total_valid:
-                    skip_size -= current_offset-total_valid+2
-                percentile_value = next(itertools.islice(
-                    sorted_raster_iterator, skip_size, skip_size+1))
-                info_string += '%3dth percentile: %s\n' % (
-                    percentile, percentile_value)
-                output_csv_file.write(',%s' % percentile_value)
-        output_csv_file.write('\n')
-        output_csv_file.flush()
-    output_csv_file.close()
-    LOGGER.info(info_string)
-
-
-def _sort_to_disk(dataset_path, datatype_id):
-    """Return an iterable of non-nodata pixels in sorted order.
+    percentile_list = sorted(percentiles) if percentiles else []
+    raster_path_list = [
+        path for glob_pattern in glob_pattern_list
+        for path in glob.glob(glob_pattern)]
+    if not raster_path_list:
+        LOGGER.warning('no rasters match %s', glob_pattern_list)
+        return
+
+    with open(output_csv_path, 'w') as output_csv_file:
+        output_csv_file.write(
+            'raster path,min,max,mean,stdev,valid count%s\n' % ''.join([
+                ',%sth percentile' % x for x in percentile_list]))
+        with multiprocessing.Pool(
+                max(1, min(n_workers, len(raster_path_list)))) as pool:
+            for raster_path, stats in pool.imap_unordered(
+                    _raster_stats_worker, [
+                        (raster_path, percentile_list, n_histogram_bins,
+                         exact_percentiles)
+                        for raster_path in raster_path_list]):
+                info_string = '\nRaster stats:\n*************\n'
+                for stat_id in ['min', 'max', 'mean', 'stdev', 'count']:
+                    info_string += '%5s: %s\n' % (stat_id, stats[stat_id])
+                for percentile, percentile_value in zip(
+                        percentile_list, stats['percentile_list']):
+                    info_string += '%3dth percentile: %s\n' % (
+                        percentile, percentile_value)
+                LOGGER.info("result for %s:%s", raster_path, info_string)
+                output_csv_file.write('%s,%s,%s,%s,%s,%s' % (
+                    raster_path, stats['min'], stats['max'], stats['mean'],
+                    stats['stdev'], stats['count']))
+                for percentile_value in stats['percentile_list']:
+                    output_csv_file.write(',%s' % percentile_value)
+                output_csv_file.write('\n')
+                output_csv_file.flush()
+
+
+def _raster_stats_worker(args):
+    """Unpack ``raster_stats`` arguments for ``Pool.imap_unordered``."""
+    raster_path = args[0]
+    return raster_path, raster_stats(*args)
+
+
+def raster_stats(
+        raster_path, percentile_list, n_histogram_bins=_N_HISTOGRAM_BINS,
+        exact_percentiles=False):
+    """Calculate the stats of band 1 of a raster in one pass.
 
     Parameters:
-        dataset_path (string): a path to a floating point GDAL dataset
-        datatype_id (string): either 'i' or 'f' to indicate int or float.
+        raster_path (str): path to the raster.
+        percentile_list (list): sorted percentiles in [0, 100].
+        n_histogram_bins (int): number of histogram bins used to
+            approximate percentiles.
+        exact_percentiles (bool): if True, refine the approximate
+            percentiles with a second pass over the pixels in their bins.
 
     Returns:
-        an iterable that produces value in decreasing sorted order
+        dict with 'min', 'max', 'mean', 'stdev' (population), 'count' of
+        valid pixels, and 'percentile_list' of values parallel to
+        ``percentile_list``. Stats are NaN if there are no valid pixels.
+        Percentile ``p`` of ``n`` values is the value of rank
+        ``min(int(p/100*n), n-1)`` in ascending order.
 
     """
-    def _read_score_index_from_disk(score_file_path, datatype_id):
-        """Create generator of float/int value from the given filenames.
-
-        Reads a buffer of `buffer_size` big before to avoid keeping the
-        file open between generations.
-
-        score_file_path (string): a path to a file that has 32 bit data
-            packed consecutively
-
-        Yields:
-            next (score, index) tuple in the given score and index files.
-
-        """
-        try:
-            score_buffer = ''
-            file_offset = 0
-            buffer_offset = 0  # initialize to 0 to trigger the first load
-
-            # ensure buffer size that is not a perfect multiple of 4
-            read_buffer_size = int(math.sqrt(_BLOCK_SIZE))
-            read_buffer_size = read_buffer_size - read_buffer_size % 4
-
-            while True:
-                if buffer_offset == len(score_buffer):
-                    score_file = open(score_file_path, 'rb')
-                    score_file.seek(file_offset)
-
-                    score_buffer = score_file.read(read_buffer_size)
-                    score_file.close()
-
-                    file_offset += read_buffer_size
-                    buffer_offset = 0
-                packed_score = score_buffer[buffer_offset:buffer_offset+4]
-                buffer_offset += 4
-                if not packed_score:
-                    break
-                yield struct.unpack(datatype_id, packed_score)[0]
-        finally:
-            # deletes the files when generator goes out of scope or ends
-            os.remove(score_file_path)
-
-    def _sort_cache_to_iterator(score_cache, datatype_id):
-        """Flushes the current cache to a heap and return it.
-
-        Parameters:
-            score_cache (1d numpy.array): contains score pixels
-            datatype_id (str): either 'i' or 'f' to indicate integer or
-                float for struct formatting.
-
-        Returns:
-            Iterable to visit scores/indexes in increasing score order.
-
-        """
-        # sort the whole bunch to disk
-        score_file = tempfile.NamedTemporaryFile(delete=False)
-
-        sort_index = score_cache.argsort()
-        score_cache = score_cache[sort_index]
-        for index in range(0, score_cache.size, _LARGEST_STRUCT_PACK):
-            score_block = score_cache[index:index+_LARGEST_STRUCT_PACK]
-            score_file.write(struct.pack(
-                '%s%s' % (score_block.size, datatype_id), *score_block))
-
-        score_file_path = score_file.name
-        score_file.close()
-
-        return _read_score_index_from_disk(score_file_path, datatype_id)
-
-    dataset_info = pygeoprocessing.get_raster_info(dataset_path)
-    nodata = dataset_info['nodata'][0]
-
-    # This will be a list of file iterators we'll pass to heap.merge
-    iters = []
-    for scores_data, scores_block in pygeoprocessing.iterblocks(
-            (dataset_path, 1), largest_block=_BLOCK_SIZE):
-        # flatten and scale the results
-        scores_block = scores_block.flatten()
+    LOGGER.info('processing %s', raster_path)
+    nodata = pygeoprocessing.get_raster_info(raster_path)['nodata'][0]
+    stats = {
+        'min': float('nan'),
+        'max': float('nan'),
+        'mean': 0.0,
+        'm2': 0.0,
+        'count': 0,
+    }
+    histogram = None
+    for _, block in pygeoprocessing.iterblocks(
+            (raster_path, 1), largest_block=_BLOCK_SIZE):
+        valid_array = _valid_values(block, nodata)
+        if valid_array.size == 0:
+            continue
+        _update_stats(stats, valid_array)
+        if percentile_list:
+            histogram = _update_histogram(
+                histogram, valid_array, n_histogram_bins)
+
+    result = {
+        'min': stats['min'],
+        'max': stats['max'],
+        'mean': stats['mean'] if stats['count'] else float('nan'),
+        'stdev': (
+            float(numpy.sqrt(stats['m2'] / stats['count']))
+            if stats['count'] else float('nan')),
+        'count': stats['count'],
+        'percentile_list': [float('nan')] * len(percentile_list),
+    }
+    if not stats['count'] or not percentile_list:
+        return result
+
+    rank_list = [
+        min(int(percentile/100.0*stats['count']), stats['count']-1)
+        for percentile in percentile_list]
+    cumulative_count = numpy.cumsum(histogram['count'])
+    bin_index_list = [
+        int(numpy.searchsorted(cumulative_count, rank, side='right'))
+        for rank in rank_list]
+    if exact_percentiles:
+        result['percentile_list'] = _refine_percentiles(
+            raster_path, nodata, histogram, rank_list, bin_index_list)
+        return result
+
+    for index, (rank, bin_index) in enumerate(
+            zip(rank_list, bin_index_list)):
+        n_before = cumulative_count[bin_index] - histogram['count'][
+            bin_index]
+        # spread the bin's values evenly across it
+        fraction = (rank - n_before + 0.5) / histogram['count'][bin_index]
+        result['percentile_list'][index] = float(numpy.clip(
+            histogram['origin'] + (bin_index + fraction) * histogram['width'],
+            stats['min'], stats['max']))
+    return result
+
+
+def _valid_values(block, nodata):
+    """Return the flat values of ``block`` that aren't nodata or non-finite."""
+    valid_mask = numpy.ones(block.shape, dtype=bool)
+    if nodata is not None:
+        valid_mask &= block != nodata
+    if numpy.issubdtype(block.dtype, numpy.floating):
+        valid_mask &= numpy.isfinite(block)
+    return block[valid_mask]
+
+
+def _update_stats(stats, valid_array):
+    """Merge a block's count, min, max, mean and m2 into ``stats``.
+
+    Uses the parallel form of Welford's algorithm so the mean and variance
+    stay accurate over billions of pixels.
+
+    """
+    valid_array = valid_array.astype(numpy.float64)
+    block_count = valid_array.size
+    block_mean = float(numpy.mean(valid_array))
+    block_m2 = float(numpy.sum((valid_array - block_mean)**2))
+    total_count = stats['count'] + block_count
+    delta = block_mean - stats['mean']
+    stats['mean'] += delta * block_count / total_count
+    stats['m2'] += block_m2 + delta**2 * stats['count'] * (
+        block_count / total_count)
+    stats['count'] = total_count
+    block_min = float(numpy.min(valid_array))
+    block_max = float(numpy.max(valid_array))
+    if not stats['min'] <= block_min:
+        stats['min'] = block_min
+    if not stats['max'] >= block_max:
+        stats['max'] = block_max
+
+
+def _update_histogram(histogram, valid_array, n_bins):
+    """Add values to a fixed size histogram that grows to fit them.
+
+    The histogram starts over the first block's range. When values fall
+    outside of it, the bin width doubles, merging pairs of adjacent bins,
+    and the range extends up or down until they fit, so earlier counts
+    never need to be re-binned from the pixels.
+
+    Parameters:
+        histogram (dict): None or a histogram from an earlier call.
+        valid_array (numpy.ndarray): flat array of values to add.
+        n_bins (int): number of bins of a new histogram, rounded up to
+            an even number so bins can be merged in pairs.
 
-        col_coords, row_coords = numpy.meshgrid(
-            range(scores_data['xoff'], scores_data['xoff'] +
-                  scores_data['win_xsize']),
-            range(scores_data['yoff'], scores_data['yoff'] +
-                  scores_data['win_ysize']))
+    Returns:
+        dict with 'origin' the lower edge of bin 0, 'width' the width of
+        every bin, and 'count' an int64 array of the count in each bin.
+
+    """
+    block_min = float(numpy.min(valid_array))
+    block_max = float(numpy.max(valid_array))
+    if histogram is None:
+        n_bins += n_bins % 2
+        value_range = block_max - block_min or abs(block_min) or 1.0
+        width = value_range / n_bins
+        # the upper edge is exclusive, so widen the bins by the least
+        # amount that puts block_max in the last bin rather than past it
+        while block_min + n_bins * width <= block_max:
+            width = numpy.nextafter(width, numpy.inf)
+        histogram = {
+            'origin': block_min,
+            'width': float(width),
+            'count': numpy.zeros(n_bins, dtype=numpy.int64),
+        }
+    count_array = histogram['count']
+    n_bins = count_array.size
+    while block_min < histogram['origin'] or block_max >= (
+            histogram['origin'] + n_bins * histogram['width']):
+        merged_array = count_array.reshape((n_bins//2, 2)).sum(axis=1)
+        count_array = numpy.zeros(n_bins, dtype=numpy.int64)
+        if block_min < histogram['origin']:
+            # the old range becomes the upper half
+            count_array[n_bins//2:] = merged_array
+            histogram['origin'] -= n_bins * histogram['width']
+        else:
+            count_array[:n_bins//2] = merged_array
+        histogram['width'] *= 2
+    histogram['count'] = count_array
+    count_array += numpy.bincount(
+        _bin_index(histogram, valid_array), minlength=n_bins)
+    return histogram
+
+
+def _bin_index(histogram, value_array):
+    """Return the histogram bin of every value in ``value_array``."""
+    return numpy.clip(
+        numpy.floor(
+            (value_array.astype(numpy.float64) - histogram['origin']) /
+            histogram['width']).astype(numpy.int64),
+        0, histogram['count'].size-1)
+
+
+def _refine_percentiles(
+        raster_path, nodata, histogram, rank_list, bin_index_list):
+    """Find exact percentiles by re-reading only the pixels near their bins.
+
+    The histogram's counts were binned against origins that shifted as it
+    grew, so float rounding can put a value on a bin edge in a neighbouring
+    bin from the one this pass computes against the final origin. This pass
+    therefore recounts every bin with the final origin, collects the
+    candidates of each percentile's bin and its neighbours, and locates
+    every rank with its own counts. If a rank still lands outside of the
+    collected bins the raster is sorted to disk instead.
 
-        sort_index = scores_block.argsort()
-        sorted_scores = scores_block[sort_index]
+    Parameters:
+        raster_path (str): path to the raster.
+        nodata (numeric): nodata of band 1 or None.
+        histogram (dict): histogram of every valid pixel of the raster.
+        rank_list (list): 0 based ranks of the percentiles.
+        bin_index_list (list): histogram bin holding each rank.
 
-        # search for nodata values are so we can splice them out
-        left_index = numpy.searchsorted(sorted_scores, nodata, side='left')
-        right_index = numpy.searchsorted(
-            sorted_scores, nodata, side='right')
+    Returns:
+        list of the values of ``rank_list``.
 
-        # remove nodata values
-        score_cache = numpy.concatenate(
-            (sorted_scores[0:left_index], sorted_scores[right_index::]))
-        iters.append(_sort_cache_to_iterator(score_cache, datatype_id))
+    """
+    n_bins = histogram['count'].size
+    target_bin_array = numpy.unique(numpy.clip(
+        numpy.add.outer(bin_index_list, [-1, 0, 1]), 0, n_bins-1))
+    if numpy.sum(histogram['count'][target_bin_array]) > _RUN_SIZE:
+        # too many candidates to hold in memory
+        return _select_ranks_by_sort(raster_path, rank_list)
+
+    candidate_list_map = {bin_index: [] for bin_index in target_bin_array}
+    bin_count_array = numpy.zeros(n_bins, dtype=numpy.int64)
+    for _, block in pygeoprocessing.iterblocks(
+            (raster_path, 1), largest_block=_BLOCK_SIZE):
+        valid_array = _valid_values(block, nodata)
+        block_bin_array = _bin_index(histogram, valid_array)
+        bin_count_array += numpy.bincount(block_bin_array, minlength=n_bins)
+        for bin_index in target_bin_array[numpy.isin(
+                target_bin_array, block_bin_array)]:
+            candidate_list_map[bin_index].append(
+                valid_array[block_bin_array == bin_index])
+
+    cumulative_count = numpy.cumsum(bin_count_array)
+    value_list = []
+    for rank in rank_list:
+        bin_index = int(numpy.searchsorted(
+            cumulative_count, rank, side='right'))
+        if bin_index not in candidate_list_map:
+            LOGGER.warning(
+                '%s: rank %d is outside of the histogram bins re-read, '
+                'sorting the raster instead', raster_path, rank)
+            return _select_ranks_by_sort(raster_path, rank_list)
+        candidate_array = numpy.concatenate(candidate_list_map[bin_index])
+        bin_rank = rank - (cumulative_count[bin_index] - bin_count_array[
+            bin_index])
+        value_list.append(
+            numpy.partition(candidate_array, bin_rank)[bin_rank])
+    return value_list
+
+
+def _select_ranks_by_sort(raster_path, rank_list):
+    """Return the values of ``rank_list`` from a full external sort."""
+    working_dir = tempfile.mkdtemp()
+    try:
+        run_list = [
+            numpy.load(run_path, mmap_mode='r') for run_path in
+            _sort_to_disk(raster_path, working_dir)]
+        value_list = [_select_rank(run_list, rank) for rank in rank_list]
+        run_list = None
+        return value_list
+    finally:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+def _sort_to_disk(dataset_path, working_dir, run_size=_RUN_SIZE):
+    """Write the valid pixels of a raster to disk as sorted runs.
 
-    return heapq.merge(*iters)
+    Parameters:
+        dataset_path (string): a path to a GDAL dataset.
+        working_dir (string): directory to write the runs to.
+        run_size (int): largest number of values sorted in memory at once.
 
+    Returns:
+        list of paths to ``.npy`` files of ascending values, together they
+        hold every pixel of band 1 that isn't nodata or non-finite.
 
-def _make_logger_callback(message):
-    """Build a timed logger callback that prints ``message`` replaced.
+    """
+    nodata = pygeoprocessing.get_raster_info(dataset_path)['nodata'][0]
+    run_path_list = []
+    pending_list = []
+    pending_size = 0
+
+    def _flush_run():
+        """Sort the pending values and save them as the next run."""
+        run_array = numpy.concatenate(pending_list)
+        run_array.sort()
+        run_path = os.path.join(working_dir, f'{len(run_path_list)}.npy')
+        numpy.save(run_path, run_array)
+        run_path_list.append(run_path)
+
+    for _, scores_block in pygeoprocessing.iterblocks(
+            (dataset_path, 1), largest_block=_BLOCK_SIZE):
+        valid_array = _valid_values(scores_block, nodata)
+        if valid_array.size == 0:
+            continue
+        if pending_size + valid_array.size > run_size and pending_list:
+            _flush_run()
+            pending_list = []
+            pending_size = 0
+        pending_list.append(valid_array)
+        pending_size += valid_array.size
+    if pending_list:
+        _flush_run()
+    return run_path_list
+
+
+def select_percentiles(run_path_list, percentile_list):
+    """Select percentile values from sorted runs.
+
+    The value of percentile ``p`` of ``n`` values is the value of rank
+    ``min(int(p/100*n), n-1)`` in ascending order.
 
     Parameters:
-        message (string): a string that expects 2 placement %% variables,
-            first for % complete from ``df_complete``, second from
-            ``p_progress_arg[0]``.
+        run_path_list (list): paths to ``.npy`` runs from ``_sort_to_disk``.
+        percentile_list (list): percentiles in [0, 100].
 
     Returns:
-        Function with signature:
-            logger_callback(df_complete, psz_message, p_progress_arg)
+        list of values parallel to ``percentile_list``, NaN if the runs
+        are empty.
+
+    """
+    run_list = [
+        numpy.load(run_path, mmap_mode='r') for run_path in run_path_list]
+    total_valid = sum([run.size for run in run_list])
+    if total_valid == 0:
+        return [float('nan')] * len(percentile_list)
+    return [
+        _select_rank(
+            run_list, min(int(percentile/100.0*total_valid), total_valid-1))
+        for percentile in percentile_list]
+
+
+def _select_rank(run_list, rank):
+    """Return the value of 0 based ``rank`` in the union of sorted runs.
+
+    Each step takes the middle of the largest remaining window of a run as
+    a pivot, counts how many values in every window are less than and
+    equal to it with a binary search, and keeps only the side of each
+    window that holds the rank. That halves the largest window each step,
+    so only a logarithmic number of values are read from each memory
+    mapped run until the remaining candidates are few enough to partition
+    in memory.
 
     """
-    def logger_callback(df_complete, _, p_progress_arg):
-        """Argument names come from the GDAL API for callbacks."""
-        try:
-            current_time = time.time()
-            if ((current_time - logger_callback.last_time) > 5.0 or
-                    (df_complete == 1.0 and
-                     logger_callback.total_time >= 5.0)):
-                # In some multiprocess applications I was encountering a
-                # ``p_progress_arg`` of None. This is unexpected and I suspect
-                # was an issue for some kind of GDAL race condition. So I'm
-                # guarding against it here and reporting an appropriate log
-                # if it occurs.
-                if p_progress_arg:
-                    LOGGER.info(message, df_complete * 100, p_progress_arg[0])
-                else:
-                    LOGGER.info(
-                        'p_progress_arg is None df_complete: %s, message: %s',
-                        df_complete, message)
-                logger_callback.last_time = current_time
-                logger_callback.total_time += current_time
-        except AttributeError:
-            logger_callback.last_time = time.time()
-            logger_callback.total_time = 0.0
-
-    return logger_callback
+    lo_array = numpy.zeros(len(run_list), dtype=numpy.int64)
+    hi_array = numpy.array([run.size for run in run_list], dtype=numpy.int64)
+    while numpy.sum(hi_array - lo_array) > _SELECT_IN_MEMORY_SIZE:
+        pivot_run_index = int(numpy.argmax(hi_array - lo_array))
+        pivot = run_list[pivot_run_index][
+            (lo_array[pivot_run_index] + hi_array[pivot_run_index]) // 2]
+        left_array = numpy.empty_like(lo_array)
+        right_array = numpy.empty_like(hi_array)
+        for run_index, run in enumerate(run_list):
+            window = run[lo_array[run_index]:hi_array[run_index]]
+            left_array[run_index] = lo_array[run_index] + numpy.searchsorted(
+                window, pivot, side='left')
+            right_array[run_index] = lo_array[run_index] + numpy.searchsorted(
+                window, pivot, side='right')
+        n_less = numpy.sum(left_array - lo_array)
+        n_less_equal = numpy.sum(right_array - lo_array)
+        if rank < n_less:
+            hi_array = left_array
+        elif rank < n_less_equal:
+            return pivot
+        else:
+            rank -= n_less_equal
+            lo_array = right_array
+    candidate_array = numpy.concatenate([
+        run[lo:hi] for run, lo, hi in zip(run_list, lo_array, hi_array)])
+    return numpy.partition(candidate_array, rank)[rank]
 
 
 if __name__ == '__main__':
@@ -264,7 +470,18 @@ if __name__ == '__main__':
         type=int, default=None)
     parser.add_argument(
         '-o', '--output_csv', help='path to output CSV file', type=str)
+    parser.add_argument(
+        '--n_workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of rasters to process in parallel')
+    parser.add_argument(
+        '--n_histogram_bins', type=int, default=_N_HISTOGRAM_BINS,
+        help='number of histogram bins used to approximate percentiles')
+    parser.add_argument(
+        '--exact_percentiles', action='store_true', help=(
+            'make a second pass over the pixels near each percentile to '
+            'report exact values rather than histogram approximations'))
     args = parser.parse_args()
-    raster_stats = calculate_raster_stats(
-        args.filepath, args.output_csv, percentiles=args.percentiles)
-    LOGGER.debug(raster_stats)
+    calculate_raster_stats(
+        args.filepath, args.output_csv, percentiles=args.percentiles,
+        n_workers=args.n_workers, n_histogram_bins=args.n_histogram_bins,
+        exact_percentiles=args.exact_percentiles)
@@ -0,0 +1,150 @@
+"""Benchmark raster_stats percentile extraction on a synthetic raster.
+
+Times the previous ``struct`` packed runs merged with ``heapq.merge`` and
+advanced with ``itertools.islice``, kept here as the reference, against the
+``.npy`` runs and memory mapped selection of ``raster_stats`` and checks
+that both give the same percentiles.
+"""
+import argparse
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from osgeo import gdal
+from osgeo import osr
+import numpy
+import pygeoprocessing
+import raster_stats.__main__ as raster_stats
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=(
+        '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
+        ' [%(funcName)s:%(lineno)d] %(message)s'),
+    stream=sys.stdout)
+LOGGER = logging.getLogger(__name__)
+
+NODATA = -1.0
+
+
+def _make_synthetic_raster(raster_path, n_rows, n_cols, nodata_fraction):
+    """Write a float32 raster with random values and nodata holes."""
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    rng = numpy.random.default_rng(1)
+    array = rng.gamma(2.0, 10.0, (n_rows, n_cols)).astype(numpy.float32)
+    array[rng.random((n_rows, n_cols)) < nodata_fraction] = NODATA
+    driver = gdal.GetDriverByName('GTiff')
+    raster = driver.Create(
+        raster_path, n_cols, n_rows, 1, gdal.GDT_Float32,
+        options=['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+    raster.SetGeoTransform([-180, 1/360, 0, 90, 0, -1/360])
+    raster.SetProjection(srs.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(array)
+    band = None
+    raster = None
+
+
+def _legacy_percentiles(raster_path, percentile_list, working_dir):
+    """Percentiles the way raster_stats used to find them."""
+    iterator_list = []
+    total_valid = 0
+    for _, block in pygeoprocessing.iterblocks(
+            (raster_path, 1), largest_block=raster_stats._BLOCK_SIZE):
+        block = numpy.sort(block.flatten())
+        left_index = numpy.searchsorted(block, NODATA, side='left')
+        right_index = numpy.searchsorted(block, NODATA, side='right')
+        block = numpy.concatenate((block[:left_index], block[right_index:]))
+        total_valid += block.size
+        run_path = os.path.join(working_dir, f'{len(iterator_list)}.bin')
+        with open(run_path, 'wb') as run_file:
+            for index in range(0, block.size, 1024):
+                sub_block = block[index:index+1024]
+                run_file.write(struct.pack(
+                    '%df' % sub_block.size, *sub_block))
+        iterator_list.append(_legacy_read_run(run_path))
+
+    sorted_iterator = heapq.merge(*iterator_list)
+    value_list = []
+    current_offset = 0
+    for percentile in percentile_list:
+        skip_size = int(percentile/100.0*total_valid) - current_offset
+        current_offset += skip_size+1
+        if current_offset >= total_valid:
+            skip_size -= current_offset-total_valid+2
+        value_list.append(next(itertools.islice(
+            sorted_iterator, skip_size, skip_size+1)))
+    return value_list
+
+
+def _legacy_read_run(run_path):
+    """Yield the float32 values of a run one ``struct.unpack`` at a time."""
+    with open(run_path, 'rb') as run_file:
+        while True:
+            packed_value = run_file.read(4)
+            if not packed_value:
+                break
+            yield struct.unpack('f', packed_value)[0]
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=(
+        'Compare the struct/heapq and npy/memmap percentile paths.'))
+    parser.add_argument(
+        '--n_rows', type=int, default=2048, help='rows of synthetic raster')
+    parser.add_argument(
+        '--n_cols', type=int, default=2048, help='cols of synthetic raster')
+    parser.add_argument(
+        '--nodata_fraction', type=float, default=0.1,
+        help='fraction of the synthetic raster that is nodata')
+    parser.add_argument(
+        '--percentiles', nargs='+', type=int,
+        default=[1, 5, 10, 25, 50, 75, 90, 95, 99],
+        help='percentiles to extract')
+    args = parser.parse_args()
+    percentile_list = sorted(args.percentiles)
+
+    workspace_dir = tempfile.mkdtemp(
+        dir='.', prefix='raster_stats_benchmark_')
+    try:
+        raster_path = os.path.join(workspace_dir, 'synthetic.tif')
+        _make_synthetic_raster(
+            raster_path, args.n_rows, args.n_cols, args.nodata_fraction)
+
+        print('engine,seconds')
+        legacy_dir = os.path.join(workspace_dir, 'legacy')
+        os.makedirs(legacy_dir)
+        start_time = time.time()
+        legacy_value_list = _legacy_percentiles(
+            raster_path, percentile_list, legacy_dir)
+        print(f'struct_heapq,{time.time()-start_time:.2f}')
+
+        run_dir = os.path.join(workspace_dir, 'runs')
+        os.makedirs(run_dir)
+        start_time = time.time()
+        run_path_list = raster_stats._sort_to_disk(raster_path, run_dir)
+        value_list = raster_stats.select_percentiles(
+            run_path_list, percentile_list)
+        print(f'npy_select,{time.time()-start_time:.2f}')
+
+        for percentile, legacy_value, value in zip(
+                percentile_list, legacy_value_list, value_list):
+            if legacy_value != value:
+                LOGGER.error(
+                    '%dth percentile differs: %s vs %s', percentile,
+                    legacy_value, value)
+    finally:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
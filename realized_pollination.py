@@ -6,11 +6,11 @@ import sys
 from ecoshard import geoprocessing
 from ecoshard import taskgraph
 from osgeo import gdal
-from osgeo import osr
 import compress_and_overview
+import convolution_engine
 import numpy
+import radial_kernel
 import raster_calculations_core
-import scipy
 
 BASE_RASTER_URL_MAP = {
     'ppl_fed': 'https://storage.googleapis.com/ecoshard-root/working-shards/pollination_ppl_fed_on_ag_10s_esa_md5_0fb6bd172901703755b33dae2c9f1b92.tif',
@@ -53,8 +53,9 @@ def main():
     task_graph = taskgraph.TaskGraph(CHURN_DIR, -1, 5.0)
     kernel_raster_path = os.path.join(CHURN_DIR, 'radial_kernel.tif')
     kernel_task = task_graph.add_task(
-        func=create_flat_radial_convolution_mask,
+        func=radial_kernel.create_radial_kernel,
         args=(0.00277778, 2000., kernel_raster_path),
+        kwargs={'normalize': 'max', 'kernel_nodata': TARGET_NODATA},
         target_path_list=[kernel_raster_path],
         task_name='make convolution kernel')
     hab_fetch_path_map = {}
@@ -92,19 +93,17 @@ def main():
     # calculate extent of ppl fed by 2km.
     ppl_fed_reach_raster_path = os.path.join(CHURN_DIR, 'ppl_fed_reach.tif')
     ppl_fed_reach_task = task_graph.add_task(
-        func=geoprocessing.convolve_2d,
+        func=convolution_engine.convolve_2d,
         args=[
             (ppl_fed_nodata_to_zero_path, 1), (kernel_raster_path, 1),
             ppl_fed_reach_raster_path],
         kwargs={
-            'working_dir': CHURN_DIR,
             'mask_nodata': False,
             'raster_driver_creation_tuple': (
                 'GTiff', (
                     'TILED=YES', 'BIGTIFF=YES', 'COMPRESS=ZSTD',
                     'PREDICTOR=1', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
-                    'NUM_THREADS=2')),
-                'n_threads': 4},
+                    'NUM_THREADS=2'))},
         dependent_task_list=[kernel_task],
         target_path_list=[ppl_fed_reach_raster_path],
         task_name=(
@@ -132,59 +131,5 @@ def main():
     task_graph.close()
 
 
-def create_flat_radial_convolution_mask(
-        pixel_size_degree, radius_meters, kernel_filepath):
-    """Create a radial mask to sample pixels in convolution filter.
-
-    Parameters:
-        pixel_size_degree (float): size of pixel in degrees.
-        radius_meters (float): desired size of radial mask in meters.
-
-    Returns:
-        A 2D numpy array that can be used in a convolution to aggregate a
-        raster while accounting for partial coverage of the circle on the
-        edges of the pixel.
-
-    """
-    degree_len_0 = 110574  # length at 0 degrees
-    degree_len_60 = 111412  # length at 60 degrees
-    pixel_size_m = pixel_size_degree * (degree_len_0 + degree_len_60) / 2.0
-    pixel_radius = numpy.ceil(radius_meters / pixel_size_m)
-    n_pixels = (int(pixel_radius) * 2 + 1)
-    sample_pixels = 200
-    mask = numpy.ones((sample_pixels * n_pixels, sample_pixels * n_pixels))
-    mask[mask.shape[0]//2, mask.shape[0]//2] = 0
-    distance_transform = scipy.ndimage.morphology.distance_transform_edt(mask)
-    mask = None
-    stratified_distance = distance_transform * pixel_size_m / sample_pixels
-    distance_transform = None
-    in_circle = numpy.where(stratified_distance <= 2000.0, 1.0, 0.0)
-    stratified_distance = None
-    reshaped = in_circle.reshape(
-        in_circle.shape[0] // sample_pixels, sample_pixels,
-        in_circle.shape[1] // sample_pixels, sample_pixels)
-    kernel_array = numpy.sum(reshaped, axis=(1, 3)) / sample_pixels**2
-    normalized_kernel_array = kernel_array / numpy.max(kernel_array)
-    LOGGER.debug(normalized_kernel_array)
-    reshaped = None
-
-    driver = gdal.GetDriverByName('GTiff')
-    kernel_raster = driver.Create(
-        kernel_filepath.encode('utf-8'), n_pixels, n_pixels, 1,
-        gdal.GDT_Float32, options=[
-            'BIGTIFF=IF_SAFER', 'TILED=YES', 'BLOCKXSIZE=256',
-            'BLOCKYSIZE=256'])
-
-    # Make some kind of geotransform, it doesn't matter what but
-    # will make GIS libraries behave better if it's all defined
-    kernel_raster.SetGeoTransform([-180, 1, 0, 90, 0, -1])
-    srs = osr.SpatialReference()
-    srs.ImportFromEPSG(4326)
-    kernel_raster.SetProjection(srs.ExportToWkt())
-    kernel_band = kernel_raster.GetRasterBand(1)
-    kernel_band.SetNoDataValue(TARGET_NODATA)
-    kernel_band.WriteArray(normalized_kernel_array)
-
-
 if __name__ == '__main__':
     main()
@@ -6,6 +6,7 @@ import os
 from ecoshard import geoprocessing
 from ecoshard import taskgraph
 from osgeo import gdal
+import numpy
 import pandas
 
 gdal.SetCacheMax(2**28)
@@ -25,6 +26,121 @@ def _base_filename(path):
 INT_TYPE = 'int'
 FLOAT_TYPE = 'float'
 
+# the dense lookup table covers every code between the smallest and largest
+# table value so it must not be larger than this
+_MAX_LOOKUP_SIZE = 2**26
+
+
+def reclassify_columns(
+        base_raster_path_band, value_map_list, target_raster_path_list,
+        target_datatype_list, target_nodata, multiband_raster_path=None):
+    """Reclassify a raster by several value maps in one pass.
+
+    Every value map is turned into a dense lookup array indexed by base
+    value minus the smallest mapped value, each block of the base raster is
+    read once, and every output block is a single ``numpy.take`` into its
+    lookup array.
+
+    Parameters:
+        base_raster_path_band (tuple): (path, band index) of integer raster
+            to reclassify.
+        value_map_list (list): list of dicts mapping base values to target
+            values, all with the same keys.
+        target_raster_path_list (list): list of paths parallel to
+            ``value_map_list`` to write each reclassification to. Ignored if
+            ``multiband_raster_path`` is not None.
+        target_datatype_list (list): list of GDAL types parallel to
+            ``value_map_list``.
+        target_nodata (numeric): nodata value of the outputs, base nodata
+            pixels are set to this, or 0 if it is None.
+        multiband_raster_path (str): if not None, write a single raster with
+            one band per value map here instead of one raster per map.
+
+    Returns:
+        None.
+
+    Raises:
+        ValueError if the base raster has a value not in the value maps or
+            the lookup table would be larger than ``_MAX_LOOKUP_SIZE``.
+
+    """
+    base_value_array = numpy.array(
+        sorted(value_map_list[0]), dtype=numpy.int64)
+    min_value = int(base_value_array[0])
+    lookup_size = int(base_value_array[-1]) - min_value + 1
+    if lookup_size > _MAX_LOOKUP_SIZE:
+        raise ValueError(
+            f'table values span {lookup_size} codes which is more than the '
+            f'{_MAX_LOOKUP_SIZE} a lookup table can hold')
+
+    mapped_array = numpy.zeros(lookup_size, dtype=bool)
+    mapped_array[base_value_array - min_value] = True
+    lookup_array_list = []
+    for value_map, target_datatype in zip(
+            value_map_list, target_datatype_list):
+        lookup_array = numpy.zeros(
+            lookup_size, dtype=(
+                numpy.float32 if target_datatype == gdal.GDT_Float32
+                else numpy.int32))
+        lookup_array[base_value_array - min_value] = [
+            value_map[base_value] for base_value in base_value_array]
+        lookup_array_list.append(lookup_array)
+    nodata_fill = 0 if target_nodata is None else target_nodata
+
+    if multiband_raster_path is not None:
+        multiband_datatype = gdal.GDT_Int32
+        if gdal.GDT_Float32 in target_datatype_list:
+            multiband_datatype = gdal.GDT_Float32
+        geoprocessing.new_raster_from_base(
+            base_raster_path_band[0], multiband_raster_path,
+            multiband_datatype, [target_nodata] * len(value_map_list))
+        target_raster_list = [gdal.OpenEx(
+            multiband_raster_path, gdal.OF_RASTER | gdal.OF_UPDATE)]
+        target_band_list = [
+            target_raster_list[0].GetRasterBand(band_index+1)
+            for band_index in range(len(value_map_list))]
+    else:
+        target_raster_list = []
+        for target_raster_path, target_datatype in zip(
+                target_raster_path_list, target_datatype_list):
+            geoprocessing.new_raster_from_base(
+                base_raster_path_band[0], target_raster_path,
+                target_datatype, [target_nodata])
+            target_raster_list.append(gdal.OpenEx(
+                target_raster_path, gdal.OF_RASTER | gdal.OF_UPDATE))
+        target_band_list = [
+            target_raster.GetRasterBand(1)
+            for target_raster in target_raster_list]
+
+    base_nodata = geoprocessing.get_raster_info(
+        base_raster_path_band[0])['nodata'][base_raster_path_band[1]-1]
+    for offset_dict, base_array in geoprocessing.iterblocks(
+            base_raster_path_band):
+        index_array = base_array.astype(numpy.int64) - min_value
+        nodata_mask = numpy.zeros(base_array.shape, dtype=bool)
+        if base_nodata is not None:
+            nodata_mask = base_array == base_nodata
+        # nodata pixels look up the smallest table value, which is always
+        # mapped, and are overwritten with the target nodata afterwards
+        index_array[nodata_mask] = 0
+        missing_mask = (index_array < 0) | (index_array >= lookup_size)
+        missing_mask[~missing_mask] = ~mapped_array[
+            index_array[~missing_mask]]
+        if numpy.any(missing_mask):
+            raise ValueError(
+                f'values in {base_raster_path_band[0]} are not in the '
+                f'table: {numpy.unique(base_array[missing_mask])}')
+        for lookup_array, target_band in zip(
+                lookup_array_list, target_band_list):
+            target_array = numpy.take(lookup_array, index_array)
+            target_array[nodata_mask] = nodata_fill
+            target_band.WriteArray(
+                target_array, xoff=offset_dict['xoff'],
+                yoff=offset_dict['yoff'])
+
+    target_band_list = None
+    target_raster_list = None
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -44,6 +160,14 @@ if __name__ == '__main__':
             'type.'))
     parser.add_argument(
         '--output_dir', default='.', help='optional path to output directory')
+    parser.add_argument(
+        '--single_pass', action='store_true', help=(
+            'reclassify every column from one read of the base raster with '
+            'dense lookup tables'))
+    parser.add_argument(
+        '--multiband', action='store_true', help=(
+            'write all columns as bands of a single raster, implies '
+            '`--single_pass`'))
 
     args = parser.parse_args()
 
@@ -60,6 +184,9 @@ if __name__ == '__main__':
         10.0)
 
     target_raster_path_list = []
+    value_map_list = []
+    target_datatype_list = []
+    raster_info = geoprocessing.get_raster_info(args.raster_path)
     for column_name_type_pair in args.target_value_fields:
         try:
             column_name, target_type = column_name_type_pair.split(',')
@@ -111,8 +238,12 @@ if __name__ == '__main__':
                 _base_filename(args.raster_path)}_{
                 _base_filename(args.reclassify_table_path)}_{
                 column_name}.tif''')
+        target_raster_path_list.append(target_raster_path)
+        value_map_list.append(value_map)
+        target_datatype_list.append(raster_target_type)
+        if args.single_pass or args.multiband:
+            continue
         LOGGER.info(f'reclassifying to: {target_raster_path}')
-        raster_info = geoprocessing.get_raster_info(args.raster_path)
         task_graph.add_task(
             func=geoprocessing.reclassify_raster,
             args=(
@@ -120,7 +251,28 @@ if __name__ == '__main__':
                 raster_target_type, raster_info['nodata'][0]),
             target_path_list=[target_raster_path],
             task_name=f'reclassify {column_name}')
-        target_raster_path_list.append(target_raster_path)
+
+    if args.single_pass or args.multiband:
+        multiband_raster_path = None
+        if args.multiband:
+            multiband_raster_path = os.path.join(
+                args.output_dir,
+                f'''reclassified_{
+                    _base_filename(args.raster_path)}_{
+                    _base_filename(args.reclassify_table_path)}.tif''')
+            target_raster_path_list = [multiband_raster_path]
+        LOGGER.info(
+            'reclassifying in one pass to:\n' +
+            '\n'.join(target_raster_path_list))
+        task_graph.add_task(
+            func=reclassify_columns,
+            args=(
+                (args.raster_path, 1), value_map_list,
+                target_raster_path_list, target_datatype_list,
+                raster_info['nodata'][0]),
+            kwargs={'multiband_raster_path': multiband_raster_path},
+            target_path_list=target_raster_path_list,
+            task_name='reclassify all columns')
     task_graph.join()
     task_graph.close()
     LOGGER.info(
@@ -0,0 +1,255 @@
+"""Per pixel reductions over a stack of rasters in a single pass.
+
+Every requested reduction (sum, mean, count, min, max, stdev, median) of a
+stack is calculated from one read of each input window and every target is
+written from the same pass. Nodata is masked with ``where=`` arguments to
+in place numpy ufuncs so there is no fancy indexing per raster, and mean
+and stdev use a per pixel Welford update so they stay accurate for long
+stacks. Rasters that aren't already on the same grid are read through
+warped VRTs on the union (or intersection) of their extents, so no aligned
+copies are written to disk.
+"""
+import logging
+import os
+
+from ecoshard import geoprocessing
+from osgeo import gdal
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+REDUCTION_LIST = ['sum', 'mean', 'count', 'min', 'max', 'stdev', 'median']
+
+# default nodata of float targets
+DEFAULT_NODATA = float(numpy.finfo(numpy.float32).min)
+
+# nodata of count targets
+COUNT_NODATA = -1
+
+# largest number of pixels of all inputs held in memory at once, the
+# median needs the whole stack of a window
+_LARGEST_STACK = 2**24
+
+
+def reduce_stack(
+        raster_path_list, reduction_to_target_path_map, working_dir,
+        target_nodata=DEFAULT_NODATA, target_pixel_size=None,
+        bounding_box_mode='union', resample_method='near'):
+    """Reduce a stack of rasters to one or more per pixel statistics.
+
+    Parameters:
+        raster_path_list (list): paths to single band rasters, a pixel
+            contributes to a reduction if it isn't nodata or NaN.
+        reduction_to_target_path_map (dict): maps a reduction in
+            ``REDUCTION_LIST`` to the path of the raster to write it to.
+            Count targets are Int32 with ``COUNT_NODATA`` nodata, all others
+            are Float32.
+        working_dir (str): directory for the warped VRTs if the rasters
+            aren't on the same grid.
+        target_nodata (float): nodata of the float targets, written where
+            no raster has a valid pixel. If None those pixels are 0 in sum
+            targets and NaN in the others.
+        target_pixel_size (tuple): pixel size of the targets if the rasters
+            need aligning, defaults to the first raster's.
+        bounding_box_mode (str): 'union' or 'intersection' of the raster
+            extents if the rasters need aligning.
+        resample_method (str): GDAL resampling method used to align.
+
+    Returns:
+        None.
+
+    """
+    for reduction in reduction_to_target_path_map:
+        if reduction not in REDUCTION_LIST:
+            raise ValueError(
+                f'unknown reduction "{reduction}", expected one of '
+                f'{REDUCTION_LIST}')
+    aligned_path_list = align_stack(
+        raster_path_list, working_dir, target_pixel_size, bounding_box_mode,
+        resample_method)
+    nodata_list = [
+        geoprocessing.get_raster_info(path)['nodata'][0]
+        for path in aligned_path_list]
+
+    target_band_map = {}
+    target_raster_list = []
+    for reduction, target_path in reduction_to_target_path_map.items():
+        if reduction == 'count':
+            datatype, nodata = gdal.GDT_Int32, COUNT_NODATA
+        else:
+            datatype, nodata = gdal.GDT_Float32, target_nodata
+        geoprocessing.new_raster_from_base(
+            aligned_path_list[0], target_path, datatype, [nodata])
+        target_raster = gdal.OpenEx(
+            target_path, gdal.OF_RASTER | gdal.OF_UPDATE)
+        target_raster_list.append(target_raster)
+        target_band_map[reduction] = target_raster.GetRasterBand(1)
+
+    band_list = []
+    raster_list = []
+    for path in aligned_path_list:
+        raster = gdal.OpenEx(path, gdal.OF_RASTER)
+        raster_list.append(raster)
+        band_list.append(raster.GetRasterBand(1))
+
+    largest_block = max(2**16, _LARGEST_STACK // len(aligned_path_list))
+    for offset_dict in geoprocessing.iterblocks(
+            (aligned_path_list[0], 1), largest_block=largest_block,
+            offset_only=True):
+        result_map = reduce_arrays(
+            [band.ReadAsArray(**offset_dict) for band in band_list],
+            nodata_list, list(reduction_to_target_path_map), target_nodata)
+        for reduction, result in result_map.items():
+            target_band_map[reduction].WriteArray(
+                result, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+
+    band_list = None
+    raster_list = None
+    target_band_map = None
+    target_raster_list = None
+
+
+def reduce_arrays(array_list, nodata_list, reduction_list, target_nodata):
+    """Reduce a stack of same shape arrays pixel by pixel.
+
+    Parameters:
+        array_list (list): arrays of the same shape.
+        nodata_list (list): nodata of each array, may be None.
+        reduction_list (list): reductions from ``REDUCTION_LIST``.
+        target_nodata (float): value of pixels with no valid values in the
+            float results, see ``reduce_stack``.
+
+    Returns:
+        dict mapping each reduction to its result array, int32 for 'count'
+        and float32 otherwise.
+
+    """
+    shape = array_list[0].shape
+    count = numpy.zeros(shape, dtype=numpy.int32)
+    total = numpy.zeros(shape, dtype=numpy.float64)
+    need_moments = 'mean' in reduction_list or 'stdev' in reduction_list
+    if need_moments:
+        mean = numpy.zeros(shape, dtype=numpy.float64)
+        m2 = numpy.zeros(shape, dtype=numpy.float64)
+        delta = numpy.empty(shape, dtype=numpy.float64)
+    if 'min' in reduction_list:
+        min_array = numpy.full(shape, numpy.inf)
+    if 'max' in reduction_list:
+        max_array = numpy.full(shape, -numpy.inf)
+    if 'median' in reduction_list:
+        stack_array = numpy.full(
+            (len(array_list),) + shape, numpy.nan, dtype=numpy.float64)
+
+    for index, (array, nodata) in enumerate(zip(array_list, nodata_list)):
+        valid_mask = numpy.ones(shape, dtype=bool)
+        if nodata is not None:
+            valid_mask &= array != nodata
+        if numpy.issubdtype(array.dtype, numpy.floating):
+            valid_mask &= ~numpy.isnan(array)
+        numpy.add(count, 1, out=count, where=valid_mask)
+        numpy.add(total, array, out=total, where=valid_mask)
+        if need_moments:
+            # Welford: delta = x - mean, mean += delta / n,
+            # m2 += delta * (x - new mean)
+            numpy.subtract(array, mean, out=delta, where=valid_mask)
+            numpy.add(
+                mean, delta / numpy.maximum(count, 1), out=mean,
+                where=valid_mask)
+            numpy.multiply(delta, array - mean, out=delta, where=valid_mask)
+            numpy.add(m2, delta, out=m2, where=valid_mask)
+        if 'min' in reduction_list:
+            numpy.minimum(min_array, array, out=min_array, where=valid_mask)
+        if 'max' in reduction_list:
+            numpy.maximum(max_array, array, out=max_array, where=valid_mask)
+        if 'median' in reduction_list:
+            numpy.copyto(stack_array[index], array, where=valid_mask)
+
+    empty_mask = count == 0
+    result_map = {}
+    for reduction in reduction_list:
+        if reduction == 'count':
+            result = count.copy()
+            result[empty_mask] = COUNT_NODATA
+            result_map[reduction] = result
+            continue
+        if reduction == 'sum':
+            result = total
+        elif reduction == 'mean':
+            result = mean
+        elif reduction == 'stdev':
+            result = numpy.sqrt(m2 / numpy.maximum(count, 1))
+        elif reduction == 'min':
+            result = min_array
+        elif reduction == 'max':
+            result = max_array
+        else:
+            # all NaN pixels are empty and are set to nodata below
+            stack_array[:, empty_mask] = 0.0
+            result = numpy.nanmedian(stack_array, axis=0)
+        result = result.astype(numpy.float32)
+        if target_nodata is not None:
+            result[empty_mask] = target_nodata
+        elif reduction != 'sum':
+            result[empty_mask] = numpy.nan
+        result_map[reduction] = result
+    return result_map
+
+
+def align_stack(
+        raster_path_list, working_dir, target_pixel_size=None,
+        bounding_box_mode='union', resample_method='near'):
+    """Return paths to versions of rasters on the same grid.
+
+    Parameters:
+        raster_path_list (list): paths to rasters.
+        working_dir (str): directory to write warped VRTs to.
+        target_pixel_size (tuple): target pixel size, defaults to the first
+            raster's.
+        bounding_box_mode (str): 'union' or 'intersection'.
+        resample_method (str): GDAL resampling method.
+
+    Returns:
+        ``raster_path_list`` itself if every raster already has the same
+        geotransform and size, otherwise a parallel list of warped VRTs
+        that are resampled as they are read.
+
+    """
+    raster_info_list = [
+        geoprocessing.get_raster_info(path) for path in raster_path_list]
+    if target_pixel_size is None:
+        target_pixel_size = raster_info_list[0]['pixel_size']
+    if all([
+            tuple(raster_info['geotransform']) == tuple(
+                raster_info_list[0]['geotransform']) and
+            tuple(raster_info['raster_size']) == tuple(
+                raster_info_list[0]['raster_size']) and
+            tuple(raster_info['pixel_size']) == tuple(target_pixel_size)
+            for raster_info in raster_info_list]):
+        return raster_path_list
+
+    target_bounding_box = geoprocessing.merge_bounding_box_list(
+        [raster_info['bounding_box'] for raster_info in raster_info_list],
+        bounding_box_mode)
+    LOGGER.info(
+        f'reading {len(raster_path_list)} rasters through warped VRTs on '
+        f'{target_bounding_box}')
+    os.makedirs(working_dir, exist_ok=True)
+    vrt_path_list = []
+    for index, (path, raster_info) in enumerate(
+            zip(raster_path_list, raster_info_list)):
+        vrt_path = os.path.join(
+            working_dir, '%d_%s.vrt' % (
+                index, os.path.splitext(os.path.basename(path))[0]))
+        warp_options = {
+            'format': 'VRT',
+            'outputBounds': target_bounding_box,
+            'xRes': abs(target_pixel_size[0]),
+            'yRes': abs(target_pixel_size[1]),
+            'resampleAlg': resample_method,
+        }
+        if raster_info['nodata'][0] is not None:
+            warp_options['srcNodata'] = raster_info['nodata'][0]
+            warp_options['dstNodata'] = raster_info['nodata'][0]
+        gdal.Warp(vrt_path, path, options=gdal.WarpOptions(**warp_options))
+        vrt_path_list.append(vrt_path)
+    return vrt_path_list
@@ -0,0 +1,237 @@
+"""Exact raster percentiles by streaming histogram refinement.
+
+Every valid pixel is mapped to an unsigned integer key whose order matches
+the order of the pixel values. The first read histograms the top 16 bits of
+those keys, which is enough to locate the bucket that holds each requested
+rank. Later reads only look at pixels in those buckets and either collect
+them, if there are few enough to hold in memory, or histogram the next 16
+bits. Rasters of 16 bits or less resolve in one read, 32 bit rasters in at
+most two, and 64 bit rasters in at most four, though usually two since
+refinement stops once a bucket is small enough to collect; nothing is
+sorted or written to disk. Percentiles are defined the same way as
+``geoprocessing.raster_band_percentile`` so the two are interchangeable.
+"""
+import logging
+
+from ecoshard import geoprocessing
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+# number of key bits histogrammed per read
+_RADIX_BITS = 16
+
+# a bucket with at most this many pixels is collected and selected in memory
+# rather than refined with another histogram pass
+_MAX_COLLECT_VALUES = 2**24
+
+_LARGEST_BLOCK = 2**24
+
+
+def raster_band_percentiles(
+        path_band_to_percentile_list_map, largest_block=_LARGEST_BLOCK,
+        max_collect_values=_MAX_COLLECT_VALUES):
+    """Calculate exact percentiles of raster bands without sorting to disk.
+
+    As in ``geoprocessing.raster_band_percentile``, the percentile of ``p``
+    is the value of the ``i``th smallest valid pixel (0 indexed) for the
+    first ``i`` with ``100/n * i >= p``, or the largest valid pixel if there
+    is no such ``i``, where ``n`` is the number of valid pixels. Pixels
+    that are ``numpy.isclose`` to nodata or aren't finite are not valid.
+
+    Parameters:
+        path_band_to_percentile_list_map (dict): maps (raster path, band id)
+            tuples to a list of percentiles in [0, 100] to calculate.
+        largest_block (int): largest number of pixels to read at once.
+        max_collect_values (int): if a bucket holding a requested rank has
+            at most this many pixels they are gathered and selected in
+            memory rather than refined with another read.
+
+    Returns:
+        dict mapping each (raster path, band id) to a list of values, one
+        per requested percentile in the same order. A band with no valid
+        pixels maps to a list of None.
+
+    """
+    result_map = {}
+    for path_band, percentile_list in (
+            path_band_to_percentile_list_map.items()):
+        result_map[path_band] = _band_percentiles(
+            path_band, percentile_list, largest_block, max_collect_values)
+    return result_map
+
+
+def _band_percentiles(
+        path_band, percentile_list, largest_block, max_collect_values):
+    """Calculate exact percentiles of a single raster band."""
+    raster_info = geoprocessing.get_raster_info(path_band[0])
+    nodata = raster_info['nodata'][path_band[1]-1]
+    numpy_type = numpy.dtype(raster_info['numpy_type'])
+    key_bits = numpy_type.itemsize * 8
+
+    # first read: count valid pixels in each bucket of the top key bits
+    first_bits = min(_RADIX_BITS, key_bits)
+    histogram = numpy.zeros(2**first_bits, dtype=numpy.int64)
+    for key_array in _iter_valid_keys(path_band, nodata, largest_block):
+        histogram += numpy.bincount(
+            _key_bits(key_array, key_bits - first_bits, first_bits),
+            minlength=2**first_bits)
+    n_valid = int(histogram.sum())
+    if n_valid == 0:
+        LOGGER.warning('%s has no valid pixels', path_band)
+        return [None] * len(percentile_list)
+
+    # each target is [rank remaining in bucket, key prefix, resolved bits]
+    target_list = []
+    for percentile in percentile_list:
+        prefix, rank, _ = _locate_rank(
+            histogram, _percentile_rank(percentile, n_valid))
+        target_list.append([rank, prefix, first_bits])
+    bucket_count_map = {
+        (prefix, first_bits): int(histogram[prefix])
+        for _, prefix, _ in target_list}
+
+    n_reads = 1
+    while any([
+            resolved_bits < key_bits
+            for _, _, resolved_bits in target_list]):
+        # buckets that still need work, either collected or refined
+        collect_bucket_set = set()
+        refine_bucket_set = set()
+        for _, prefix, resolved_bits in target_list:
+            if resolved_bits == key_bits:
+                continue
+            if bucket_count_map[(prefix, resolved_bits)] <= (
+                    max_collect_values):
+                collect_bucket_set.add((prefix, resolved_bits))
+            else:
+                refine_bucket_set.add((prefix, resolved_bits))
+
+        collected_map = {bucket: [] for bucket in collect_bucket_set}
+        histogram_map = {}
+        for prefix, resolved_bits in refine_bucket_set:
+            histogram_map[(prefix, resolved_bits)] = numpy.zeros(
+                2**min(_RADIX_BITS, key_bits - resolved_bits),
+                dtype=numpy.int64)
+
+        n_reads += 1
+        for key_array in _iter_valid_keys(path_band, nodata, largest_block):
+            for (prefix, resolved_bits), key_list in collected_map.items():
+                key_list.append(key_array[_key_bits(
+                    key_array, key_bits - resolved_bits, resolved_bits) ==
+                    prefix])
+            for (prefix, resolved_bits), bucket_histogram in (
+                    histogram_map.items()):
+                next_bits = min(_RADIX_BITS, key_bits - resolved_bits)
+                bucket_key_array = key_array[_key_bits(
+                    key_array, key_bits - resolved_bits, resolved_bits) ==
+                    prefix]
+                bucket_histogram += numpy.bincount(
+                    _key_bits(
+                        bucket_key_array,
+                        key_bits - resolved_bits - next_bits, next_bits),
+                    minlength=2**next_bits)
+
+        for target in target_list:
+            rank, prefix, resolved_bits = target
+            bucket = (prefix, resolved_bits)
+            if bucket in collected_map:
+                bucket_key_array = numpy.concatenate(collected_map[bucket])
+                target[:] = [
+                    0, numpy.partition(bucket_key_array, rank)[rank],
+                    key_bits]
+            elif bucket in histogram_map:
+                next_bits = min(_RADIX_BITS, key_bits - resolved_bits)
+                sub_prefix, rank, sub_count = _locate_rank(
+                    histogram_map[bucket], rank)
+                prefix = (prefix << next_bits) | sub_prefix
+                resolved_bits += next_bits
+                target[:] = [rank, prefix, resolved_bits]
+                bucket_count_map[(prefix, resolved_bits)] = sub_count
+
+    LOGGER.debug(
+        'resolved %d percentiles of %s in %d reads', len(percentile_list),
+        path_band, n_reads)
+    key_array = numpy.array(
+        [prefix for _, prefix, _ in target_list],
+        dtype=numpy.dtype('u%d' % numpy_type.itemsize))
+    return [
+        value.item() for value in _keys_to_values(key_array, numpy_type)]
+
+
+def _percentile_rank(percentile, n_valid):
+    """Return the 0 based rank of ``percentile`` among ``n_valid`` values.
+
+    This is the first ``i`` with ``100/n_valid * i >= percentile``, found
+    with the same float arithmetic ``geoprocessing.raster_band_percentile``
+    uses so boundary ranks agree, or the last rank if there is none.
+
+    """
+    step_size = 100.0 / n_valid
+    rank = max(0, int(numpy.ceil(percentile / step_size)))
+    while rank > 0 and step_size * (rank - 1) >= percentile:
+        rank -= 1
+    while rank < n_valid and step_size * rank < percentile:
+        rank += 1
+    return min(rank, n_valid - 1)
+
+
+def _locate_rank(histogram, rank):
+    """Return (bucket index, rank within bucket, bucket count) of ``rank``."""
+    cumulative_count = numpy.cumsum(histogram)
+    bucket_index = int(numpy.searchsorted(
+        cumulative_count, rank, side='right'))
+    bucket_start = 0
+    if bucket_index > 0:
+        bucket_start = int(cumulative_count[bucket_index-1])
+    return bucket_index, rank - bucket_start, int(histogram[bucket_index])
+
+
+def _key_bits(key_array, shift, n_bits):
+    """Return the ``n_bits`` of ``key_array`` above ``shift`` as int64."""
+    key_type = key_array.dtype.type
+    return ((key_array >> key_type(shift)) & key_type(2**n_bits - 1)).astype(
+        numpy.int64)
+
+
+def _iter_valid_keys(path_band, nodata, largest_block):
+    """Yield order preserving keys of the valid pixels of each block."""
+    for _, array in geoprocessing.iterblocks(
+            path_band, largest_block=largest_block):
+        valid_mask = numpy.ones(array.shape, dtype=bool)
+        if nodata is not None:
+            valid_mask &= ~numpy.isclose(array, nodata)
+        if numpy.issubdtype(array.dtype, numpy.floating):
+            valid_mask &= numpy.isfinite(array)
+        yield _values_to_keys(array[valid_mask])
+
+
+def _values_to_keys(value_array):
+    """Map values to unsigned integers that sort in the same order.
+
+    Floats flip every bit of negative values and only the sign bit of
+    positive ones, signed integers flip the sign bit, unsigned integers are
+    already ordered.
+
+    """
+    itemsize = value_array.dtype.itemsize
+    key_type = numpy.dtype('u%d' % itemsize)
+    sign_bit = key_type.type(1 << (itemsize * 8 - 1))
+    key_array = value_array.view(key_type)
+    if numpy.issubdtype(value_array.dtype, numpy.floating):
+        return numpy.where(
+            key_array & sign_bit, ~key_array, key_array | sign_bit)
+    if numpy.issubdtype(value_array.dtype, numpy.signedinteger):
+        return key_array ^ sign_bit
+    return key_array
+
+
+def _keys_to_values(key_array, numpy_type):
+    """Invert ``_values_to_keys`` for keys of ``numpy_type`` values."""
+    sign_bit = key_array.dtype.type(1 << (numpy_type.itemsize * 8 - 1))
+    if numpy.issubdtype(numpy_type, numpy.floating):
+        key_array = numpy.where(
+            key_array & sign_bit, key_array ^ sign_bit, ~key_array)
+    elif numpy.issubdtype(numpy_type, numpy.signedinteger):
+        key_array = key_array ^ sign_bit
+    return key_array.view(numpy_type)
@@ -0,0 +1,43 @@
+"""Tests of the columnar CDF result store."""
+import cdf_result_store
+
+PERCENTILE_LIST = list(range(0, 101, 1))
+
+
+def _write_feature(database_path, aggregate_vector_id, scale):
+    """Store a 'CHN' feature whose values are the percentiles * scale."""
+    percentile_value_list = [
+        percentile * scale for percentile in PERCENTILE_LIST]
+    cdf_list = [
+        float(sum(percentile_value_list[index:]))
+        for index in range(len(PERCENTILE_LIST))]
+    cdf_result_store.write_feature_results(
+        database_path, 'raster', aggregate_vector_id, 'CHN',
+        PERCENTILE_LIST, [
+            (False, percentile_value_list, cdf_list),
+            (True, percentile_value_list, cdf_list)])
+    return percentile_value_list, cdf_list
+
+
+def test_results_are_selected_by_aggregate_vector(tmp_path):
+    """A raster stored under two vectors keeps their features apart."""
+    database_path = str(tmp_path / 'results.db')
+    iso3_result = _write_feature(database_path, 'world_borders', 1.0)
+    sov_result = _write_feature(database_path, 'eez', 3.0)
+    for aggregate_vector_id, expected_result in [
+            ('world_borders', iso3_result), ('eez', sov_result)]:
+        for nodata0 in (False, True):
+            feature_result_map = cdf_result_store.get_feature_results(
+                database_path, 'raster', aggregate_vector_id, nodata0)
+            assert feature_result_map == {'CHN': tuple(
+                [float(x) for x in value_list]
+                for value_list in expected_result)}
+        threshold_list = cdf_result_store.get_cdf_threshold(
+            database_path, 'raster', aggregate_vector_id, 0.5, True)
+        assert len(threshold_list) == 1
+        feature_id, percentile, percentile_value, cdf_value = (
+            threshold_list[0])
+        assert feature_id == 'CHN'
+        assert cdf_value < 0.5 * expected_result[1][0]
+        assert percentile_value == expected_result[0][int(percentile)]
+    cdf_result_store.close_connection(database_path)
@@ -0,0 +1,248 @@
+"""Tests of ecoshard_download against a local HTTP server."""
+import hashlib
+import http.server
+import multiprocessing
+import os
+import re
+import threading
+import time
+import urllib.error
+
+import pytest
+
+pytest.importorskip('retrying')
+import ecoshard_download  # noqa: E402
+
+
+class _EcoshardServer(http.server.ThreadingHTTPServer):
+    """Serves ``content_map`` with ranges and scripted failures."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _EcoshardHandler)
+        self.content_map = {}
+        # each entry is (method, status) and fails the next request of that
+        # method with that status
+        self.failure_list = []
+        # if set, the next GET only sends this many bytes of its body
+        self.truncate_bytes = None
+        self.refuse_head = False
+        self.request_list = []
+        self.lock = threading.Lock()
+        # seconds each request holds its connection before responding
+        self.delay = 0.0
+        self.active_count = 0
+        self.peak_active_count = 0
+
+    def url(self, name):
+        """Return the url of ``name`` on this server."""
+        return 'http://127.0.0.1:%d/%s' % (self.server_address[1], name)
+
+
+class _EcoshardHandler(http.server.BaseHTTPRequestHandler):
+    """Handles HEAD and GET of byte ranges of the server's content."""
+
+    def do_HEAD(self):
+        """Send the size and range support of a file."""
+        content = self._start('HEAD')
+        if content is None:
+            return
+        if self.server.refuse_head:
+            self.send_error(405)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        """Send a file or the byte range in the Range header."""
+        content = self._start('GET')
+        if content is None:
+            return
+        start, end = 0, len(content)
+        range_match = re.match(
+            r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if range_match:
+            start = int(range_match.group(1))
+            if range_match.group(2):
+                end = int(range_match.group(2)) + 1
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', 'bytes %d-%d/%d' % (
+                    start, end-1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        with self.server.lock:
+            truncate_bytes = self.server.truncate_bytes
+            self.server.truncate_bytes = None
+        if truncate_bytes is not None:
+            self.wfile.write(content[start:start+truncate_bytes])
+            self.close_connection = True
+            return
+        self.wfile.write(content[start:end])
+
+    def _start(self, method):
+        """Record a request, return its content or None if it failed."""
+        with self.server.lock:
+            self.server.request_list.append(
+                (method, self.headers.get('Range')))
+            self.server.active_count += 1
+            self.server.peak_active_count = max(
+                self.server.peak_active_count, self.server.active_count)
+        # the connection is only counted as active before any response is
+        # sent, so a client can't have released it while it's counted
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.active_count -= 1
+            for failure in self.server.failure_list:
+                if failure[0] == method:
+                    self.server.failure_list.remove(failure)
+                    self.send_error(failure[1])
+                    return None
+        content = self.server.content_map.get(self.path.lstrip('/'))
+        if content is None:
+            self.send_error(404)
+        return content
+
+    def log_message(self, *args):
+        """Don't log requests."""
+
+
+@pytest.fixture
+def server():
+    """Yield an ``_EcoshardServer`` running in a thread."""
+    ecoshard_server = _EcoshardServer()
+    thread = threading.Thread(target=ecoshard_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield ecoshard_server
+    ecoshard_server.shutdown()
+    ecoshard_server.server_close()
+
+
+def _add_ecoshard(server, size, md5_hash=None):
+    """Serve ``size`` random bytes under an ecoshard name, return both."""
+    content = os.urandom(size)
+    name = 'shard_md5_%s.tif' % (
+        md5_hash or hashlib.md5(content).hexdigest())
+    server.content_map[name] = content
+    return name, content
+
+
+def _get_list(server):
+    """Return the Range header of every GET the server received."""
+    return [
+        range_header for method, range_header in server.request_list
+        if method == 'GET']
+
+
+def test_download_verifies_md5(server, tmp_path):
+    """A small file downloads in one part and keeps no part files."""
+    name, content = _add_ecoshard(server, 10000)
+    target_path = str(tmp_path / name)
+    ecoshard_download.download_url(server.url(name), target_path)
+    with open(target_path, 'rb') as target_file:
+        assert target_file.read() == content
+    assert os.listdir(tmp_path) == [name]
+
+
+def test_segmented_download(server, tmp_path, monkeypatch):
+    """Large files are fetched as parallel ranges and concatenated."""
+    monkeypatch.setattr(ecoshard_download, '_SEGMENT_THRESHOLD', 1000)
+    name, content = _add_ecoshard(server, 10001)
+    target_path = str(tmp_path / name)
+    ecoshard_download.download_url(
+        server.url(name), target_path, n_segments=4)
+    with open(target_path, 'rb') as target_file:
+        assert target_file.read() == content
+    assert sorted(_get_list(server)) == [
+        'bytes=0-2500', 'bytes=2501-5001', 'bytes=5002-7502',
+        'bytes=7503-10000']
+    assert os.listdir(tmp_path) == [name]
+
+
+def test_resumes_from_part_file(server, tmp_path):
+    """Bytes already in the part file are not downloaded again."""
+    name, content = _add_ecoshard(server, 10000)
+    target_path = str(tmp_path / name)
+    with open(target_path + '.part', 'wb') as part_file:
+        part_file.write(content[:4000])
+    ecoshard_download.download_url(server.url(name), target_path)
+    with open(target_path, 'rb') as target_file:
+        assert target_file.read() == content
+    assert _get_list(server) == ['bytes=4000-9999']
+
+
+def test_dropped_connection_resumes(server, tmp_path):
+    """A response cut short is retried from where it stopped."""
+    name, content = _add_ecoshard(server, 10000)
+    server.truncate_bytes = 3000
+    target_path = str(tmp_path / name)
+    ecoshard_download.download_url(server.url(name), target_path)
+    with open(target_path, 'rb') as target_file:
+        assert target_file.read() == content
+    assert _get_list(server) == ['bytes=0-9999', 'bytes=3000-9999']
+
+
+def test_transient_errors_are_retried(server, tmp_path):
+    """Server errors of the probe and of a fetch are retried."""
+    name, content = _add_ecoshard(server, 10000)
+    server.failure_list = [('HEAD', 503), ('GET', 502)]
+    target_path = str(tmp_path / name)
+    ecoshard_download.download_url(server.url(name), target_path)
+    with open(target_path, 'rb') as target_file:
+        assert target_file.read() == content
+    assert [method for method, _ in server.request_list] == [
+        'HEAD', 'HEAD', 'GET', 'GET']
+
+
+def test_refused_head_falls_back_to_plain_download(server, tmp_path):
+    """A server that refuses HEAD still serves the whole file."""
+    name, content = _add_ecoshard(server, 10000)
+    server.refuse_head = True
+    target_path = str(tmp_path / name)
+    ecoshard_download.download_url(server.url(name), target_path)
+    with open(target_path, 'rb') as target_file:
+        assert target_file.read() == content
+    assert _get_list(server) == [None]
+
+
+def test_md5_mismatch_raises(server, tmp_path):
+    """A wrong md5 raises and leaves neither a target nor part files."""
+    name, _ = _add_ecoshard(server, 10000, md5_hash='0'*32)
+    with pytest.raises(ValueError):
+        ecoshard_download.download_url(
+            server.url(name), str(tmp_path / name))
+    assert os.listdir(tmp_path) == []
+
+
+def test_missing_file_is_not_retried(server, tmp_path):
+    """A 404 fails on the first attempt."""
+    with pytest.raises(urllib.error.HTTPError):
+        ecoshard_download.download_url(
+            server.url('missing.tif'), str(tmp_path / 'missing.tif'))
+    assert len(server.request_list) == 2
+
+
+def test_connections_are_bounded_across_processes(server, tmp_path):
+    """Processes downloading at once share one connection limit."""
+    server.delay = 0.5
+    lock_dir = str(tmp_path / 'locks')
+    process_list = []
+    for index in range(3):
+        name, _ = _add_ecoshard(server, 10000 + index)
+        target_dir = tmp_path / str(index)
+        target_dir.mkdir()
+        process = multiprocessing.get_context('spawn').Process(
+            target=ecoshard_download.download_url,
+            args=(server.url(name), str(target_dir / name)),
+            kwargs={'max_connections': 2, 'connection_lock_dir': lock_dir})
+        process.start()
+        process_list.append(process)
+    for process in process_list:
+        process.join()
+        assert process.exitcode == 0
+    assert len(server.request_list) == 3 * 2
+    assert server.peak_active_count == 2
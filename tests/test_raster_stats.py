@@ -0,0 +1,72 @@
+"""Tests of raster_stats percentiles against numpy."""
+import importlib
+
+import numpy
+import pytest
+
+pytest.importorskip('pygeoprocessing')
+raster_stats = importlib.import_module('raster_stats.__main__')
+
+NODATA = -1.0
+
+
+def _patch_raster(monkeypatch, array, n_block_rows):
+    """Make raster_stats read ``array`` in blocks of ``n_block_rows``."""
+    monkeypatch.setattr(
+        raster_stats.pygeoprocessing, 'get_raster_info',
+        lambda raster_path: {'nodata': [NODATA]}, raising=False)
+    monkeypatch.setattr(
+        raster_stats.pygeoprocessing, 'iterblocks',
+        lambda band_path, largest_block: (
+            (None, array[row:row+n_block_rows])
+            for row in range(0, array.shape[0], n_block_rows)),
+        raising=False)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_exact_percentiles_match_numpy(monkeypatch, seed):
+    """Exact percentiles equal numpy's at ``min(int(p/100*n), n-1)``."""
+    rng = numpy.random.default_rng(seed)
+    n_rows = int(rng.integers(1, 80))
+    n_cols = int(rng.integers(1, 80))
+    distribution = seed % 3
+    if distribution == 0:
+        array = rng.normal(rng.normal(0, 10), 1, (n_rows, n_cols))
+    elif distribution == 1:
+        array = rng.gamma(2.0, 10.0, (n_rows, n_cols))
+    else:
+        array = rng.integers(-50, 50, (n_rows, n_cols)).astype(numpy.float64)
+    array[rng.random(array.shape) < 0.1] = NODATA
+    _patch_raster(monkeypatch, array, int(rng.integers(1, 20)))
+
+    valid_array = numpy.sort(array[array != NODATA])
+    percentile_list = [0, 1, 5, 25, 50, 75, 95, 99, 100]
+    result = raster_stats.raster_stats(
+        'synthetic', percentile_list,
+        n_histogram_bins=int(rng.integers(2, 64)), exact_percentiles=True)
+    if valid_array.size == 0:
+        assert result['count'] == 0
+        return
+    expected_list = [
+        valid_array[min(
+            int(percentile/100.0*valid_array.size), valid_array.size-1)]
+        for percentile in percentile_list]
+    assert [float(x) for x in result['percentile_list']] == [
+        float(x) for x in expected_list]
+    assert result['count'] == valid_array.size
+
+
+@pytest.mark.parametrize('n_bins', [2, 3, 1000])
+def test_first_block_fills_every_bin_range(n_bins):
+    """The first block spans all bins and its maximum is in the last one."""
+    rng = numpy.random.default_rng(n_bins)
+    valid_array = rng.gamma(2.0, 10.0, 100000)
+    histogram = raster_stats._update_histogram(None, valid_array, n_bins)
+    count_array = histogram['count']
+    assert count_array.size == n_bins + n_bins % 2
+    assert count_array[0] > 0 and count_array[-1] > 0
+    assert histogram['origin'] == valid_array.min()
+    assert valid_array.max() < (
+        histogram['origin'] + count_array.size * histogram['width'])
+    assert histogram['width'] < 2 * (
+        valid_array.max() - valid_array.min()) / count_array.size
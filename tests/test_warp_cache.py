@@ -0,0 +1,73 @@
+"""Tests of the warp cache eviction in raster_calculations_core."""
+import os
+
+import pytest
+
+pytest.importorskip('ecoshard')
+pytest.importorskip('osgeo')
+import raster_calculations_core  # noqa: E402
+
+ENTRY_BYTES = 1000
+
+
+def _add_linked_entry(tmp_path, name, mtime):
+    """Cache an entry and link it from an expression churn dir."""
+    cache_path = str(tmp_path / 'warp_cache' / f'{name}.tif')
+    with open(cache_path, 'wb') as cache_file:
+        cache_file.write(b'0' * ENTRY_BYTES)
+    os.utime(cache_path, (mtime, mtime))
+    churn_dir = tmp_path / 'processed_rasters_dir' / name
+    churn_dir.mkdir()
+    link_path = str(churn_dir / f'{name}.tif')
+    os.link(cache_path, link_path)
+    pickle_path = str(
+        churn_dir / raster_calculations_core._PROCESSED_RASTER_LIST_FILENAME)
+    with open(pickle_path, 'wb') as pickle_file:
+        pickle_file.write(b'')
+    return cache_path, link_path, pickle_path
+
+
+def _cache_bytes(tmp_path):
+    """Return the bytes on disk of the cache and its links."""
+    inode_to_bytes = {}
+    for dir_path, _, file_list in os.walk(str(tmp_path)):
+        for filename in file_list:
+            file_stat = os.stat(os.path.join(dir_path, filename))
+            inode_to_bytes[(file_stat.st_dev, file_stat.st_ino)] = (
+                file_stat.st_size)
+    return sum(inode_to_bytes.values())
+
+
+def test_linked_entries_are_evicted_below_budget(tmp_path):
+    """Linked entries count and are evicted oldest first with their links."""
+    (tmp_path / 'warp_cache').mkdir()
+    (tmp_path / 'processed_rasters_dir').mkdir()
+    entry_list = [
+        _add_linked_entry(tmp_path, f'entry_{index}', 1000 + index)
+        for index in range(4)]
+    assert _cache_bytes(tmp_path) == 4 * ENTRY_BYTES
+
+    # the oldest entry is in use by the expression being preprocessed
+    raster_calculations_core._evict_warp_cache(
+        str(tmp_path / 'warp_cache'), int(2.5 * ENTRY_BYTES),
+        {entry_list[0][0]}, str(tmp_path / 'processed_rasters_dir'))
+
+    assert _cache_bytes(tmp_path) <= 2.5 * ENTRY_BYTES
+    for entry_index, path_tuple in enumerate(entry_list):
+        for path in path_tuple:
+            assert os.path.exists(path) == (entry_index in (0, 3))
+
+
+def test_cache_under_budget_is_kept(tmp_path):
+    """Nothing is removed when the cache fits its budget."""
+    (tmp_path / 'warp_cache').mkdir()
+    (tmp_path / 'processed_rasters_dir').mkdir()
+    entry_list = [
+        _add_linked_entry(tmp_path, f'entry_{index}', 1000 + index)
+        for index in range(2)]
+    raster_calculations_core._evict_warp_cache(
+        str(tmp_path / 'warp_cache'), 2 * ENTRY_BYTES, set(),
+        str(tmp_path / 'processed_rasters_dir'))
+    for path_tuple in entry_list:
+        for path in path_tuple:
+            assert os.path.exists(path)
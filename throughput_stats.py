@@ -1,29 +1,453 @@
-"""Test how fast we can read and write."""
+"""Benchmark raster I/O and processing throughput on this host.
+
+Synthetic rasters are generated locally for every combination of data
+type, layout (tiled or striped), compression, and density (dense, or sparse
+with most blocks never written) so runs are reproducible on any machine.
+Each raster is then timed for:
+
+    * read: reading every window, with a process pool when there is more
+      than one worker,
+    * write: writing a copy window by window with the same creation options,
+    * raster_calculator: ``geoprocessing.raster_calculator`` of a two input
+      expression,
+    * warp: ``gdal.Warp`` to twice the pixel size with ``NUM_THREADS`` set
+      to the worker count,
+    * percentile: ``streaming_percentile.raster_band_percentiles``,
+
+across block sizes (``largest_block``), GDAL cache sizes
+(``gdal.SetCacheMax``), and worker counts. Every measurement is written as a
+JSON line with the host, library versions, and parameters so results from
+different hosts and commits can be compared to pick settings and catch
+regressions. Rasters are read warm from the OS page cache after they are
+generated, use ``--repeat`` to average out noise.
+"""
+import argparse
+import datetime
+import json
 import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
 import time
 
 from ecoshard import geoprocessing
-
+from osgeo import gdal
+from osgeo import osr
+import numpy
+import streaming_percentile
 
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=logging.INFO,
     format=(
         '%(asctime)s (%(relativeCreated)d) %(levelname)s %(name)s'
-        ' [%(pathname)s.%(funcName)s:%(lineno)d] %(message)s'))
+        ' [%(pathname)s.%(funcName)s:%(lineno)d] %(message)s'),
+    stream=sys.stdout)
 LOGGER = logging.getLogger(__name__)
 
+BENCHMARK_LIST = ['read', 'write', 'raster_calculator', 'warp', 'percentile']
 
-if __name__ == "__main__":
-    path = r"C:\Users\richp\Downloads\impact_obs_10m_2017_compressed_md5_99376e.tif"
-    for exp in reversed(range(20, 31)):
+_DTYPE_MAP = {
+    'uint8': (gdal.GDT_Byte, numpy.uint8, 255),
+    'int16': (gdal.GDT_Int16, numpy.int16, -9999),
+    'int32': (gdal.GDT_Int32, numpy.int32, -9999),
+    'float32': (gdal.GDT_Float32, numpy.float32, -1.0),
+    'float64': (gdal.GDT_Float64, numpy.float64, -1.0),
+}
+
+# block size of tiled rasters and rows per strip of striped ones
+_TILE_SIZE = 256
+
+# fraction of blocks written in sparse rasters
+_SPARSE_FRACTION = 0.05
+
+# fraction of written pixels that are nodata
+_NODATA_FRACTION = 0.1
+
+
+def make_synthetic_raster(
+        raster_path, n_rows, n_cols, dtype_id, compression, layout,
+        density, seed=1):
+    """Write a raster of random values with nodata holes.
+
+    Parameters:
+        raster_path (str): path to the GeoTIFF to create.
+        n_rows (int): number of rows.
+        n_cols (int): number of columns.
+        dtype_id (str): key of ``_DTYPE_MAP``.
+        compression (str): GeoTIFF COMPRESS option, e.g. 'NONE' or 'ZSTD'.
+        layout (str): 'tiled' for 256x256 tiles or 'striped' for 256 row
+            strips.
+        density (str): 'dense' to write every block or 'sparse' to only
+            write ``_SPARSE_FRACTION`` of them and leave the rest empty.
+        seed (int): random seed.
+
+    Returns:
+        None.
+
+    """
+    gdal_type, numpy_type, nodata = _DTYPE_MAP[dtype_id]
+    rng = numpy.random.default_rng(seed)
+    driver = gdal.GetDriverByName('GTiff')
+    raster = driver.Create(
+        raster_path, n_cols, n_rows, 1, gdal_type,
+        options=creation_options(
+            compression, layout, density == 'sparse',
+            numpy.issubdtype(numpy_type, numpy.floating)))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    raster.SetProjection(srs.ExportToWkt())
+    raster.SetGeoTransform([-180, 1/360, 0, 90, 0, -1/360])
+    band = raster.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    block_cols = _TILE_SIZE if layout == 'tiled' else n_cols
+    for yoff in range(0, n_rows, _TILE_SIZE):
+        win_ysize = min(_TILE_SIZE, n_rows - yoff)
+        for xoff in range(0, n_cols, block_cols):
+            win_xsize = min(block_cols, n_cols - xoff)
+            if density == 'sparse' and rng.random() >= _SPARSE_FRACTION:
+                continue
+            if numpy.issubdtype(numpy_type, numpy.floating):
+                array = rng.gamma(2.0, 10.0, (win_ysize, win_xsize))
+            else:
+                array = rng.integers(0, 100, (win_ysize, win_xsize))
+            array = array.astype(numpy_type)
+            array[rng.random(array.shape) < _NODATA_FRACTION] = nodata
+            band.WriteArray(array, xoff=xoff, yoff=yoff)
+    band = None
+    raster = None
+
+
+def creation_options(compression, layout, sparse, floating):
+    """Return GeoTIFF creation options for a synthetic raster.
+
+    Parameters:
+        compression (str): GeoTIFF COMPRESS option.
+        layout (str): 'tiled' or 'striped'.
+        sparse (bool): if True, allow unwritten blocks.
+        floating (bool): True for floating point rasters, which use the
+            floating point predictor when compressed.
+
+    Returns:
+        list of creation option strings.
+
+    """
+    option_list = ['BIGTIFF=YES', f'COMPRESS={compression}']
+    if layout == 'tiled':
+        option_list += [
+            'TILED=YES', f'BLOCKXSIZE={_TILE_SIZE}',
+            f'BLOCKYSIZE={_TILE_SIZE}']
+    else:
+        option_list += ['TILED=NO', f'BLOCKYSIZE={_TILE_SIZE}']
+    if compression in ('LZW', 'DEFLATE', 'ZSTD'):
+        option_list.append('PREDICTOR=3' if floating else 'PREDICTOR=2')
+    if sparse:
+        option_list.append('SPARSE_OK=TRUE')
+    return option_list
+
+
+def supported_compression_list(compression_list):
+    """Return the compressions this GDAL build's GeoTIFF driver supports."""
+    option_list_xml = gdal.GetDriverByName('GTiff').GetMetadataItem(
+        'DMD_CREATIONOPTIONLIST')
+    supported_list = []
+    for compression in compression_list:
+        if compression == 'NONE' or compression in option_list_xml:
+            supported_list.append(compression)
+        else:
+            LOGGER.warning(f'GeoTIFF driver has no {compression}, skipping')
+    return supported_list
+
+
+def time_read(raster_path, largest_block, n_workers, cache_bytes):
+    """Time reading every window of a raster, return (seconds, n_pixels)."""
+    offset_dict_list = list(geoprocessing.iterblocks(
+        (raster_path, 1), largest_block=largest_block, offset_only=True))
+    if n_workers <= 1:
         start_time = time.time()
-        largest_block = 2**exp
-        for _ in geoprocessing.iterblocks(
-                (path, 1), offset_only=True, largest_block=largest_block):
-            pass
-        print(f'offset,{time.time()-start_time:.2f},{exp}')
+        n_pixels = _read_windows((raster_path, offset_dict_list))
+        return time.time() - start_time, n_pixels
+    chunk_list = [
+        (raster_path, list(offset_dict_array))
+        for offset_dict_array in numpy.array_split(
+            numpy.array(offset_dict_list, dtype=object),
+            min(len(offset_dict_list), n_workers * 4))
+        if len(offset_dict_array) > 0]
+    with multiprocessing.Pool(
+            n_workers, initializer=gdal.SetCacheMax,
+            initargs=(cache_bytes,)) as pool:
         start_time = time.time()
-        for _ in geoprocessing.iterblocks(
-                (path, 1), largest_block=largest_block):
-            pass
-        print(f'iterblocks,{time.time()-start_time:.2f},{exp}')
+        n_pixels = sum(pool.map(_read_windows, chunk_list))
+        return time.time() - start_time, n_pixels
+
+
+def _read_windows(path_offset_dict_list):
+    """Read a list of windows of a raster and return the pixels read."""
+    raster_path, offset_dict_list = path_offset_dict_list
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    n_pixels = 0
+    for offset_dict in offset_dict_list:
+        n_pixels += band.ReadAsArray(**offset_dict).size
+    band = None
+    raster = None
+    return n_pixels
+
+
+def time_write(raster_path, target_path, largest_block, option_list):
+    """Time copying a raster window by window, return (seconds, n_pixels).
+
+    Windows are read before the clock starts so only writing is timed.
+
+    """
+    raster_info = geoprocessing.get_raster_info(raster_path)
+    window_list = [
+        (offset_dict, array) for offset_dict, array in
+        geoprocessing.iterblocks(
+            (raster_path, 1), largest_block=largest_block)]
+    start_time = time.time()
+    n_cols, n_rows = raster_info['raster_size']
+    driver = gdal.GetDriverByName('GTiff')
+    target_raster = driver.Create(
+        target_path, n_cols, n_rows, 1, raster_info['datatype'],
+        options=option_list)
+    target_band = target_raster.GetRasterBand(1)
+    target_band.SetNoDataValue(raster_info['nodata'][0])
+    for offset_dict, array in window_list:
+        target_band.WriteArray(
+            array, xoff=offset_dict['xoff'], yoff=offset_dict['yoff'])
+    target_band = None
+    target_raster = None
+    return time.time() - start_time, n_cols * n_rows
+
+
+def time_raster_calculator(raster_path, target_path, largest_block):
+    """Time a two input raster_calculator, return (seconds, n_pixels)."""
+    nodata = geoprocessing.get_raster_info(raster_path)['nodata'][0]
+    target_nodata = -1.0
+
+    def _op(array_a, array_b):
+        """Return a*2+b where both are valid."""
+        result = numpy.full(array_a.shape, target_nodata, numpy.float32)
+        valid_mask = (array_a != nodata) & (array_b != nodata)
+        result[valid_mask] = array_a[valid_mask]*2 + array_b[valid_mask]
+        return result
+
+    n_cols, n_rows = geoprocessing.get_raster_info(raster_path)[
+        'raster_size']
+    start_time = time.time()
+    geoprocessing.raster_calculator(
+        [(raster_path, 1), (raster_path, 1)], _op, target_path,
+        gdal.GDT_Float32, target_nodata, calc_raster_stats=False,
+        largest_block=largest_block)
+    return time.time() - start_time, n_cols * n_rows
+
+
+def time_warp(raster_path, target_path, n_workers):
+    """Time warping to twice the pixel size, return (seconds, n_pixels)."""
+    raster_info = geoprocessing.get_raster_info(raster_path)
+    n_cols, n_rows = raster_info['raster_size']
+    start_time = time.time()
+    gdal.Warp(target_path, raster_path, options=gdal.WarpOptions(
+        format='GTiff', xRes=abs(raster_info['pixel_size'][0])*2,
+        yRes=abs(raster_info['pixel_size'][1])*2, resampleAlg='near',
+        multithread=n_workers > 1,
+        warpOptions=[f'NUM_THREADS={n_workers}'],
+        creationOptions=['TILED=YES', 'BIGTIFF=YES']))
+    return time.time() - start_time, n_cols * n_rows
+
+
+def time_percentile(raster_path, largest_block):
+    """Time exact 1/50/99th percentiles, return (seconds, n_pixels)."""
+    n_cols, n_rows = geoprocessing.get_raster_info(raster_path)[
+        'raster_size']
+    start_time = time.time()
+    streaming_percentile.raster_band_percentiles(
+        {(raster_path, 1): [1, 50, 99]}, largest_block=largest_block)
+    return time.time() - start_time, n_cols * n_rows
+
+
+def host_info():
+    """Return a dict describing this host and its library versions."""
+    return {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'python_version': platform.python_version(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'gdal_version': gdal.__version__,
+        'numpy_version': numpy.__version__,
+    }
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=(
+        'Benchmark raster read, write, raster_calculator, warp and '
+        'percentile throughput on synthetic rasters.'))
+    parser.add_argument(
+        '--benchmarks', nargs='+', default=BENCHMARK_LIST,
+        choices=BENCHMARK_LIST, help='benchmarks to run')
+    parser.add_argument(
+        '--n_rows', type=int, default=8192, help='rows of synthetic rasters')
+    parser.add_argument(
+        '--n_cols', type=int, default=8192, help='cols of synthetic rasters')
+    parser.add_argument(
+        '--dtypes', nargs='+', default=['float32'], choices=list(_DTYPE_MAP),
+        help='data types of synthetic rasters')
+    parser.add_argument(
+        '--compressions', nargs='+',
+        default=['NONE', 'LZW', 'DEFLATE', 'ZSTD'],
+        help='GeoTIFF compressions of synthetic rasters')
+    parser.add_argument(
+        '--layouts', nargs='+', default=['tiled'],
+        choices=['tiled', 'striped'], help='layouts of synthetic rasters')
+    parser.add_argument(
+        '--densities', nargs='+', default=['dense', 'sparse'],
+        choices=['dense', 'sparse'], help=(
+            'dense rasters have every block written, sparse rasters only '
+            f'{_SPARSE_FRACTION*100:.0f}%% of them'))
+    parser.add_argument(
+        '--raster_path', nargs='*', default=[], help=(
+            'existing rasters to benchmark along with the synthetic ones, '
+            'they are not used for the write benchmark'))
+    parser.add_argument(
+        '--block_exponents', nargs='+', type=int, default=[20, 22, 24],
+        help='benchmark largest_block of 2**exponent pixels')
+    parser.add_argument(
+        '--cache_mb', nargs='+', type=int, default=[64, 512],
+        help='gdal.SetCacheMax sizes in MB')
+    parser.add_argument(
+        '--n_workers', nargs='+', type=int,
+        default=sorted({1, multiprocessing.cpu_count()}),
+        help='worker counts for the read and warp benchmarks')
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='times to repeat every measurement')
+    parser.add_argument(
+        '--output_path', help=(
+            'path to the JSON lines results, defaults to '
+            'throughput_stats_<host>_<time>.jsonl in the current directory'))
+    parser.add_argument(
+        '--workspace_dir', help=(
+            'directory for the synthetic rasters, defaults to a temporary '
+            'directory in the current directory that is removed afterwards'))
+    args = parser.parse_args()
+
+    run_time = datetime.datetime.now()
+    host_info_map = host_info()
+    output_path = args.output_path
+    if output_path is None:
+        output_path = (
+            f'throughput_stats_{host_info_map["hostname"]}_'
+            f'{run_time.strftime("%Y_%m_%d_%H_%M_%S")}.jsonl')
+    if args.workspace_dir is None:
+        workspace_dir = tempfile.mkdtemp(
+            dir='.', prefix='throughput_stats_workspace_')
+    else:
+        workspace_dir = args.workspace_dir
+        os.makedirs(workspace_dir, exist_ok=True)
+
+    raster_list = []
+    for dtype_id in args.dtypes:
+        for compression in supported_compression_list(args.compressions):
+            for layout in args.layouts:
+                for density in args.densities:
+                    raster_id = (
+                        f'{dtype_id}_{compression}_{layout}_{density}')
+                    raster_path = os.path.join(
+                        workspace_dir, f'{raster_id}.tif')
+                    LOGGER.info(f'generating {raster_path}')
+                    make_synthetic_raster(
+                        raster_path, args.n_rows, args.n_cols, dtype_id,
+                        compression, layout, density)
+                    raster_list.append((raster_path, {
+                        'raster_id': raster_id,
+                        'dtype': dtype_id,
+                        'compression': compression,
+                        'layout': layout,
+                        'density': density,
+                        'creation_options': creation_options(
+                            compression, layout, density == 'sparse',
+                            numpy.issubdtype(
+                                _DTYPE_MAP[dtype_id][1], numpy.floating)),
+                    }))
+    for raster_path in args.raster_path:
+        raster_list.append((raster_path, {
+            'raster_id': os.path.basename(raster_path),
+            'creation_options': None,
+        }))
+
+    target_path = os.path.join(workspace_dir, 'benchmark_target.tif')
+    try:
+        with open(output_path, 'w') as output_file:
+            print('benchmark,raster,largest_block,cache_mb,n_workers,'
+                  'seconds,mpixels_per_second')
+            for raster_path, raster_description in raster_list:
+                for benchmark, cache_mb, largest_block, n_workers in [
+                        (benchmark, cache_mb, largest_block, n_workers)
+                        for benchmark in args.benchmarks
+                        for cache_mb in args.cache_mb
+                        for largest_block in (
+                            [None] if benchmark == 'warp' else
+                            [2**exp for exp in args.block_exponents])
+                        for n_workers in (
+                            args.n_workers if benchmark in ('read', 'warp')
+                            else [1])]:
+                    if benchmark == 'write' and (
+                            raster_description['creation_options'] is None):
+                        continue
+                    gdal.SetCacheMax(cache_mb * 2**20)
+                    for repeat_index in range(args.repeat):
+                        if os.path.exists(target_path):
+                            os.remove(target_path)
+                        if benchmark == 'read':
+                            seconds, n_pixels = time_read(
+                                raster_path, largest_block, n_workers,
+                                cache_mb * 2**20)
+                        elif benchmark == 'write':
+                            seconds, n_pixels = time_write(
+                                raster_path, target_path, largest_block,
+                                raster_description['creation_options'])
+                        elif benchmark == 'raster_calculator':
+                            seconds, n_pixels = time_raster_calculator(
+                                raster_path, target_path, largest_block)
+                        elif benchmark == 'warp':
+                            seconds, n_pixels = time_warp(
+                                raster_path, target_path, n_workers)
+                        else:
+                            seconds, n_pixels = time_percentile(
+                                raster_path, largest_block)
+                        record = {
+                            'time': run_time.isoformat(),
+                            'benchmark': benchmark,
+                            'raster_path': raster_path,
+                            'largest_block': largest_block,
+                            'cache_mb': cache_mb,
+                            'n_workers': n_workers,
+                            'repeat_index': repeat_index,
+                            'seconds': seconds,
+                            'n_pixels': n_pixels,
+                            'mpixels_per_second': (
+                                n_pixels / seconds / 1e6 if seconds > 0
+                                else None),
+                        }
+                        record.update(raster_description)
+                        record.update(host_info_map)
+                        output_file.write(json.dumps(record) + '\n')
+                        output_file.flush()
+                        print(
+                            f'{benchmark},{raster_description["raster_id"]},'
+                            f'{largest_block},{cache_mb},{n_workers},'
+                            f'{seconds:.2f},'
+                            f'{record["mpixels_per_second"] or 0:.1f}')
+    finally:
+        if args.workspace_dir is None:
+            shutil.rmtree(workspace_dir, ignore_errors=True)
+    LOGGER.info(f'results in {output_path}')
+
+
+if __name__ == "__main__":
+    main()
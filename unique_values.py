@@ -1,11 +1,21 @@
-"""Calculate (Raster A - Raster B) but treat nodata as 0'."""
+"""Count the unique values of a raster and write them to a value/count table.
+
+Integer rasters are counted with ``numpy.bincount`` over each block's value
+range, float rasters with ``numpy.unique`` per block. Either way every
+block reduces to a sorted (value, count) pair of arrays, workers merge the
+pairs of the blocks they read, and the main process merges the workers'
+results. The output CSV has a ``value`` and a ``count`` column so it can be
+filled in and used directly as a ``reclassify_by_table.py`` table with
+``value`` as the base field.
+"""
 import argparse
 import logging
+import multiprocessing
 import os
-import shutil
 import time
 
 from ecoshard import geoprocessing
+from osgeo import gdal
 import numpy
 
 logging.basicConfig(
@@ -15,22 +25,162 @@ logging.basicConfig(
         ' [%(pathname)s.%(funcName)s:%(lineno)d] %(message)s'))
 LOGGER = logging.getLogger(__name__)
 
+# blocks with a value range wider than this are counted with numpy.unique
+# even if they're integers
+_MAX_BINCOUNT_RANGE = 2**24
+
+# a worker merges its pending block results once it holds this many
+_MERGE_EVERY_N_BLOCKS = 64
+
+
+def unique_value_counts(path_band, n_workers, largest_block=2**20):
+    """Count how many pixels of a raster band have each value.
+
+    Parameters:
+        path_band (tuple): (raster path, band index) to count.
+        n_workers (int): number of processes reading blocks in parallel.
+        largest_block (int): largest number of pixels to read at once.
+
+    Returns:
+        tuple of (value_array, count_array, nodata_count), ``value_array``
+        holds the sorted unique values of the band excluding nodata and NaN,
+        ``count_array`` the number of pixels with each value, and
+        ``nodata_count`` the number of nodata or NaN pixels.
+
+    """
+    offset_dict_list = list(geoprocessing.iterblocks(
+        path_band, largest_block=largest_block, offset_only=True))
+    n_workers = max(1, min(n_workers, len(offset_dict_list)))
+    # more chunks than workers so progress is reported as chunks finish
+    chunk_list = [
+        (path_band, list(offset_dict_array))
+        for offset_dict_array in numpy.array_split(
+            numpy.array(offset_dict_list, dtype=object),
+            min(len(offset_dict_list), n_workers * 8))
+        if len(offset_dict_array) > 0]
+
+    value_count_list = []
+    nodata_count = 0
+    last_time = time.time()
+    with multiprocessing.Pool(n_workers) as pool:
+        for chunk_index, (value_array, count_array, chunk_nodata_count) in (
+                enumerate(pool.imap_unordered(
+                    _unique_value_counts_in_windows, chunk_list))):
+            value_count_list.append((value_array, count_array))
+            nodata_count += chunk_nodata_count
+            if time.time()-last_time > 5.0:
+                LOGGER.info(
+                    f'{(chunk_index+1)/len(chunk_list)*100:.2f}% complete')
+                last_time = time.time()
+    value_array, count_array = _merge_value_counts(value_count_list)
+    return value_array, count_array, nodata_count
+
+
+def _unique_value_counts_in_windows(path_band_offset_dict_list):
+    """Count the unique values in a list of windows of one raster band.
+
+    Parameters:
+        path_band_offset_dict_list (tuple): (path_band, offset_dict_list)
+            where ``offset_dict_list`` holds ``iterblocks`` offset dicts.
+
+    Returns:
+        tuple of sorted (value_array, count_array) and the nodata count.
+
+    """
+    path_band, offset_dict_list = path_band_offset_dict_list
+    raster = gdal.OpenEx(path_band[0], gdal.OF_RASTER)
+    band = raster.GetRasterBand(path_band[1])
+    nodata = band.GetNoDataValue()
+    value_count_list = []
+    nodata_count = 0
+    for offset_dict in offset_dict_list:
+        array = band.ReadAsArray(**offset_dict)
+        valid_mask = numpy.ones(array.shape, dtype=bool)
+        if nodata is not None:
+            valid_mask &= array != nodata
+        if numpy.issubdtype(array.dtype, numpy.floating):
+            valid_mask &= ~numpy.isnan(array)
+        nodata_count += array.size - numpy.count_nonzero(valid_mask)
+        value_count_list.append(_block_value_counts(array[valid_mask]))
+        if len(value_count_list) >= _MERGE_EVERY_N_BLOCKS:
+            value_count_list = [_merge_value_counts(value_count_list)]
+    band = None
+    raster = None
+    value_array, count_array = _merge_value_counts(value_count_list)
+    return value_array, count_array, nodata_count
+
+
+def _block_value_counts(value_array):
+    """Return sorted unique values and their counts of a flat array."""
+    if value_array.size == 0:
+        return value_array, numpy.empty(0, dtype=numpy.int64)
+    if numpy.issubdtype(value_array.dtype, numpy.integer):
+        block_min = int(value_array.min())
+        if int(value_array.max()) - block_min < _MAX_BINCOUNT_RANGE:
+            count_array = numpy.bincount(
+                value_array.astype(numpy.int64) - block_min)
+            present_array = numpy.flatnonzero(count_array)
+            return (
+                (present_array + block_min).astype(value_array.dtype),
+                count_array[present_array])
+    return numpy.unique(value_array, return_counts=True)
+
+
+def _merge_value_counts(value_count_list):
+    """Merge sorted (value, count) array pairs, adding counts of equal values.
+
+    Parameters:
+        value_count_list (list): list of (value_array, count_array) pairs.
+
+    Returns:
+        merged (value_array, count_array) pair sorted by value.
+
+    """
+    value_array = numpy.concatenate([
+        value_array for value_array, _ in value_count_list])
+    count_array = numpy.concatenate([
+        count_array for _, count_array in value_count_list]).astype(
+            numpy.int64)
+    if value_array.size == 0:
+        return value_array, count_array
+    # each input is already sorted so a stable sort is a merge of runs
+    sort_order = numpy.argsort(value_array, kind='stable')
+    value_array = value_array[sort_order]
+    count_array = count_array[sort_order]
+    start_array = numpy.flatnonzero(numpy.concatenate((
+        [True], value_array[1:] != value_array[:-1])))
+    return (
+        value_array[start_array],
+        numpy.add.reduceat(count_array, start_array))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='list unique values in raster')
     parser.add_argument('raster_path', help='Path to raster')
+    parser.add_argument(
+        '--output_csv', help=(
+            'path to value/count table, defaults to '
+            '`unique_values_<raster name>.csv` in the current directory'))
+    parser.add_argument(
+        '--n_workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes to read blocks in parallel')
     args = parser.parse_args()
 
-    unique_set = set()
-    n_blocks = len(list(geoprocessing.iterblocks((args.raster_path, 1), largest_block=2**20, offset_only=True)))
-    blocks_left = n_blocks
-    last_time = time.time()
-    for _, array in geoprocessing.iterblocks((args.raster_path, 1), largest_block=2**20):
-        unique_set |= set(numpy.unique(array))
-        blocks_left -= 1
-        if time.time()-last_time > 5.0:
-            LOGGER.info(f'{(n_blocks-blocks_left)/n_blocks*100:.2f}% complete')
-            last_time = time.time()
-    set_string = "\n".join([str(x) for x in sorted(unique_set)])
+    value_array, count_array, nodata_count = unique_value_counts(
+        (args.raster_path, 1), args.n_workers)
+
+    output_csv_path = args.output_csv
+    if output_csv_path is None:
+        output_csv_path = 'unique_values_%s.csv' % os.path.splitext(
+            os.path.basename(args.raster_path))[0]
+    with open(output_csv_path, 'w') as output_csv_file:
+        output_csv_file.write('value,count\n')
+        for value, count in zip(value_array, count_array):
+            output_csv_file.write(f'{value},{count}\n')
+
+    set_string = "\n".join([str(x) for x in value_array])
     LOGGER.info(f'unique values in {args.raster_path}:\n{set_string}')
-    
\ No newline at end of file
+    LOGGER.info(
+        f'{nodata_count} nodata pixels, value counts written to '
+        f'{output_csv_path}')
@@ -1,14 +1,26 @@
-"""Command line script wrapping geoprocessing.raster_stats."""
+"""Command line script wrapping geoprocessing.raster_stats.
+
+With ``--shared_zone_raster`` the vector is rasterized once per raster grid
+to a raster of polygon FIDs, every raster matching the pattern is reduced
+against that zone raster block by block in a process pool with grouped
+``numpy.bincount`` style reductions, and the stats of all rasters are
+written to one table.
+"""
 import argparse
 import collections
 import datetime
 import glob
+import hashlib
 import logging
+import multiprocessing
 import os
 import sys
 
 from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
 from ecoshard import geoprocessing
+import numpy
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -22,6 +34,394 @@ logging.getLogger('taskgraph').setLevel(logging.INFO)
 
 WORKSPACE_DIR = 'zonal_stats_workspace'
 
+STAT_LIST = ['count', 'max', 'min', 'nodata_count', 'sum']
+
+# integer field holding each polygon's FID so it can be rasterized as a zone
+ZONE_FIELD = 'zone_fid'
+ZONE_NODATA = -1
+
+
+def get_fid_to_field_value(vector_path, field_name):
+    """Map every feature's FID to its ``field_name`` value in one pass."""
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    fid_to_field_val = {
+        feature.GetFID(): feature.GetField(field_name) for feature in layer}
+    layer = None
+    vector = None
+    return fid_to_field_val
+
+
+def aggregate_by_field(stat_dict, fid_to_field_val):
+    """Combine per FID stats into stats per field value.
+
+    Parameters:
+        stat_dict (dict): maps FID to a dict with the keys of ``STAT_LIST``,
+            'min' and 'max' are None if the FID had no valid pixels.
+        fid_to_field_val (dict): maps FID to its field value.
+
+    Returns:
+        dict mapping field value to a dict of the combined stats.
+
+    """
+    stat_by_fieldname_dict = collections.defaultdict(dict)
+    for fid, stats in stat_dict.items():
+        field_stat_dict = stat_by_fieldname_dict[fid_to_field_val[fid]]
+        for stat_id in STAT_LIST:
+            if stat_id not in field_stat_dict:
+                field_stat_dict[stat_id] = stats[stat_id]
+            elif stat_id in ('max', 'min'):
+                if stats[stat_id] is None:
+                    continue
+                if field_stat_dict[stat_id] is None:
+                    field_stat_dict[stat_id] = stats[stat_id]
+                else:
+                    field_stat_dict[stat_id] = (
+                        max if stat_id == 'max' else min)(
+                            field_stat_dict[stat_id], stats[stat_id])
+            else:
+                field_stat_dict[stat_id] += stats[stat_id]
+    return stat_by_fieldname_dict
+
+
+def _write_stat_row(table_file, prefix_list, stats):
+    """Write ``prefix_list``, the stats in ``STAT_LIST`` order, and mean."""
+    table_file.write(','.join([str(x) for x in prefix_list] + [
+        str(stats[stat_id]) for stat_id in STAT_LIST]))
+    if stats['count'] > 0:
+        table_file.write(f',{stats["sum"]/stats["count"]}\n')
+    else:
+        table_file.write(',NaN\n')
+
+
+def rasterize_zones(vector_path, base_raster_path, working_dir):
+    """Rasterize polygon FIDs onto the grid of ``base_raster_path``.
+
+    The zone raster is named by a hash of the grid and of the size and
+    modification time of the vector's files so rasters that share a grid
+    share one zone raster, it's only built once, and it's rebuilt if the
+    vector changes.
+
+    Parameters:
+        vector_path (str): path to polygon vector, polygons are assumed not
+            to overlap.
+        base_raster_path (str): raster whose grid and projection to use.
+        working_dir (str): directory to write the zone raster and the
+            projected vector to.
+
+    Returns:
+        tuple of (zone raster path, number of zones, projected vector path)
+        where zone ``i`` is the polygon with FID ``i``, pixels outside
+        every polygon are ``ZONE_NODATA``, and the projected vector holds
+        the polygons in the raster's projection with their FID in
+        ``ZONE_FIELD``.
+
+    """
+    raster_info = geoprocessing.get_raster_info(base_raster_path)
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    file_stat_list = []
+    for file_path in vector.GetFileList() or [vector_path]:
+        file_stat = os.stat(file_path)
+        file_stat_list.append((
+            os.path.abspath(file_path), file_stat.st_size,
+            file_stat.st_mtime_ns))
+    grid_hash = hashlib.md5(repr((
+        file_stat_list, tuple(raster_info['geotransform']),
+        tuple(raster_info['raster_size']),
+        raster_info['projection_wkt'])).encode('utf-8')).hexdigest()
+    zone_raster_path = os.path.join(working_dir, f'zones_{grid_hash}.tif')
+    projected_vector_path = os.path.join(
+        working_dir, f'zones_{grid_hash}.gpkg')
+
+    layer = vector.GetLayer()
+    n_zones = max([feature.GetFID() for feature in layer], default=-1) + 1
+    if os.path.exists(zone_raster_path):
+        return zone_raster_path, n_zones, projected_vector_path
+
+    # copy the polygons in the raster's projection with their original FIDs
+    # stored in ZONE_FIELD, a reprojected copy may renumber the FIDs
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromWkt(raster_info['projection_wkt'])
+    raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    vector_srs = layer.GetSpatialRef()
+    transform = None
+    if vector_srs is not None and not vector_srs.IsSame(raster_srs):
+        vector_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(vector_srs, raster_srs)
+    if os.path.exists(projected_vector_path):
+        os.remove(projected_vector_path)
+    projected_vector = gdal.GetDriverByName('GPKG').Create(
+        projected_vector_path, 0, 0, 0, gdal.GDT_Unknown)
+    projected_layer = projected_vector.CreateLayer(
+        'zones', raster_srs, ogr.wkbMultiPolygon)
+    projected_layer.CreateField(ogr.FieldDefn(ZONE_FIELD, ogr.OFTInteger))
+    projected_defn = projected_layer.GetLayerDefn()
+    projected_layer.StartTransaction()
+    layer.ResetReading()
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        if transform is not None:
+            geometry.Transform(transform)
+        projected_feature = ogr.Feature(projected_defn)
+        projected_feature.SetGeometry(geometry)
+        projected_feature.SetField(ZONE_FIELD, feature.GetFID())
+        projected_layer.CreateFeature(projected_feature)
+    projected_layer.CommitTransaction()
+    projected_layer = None
+    projected_vector = None
+    layer = None
+    vector = None
+
+    # build under a temporary name so a partial zone raster is never reused
+    working_zone_raster_path = os.path.join(
+        working_dir, f'working_zones_{grid_hash}.tif')
+    geoprocessing.new_raster_from_base(
+        base_raster_path, working_zone_raster_path, gdal.GDT_Int32,
+        [ZONE_NODATA], fill_value_list=[ZONE_NODATA])
+    geoprocessing.rasterize(
+        projected_vector_path, working_zone_raster_path,
+        option_list=[f'ATTRIBUTE={ZONE_FIELD}'])
+    os.replace(working_zone_raster_path, zone_raster_path)
+    return zone_raster_path, n_zones, projected_vector_path
+
+
+def _valid_mask(value_array, nodata):
+    """Return where ``value_array`` is neither ``nodata`` nor NaN."""
+    valid_mask = numpy.ones(value_array.shape, dtype=bool)
+    if nodata is not None:
+        valid_mask &= value_array != nodata
+    if numpy.issubdtype(value_array.dtype, numpy.floating):
+        valid_mask &= ~numpy.isnan(value_array)
+    return valid_mask
+
+
+def _unset_zone_stats(raster_path, projected_vector_path, fid_set):
+    """Stats of polygons that cover no pixel center from their envelopes.
+
+    Polygons smaller than a pixel are missed by the center rasterization,
+    so like ``geoprocessing.zonal_statistics`` the pixels that intersect
+    their bounding box are used as a proxy for the polygon.
+
+    Parameters:
+        raster_path (str): path to a single band raster.
+        projected_vector_path (str): polygons in the raster's projection
+            with their FID in ``ZONE_FIELD``, from ``rasterize_zones``.
+        fid_set (set): FIDs of the polygons to calculate stats for.
+
+    Returns:
+        dict mapping each FID in ``fid_set`` whose envelope overlaps the
+        raster to a dict of the stats in ``STAT_LIST``.
+
+    """
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    geotransform = raster.GetGeoTransform()
+    vector = gdal.OpenEx(projected_vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    stat_dict = {}
+    for feature in layer:
+        fid = feature.GetField(ZONE_FIELD)
+        if fid not in fid_set:
+            continue
+        min_x, max_x, min_y, max_y = feature.GetGeometryRef().GetEnvelope()
+        if geotransform[1] < 0:
+            min_x, max_x = max_x, min_x
+        if geotransform[5] < 0:
+            min_y, max_y = max_y, min_y
+        xoff = max(0, int((min_x - geotransform[0]) / geotransform[1]))
+        yoff = max(0, int((min_y - geotransform[3]) / geotransform[5]))
+        xend = min(band.XSize, int(numpy.ceil(
+            (max_x - geotransform[0]) / geotransform[1])))
+        yend = min(band.YSize, int(numpy.ceil(
+            (max_y - geotransform[3]) / geotransform[5])))
+        if xend <= xoff or yend <= yoff:
+            continue
+        value_array = band.ReadAsArray(
+            xoff=xoff, yoff=yoff, win_xsize=xend-xoff, win_ysize=yend-yoff)
+        valid_mask = _valid_mask(value_array, nodata)
+        valid_value_array = value_array[valid_mask].astype(numpy.float64)
+        stat_dict[fid] = {
+            'count': int(valid_value_array.size),
+            'max': (
+                float(numpy.max(valid_value_array))
+                if valid_value_array.size > 0 else None),
+            'min': (
+                float(numpy.min(valid_value_array))
+                if valid_value_array.size > 0 else None),
+            'nodata_count': int(numpy.count_nonzero(~valid_mask)),
+            'sum': float(numpy.sum(valid_value_array)),
+        }
+    layer = None
+    vector = None
+    band = None
+    raster = None
+    return stat_dict
+
+
+def _zone_stats_in_windows(job_tuple):
+    """Grouped count/sum/min/max/nodata_count over windows of one raster.
+
+    Parameters:
+        job_tuple (tuple): (raster path, zone raster path, number of zones,
+            list of ``iterblocks`` offset dicts to reduce).
+
+    Returns:
+        (raster path, stat array map) where the map has a length n_zones
+        array for each stat in ``STAT_LIST``, min and max are +/-inf for
+        zones without valid pixels.
+
+    """
+    raster_path, zone_raster_path, n_zones, offset_dict_list = job_tuple
+    count_array = numpy.zeros(n_zones, dtype=numpy.int64)
+    nodata_count_array = numpy.zeros(n_zones, dtype=numpy.int64)
+    sum_array = numpy.zeros(n_zones, dtype=numpy.float64)
+    min_array = numpy.full(n_zones, numpy.inf)
+    max_array = numpy.full(n_zones, -numpy.inf)
+
+    raster = gdal.OpenEx(raster_path, gdal.OF_RASTER)
+    band = raster.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    zone_raster = gdal.OpenEx(zone_raster_path, gdal.OF_RASTER)
+    zone_band = zone_raster.GetRasterBand(1)
+    for offset_dict in offset_dict_list:
+        zone_array = zone_band.ReadAsArray(**offset_dict)
+        zone_mask = zone_array != ZONE_NODATA
+        if not numpy.any(zone_mask):
+            continue
+        value_array = band.ReadAsArray(**offset_dict)
+        valid_mask = _valid_mask(value_array, nodata)
+
+        nodata_count_array += numpy.bincount(
+            zone_array[zone_mask & ~valid_mask], minlength=n_zones)
+        valid_mask &= zone_mask
+        valid_zone_array = zone_array[valid_mask]
+        if valid_zone_array.size == 0:
+            continue
+        valid_value_array = value_array[valid_mask].astype(numpy.float64)
+        count_array += numpy.bincount(valid_zone_array, minlength=n_zones)
+        sum_array += numpy.bincount(
+            valid_zone_array, weights=valid_value_array, minlength=n_zones)
+
+        # min and max by sorting on zone and reducing each run of equal zones
+        sort_order = numpy.argsort(valid_zone_array, kind='stable')
+        sorted_zone_array = valid_zone_array[sort_order]
+        sorted_value_array = valid_value_array[sort_order]
+        start_array = numpy.flatnonzero(numpy.concatenate((
+            [True], sorted_zone_array[1:] != sorted_zone_array[:-1])))
+        run_zone_array = sorted_zone_array[start_array]
+        min_array[run_zone_array] = numpy.minimum(
+            min_array[run_zone_array],
+            numpy.minimum.reduceat(sorted_value_array, start_array))
+        max_array[run_zone_array] = numpy.maximum(
+            max_array[run_zone_array],
+            numpy.maximum.reduceat(sorted_value_array, start_array))
+    band = None
+    raster = None
+    zone_band = None
+    zone_raster = None
+    return raster_path, {
+        'count': count_array, 'max': max_array, 'min': min_array,
+        'nodata_count': nodata_count_array, 'sum': sum_array}
+
+
+def shared_zone_statistics(
+        raster_path_list, vector_path, working_dir, n_workers,
+        largest_block=2**20):
+    """Zonal statistics of many rasters against one rasterized vector.
+
+    Parameters:
+        raster_path_list (list): paths to single band rasters.
+        vector_path (str): path to non-overlapping polygon vector.
+        working_dir (str): directory for zone rasters.
+        n_workers (int): number of processes to reduce blocks with.
+        largest_block (int): largest number of pixels to read at once.
+
+    Returns:
+        dict mapping each raster path to a dict mapping FID to a dict of the
+        stats in ``STAT_LIST``, in the same form as
+        ``geoprocessing.zonal_statistics``. Polygons that cover no pixel
+        center get the stats of the pixels under their bounding box as
+        that function does.
+
+    """
+    job_list = []
+    projected_vector_path_map = {}
+    for raster_path in raster_path_list:
+        zone_raster_path, n_zones, projected_vector_path = rasterize_zones(
+            vector_path, raster_path, working_dir)
+        projected_vector_path_map[raster_path] = projected_vector_path
+        offset_dict_list = list(geoprocessing.iterblocks(
+            (zone_raster_path, 1), largest_block=largest_block,
+            offset_only=True))
+        # several jobs per worker so rasters are balanced across the pool
+        n_jobs = max(1, min(len(offset_dict_list), n_workers * 4))
+        job_list.extend([
+            (raster_path, zone_raster_path, n_zones, list(offset_dict_array))
+            for offset_dict_array in numpy.array_split(
+                numpy.array(offset_dict_list, dtype=object), n_jobs)
+            if len(offset_dict_array) > 0])
+
+    stat_array_by_raster = {}
+    with multiprocessing.Pool(max(1, n_workers)) as pool:
+        for job_index, (raster_path, stat_array_map) in enumerate(
+                pool.imap_unordered(_zone_stats_in_windows, job_list)):
+            if raster_path not in stat_array_by_raster:
+                stat_array_by_raster[raster_path] = stat_array_map
+            else:
+                merged_map = stat_array_by_raster[raster_path]
+                for stat_id in ('count', 'nodata_count', 'sum'):
+                    merged_map[stat_id] += stat_array_map[stat_id]
+                merged_map['min'] = numpy.minimum(
+                    merged_map['min'], stat_array_map['min'])
+                merged_map['max'] = numpy.maximum(
+                    merged_map['max'], stat_array_map['max'])
+            LOGGER.info(
+                f'{(job_index+1)/len(job_list)*100:.2f}% of blocks reduced')
+
+    fid_list = _get_fid_list(vector_path)
+    stat_dict_by_raster = {}
+    for raster_path in raster_path_list:
+        stat_array_map = stat_array_by_raster[raster_path]
+        stat_dict_by_raster[raster_path] = {
+            fid: {
+                'count': int(stat_array_map['count'][fid]),
+                'max': (
+                    float(stat_array_map['max'][fid])
+                    if stat_array_map['count'][fid] > 0 else None),
+                'min': (
+                    float(stat_array_map['min'][fid])
+                    if stat_array_map['count'][fid] > 0 else None),
+                'nodata_count': int(stat_array_map['nodata_count'][fid]),
+                'sum': float(stat_array_map['sum'][fid]),
+            } for fid in fid_list}
+        unset_fid_set = set([
+            fid for fid in fid_list
+            if stat_array_map['count'][fid] == 0 and
+            stat_array_map['nodata_count'][fid] == 0])
+        if unset_fid_set:
+            LOGGER.debug(
+                f'{len(unset_fid_set)} polygons cover no pixel center of '
+                f'{raster_path}, using their bounding boxes')
+            stat_dict_by_raster[raster_path].update(_unset_zone_stats(
+                raster_path, projected_vector_path_map[raster_path],
+                unset_fid_set))
+    return stat_dict_by_raster
+
+
+def _get_fid_list(vector_path):
+    """Return the FIDs of the features in ``vector_path``."""
+    vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
+    layer = vector.GetLayer()
+    fid_list = [feature.GetFID() for feature in layer]
+    layer = None
+    vector = None
+    return fid_list
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='mult by columns script')
     parser.add_argument(
@@ -40,13 +440,66 @@ if __name__ == '__main__':
         '--polygons_overlap', action='store_true', help=(
             'set if polygons overlap and need zonal_statistics to be '
             'calculated individually for each'))
+    parser.add_argument(
+        '--shared_zone_raster', action='store_true', help=(
+            'rasterize the vector once and reuse it for every raster in '
+            'the pattern, reducing blocks in parallel and writing one '
+            'combined table, polygons must not overlap. Pixels are '
+            'assigned to the polygon covering their center, polygons that '
+            'cover no pixel center use the pixels under their bounding '
+            'box like the default zonal stats'))
+    parser.add_argument(
+        '--n_workers', type=int, default=multiprocessing.cpu_count(),
+        help='number of processes used with --shared_zone_raster')
     args = parser.parse_args()
+    if args.shared_zone_raster and args.polygons_overlap:
+        parser.error(
+            '--shared_zone_raster needs non-overlapping polygons, it can\'t '
+            'be used with --polygons_overlap')
 
     LOGGER.info(
         f'calculating zonal stats for {args.raster_pattern} '
         f'on {args.vector_path}')
     working_dir = os.path.join(WORKSPACE_DIR, 'zonal_stats')
     os.makedirs(working_dir, exist_ok=True)
+    fid_to_field_val = {}
+    if args.field_name:
+        fid_to_field_val = get_fid_to_field_value(
+            args.vector_path, args.field_name)
+
+    if args.shared_zone_raster:
+        raster_path_list = sorted(glob.glob(args.raster_pattern))
+        stat_dict_by_raster = shared_zone_statistics(
+            raster_path_list, args.vector_path, working_dir, args.n_workers)
+        time_str = str(datetime.datetime.utcnow()).replace(
+            '-', '_').replace(':', '_').replace('.', '_').replace(' ', '_')
+        vector_basename = os.path.basename(
+            os.path.splitext(args.vector_path)[0])
+        table_path = os.path.join(
+            WORKSPACE_DIR, f'{vector_basename}_{time_str}.csv')
+        LOGGER.info(f'*********** building table at {table_path}')
+        with open(table_path, 'w') as table_file:
+            table_file.write(f'{args.vector_path}\n')
+            table_file.write('raster,fid,')
+            if args.field_name:
+                table_file.write(f'{args.field_name},')
+            table_file.write(f'{",".join(STAT_LIST)},mean\n')
+            for raster_path in raster_path_list:
+                stat_dict = stat_dict_by_raster[raster_path]
+                for fid, stats in stat_dict.items():
+                    prefix_list = [raster_path, fid]
+                    if args.field_name:
+                        prefix_list.append(fid_to_field_val[fid])
+                    _write_stat_row(table_file, prefix_list, stats)
+                if args.field_name:
+                    for field_val, stats in aggregate_by_field(
+                            stat_dict, fid_to_field_val).items():
+                        _write_stat_row(
+                            table_file, [raster_path, 'BY FIELD', field_val],
+                            stats)
+        LOGGER.info(f'all done, table at {table_path}')
+        sys.exit(0)
+
     for raster_path in glob.glob(args.raster_pattern):
         LOGGER.info(f'processing {raster_path}')
         basename = os.path.basename(os.path.splitext(raster_path)[0])
@@ -55,49 +508,11 @@ if __name__ == '__main__':
             working_dir=working_dir,
             clean_working_dir=not args.keep_working_dir,
             polygons_might_overlap=args.polygons_overlap)
-        fid_to_field_val = {}
-        if args.field_name:
-            vector = gdal.OpenEx(args.vector_path, gdal.OF_VECTOR)
-            layer = vector.GetLayer()
-            fid_to_field_val = {
-                fid: layer.GetFeature(fid).GetField(args.field_name)
-                for fid in stat_dict
-            }
-            layer = None
-            vector = None
         time_str = str(datetime.datetime.utcnow()).replace(
             '-', '_').replace(':', '_').replace('.', '_').replace(' ', '_')
-        stat_list = ['count', 'max', 'min', 'nodata_count', 'sum']
         if args.field_name:
-            stat_by_fieldname_dict = collections.defaultdict(dict)
-            for fid, stats in stat_dict.items():
-                field_val = fid_to_field_val[fid]
-                field_stat_dict = stat_by_fieldname_dict[field_val]
-                for stat_id in stat_list:
-                    if stat_id not in field_stat_dict:
-                        field_stat_dict[stat_id] = stats[stat_id]
-                    else:
-                        if stat_id == 'max':
-                            if stats['max'] is None:
-                                continue
-                            if 'max' not in field_stat_dict or field_stat_dict[stat_id] is None:
-                                field_stat_dict['max'] = stats[stat_id]
-                            else:
-                                field_stat_dict[stat_id] = max(
-                                    field_stat_dict[stat_id],
-                                    stats[stat_id])
-                        elif stat_id == 'min':
-                            if stats['min'] is None:
-                                continue
-                            if 'min' not in field_stat_dict or field_stat_dict[stat_id] is None:
-                                field_stat_dict['min'] = stats[stat_id]
-                            else:
-                                field_stat_dict[stat_id] = min(
-                                    field_stat_dict[stat_id],
-                                    stats[stat_id])
-                        else:
-                            field_stat_dict[stat_id] += stats[stat_id]
-                stat_by_fieldname_dict[field_val] = field_stat_dict
+            stat_by_fieldname_dict = aggregate_by_field(
+                stat_dict, fid_to_field_val)
 
         table_path = os.path.join(WORKSPACE_DIR, f'{basename}_{time_str}.csv')
         LOGGER.info(f'*********** building table at {table_path}')
@@ -106,27 +521,15 @@ if __name__ == '__main__':
             table_file.write('fid,')
             if args.field_name:
                 table_file.write(f'{args.field_name},')
-            table_file.write(f'{",".join(stat_list)},mean\n')
+            table_file.write(f'{",".join(STAT_LIST)},mean\n')
             for fid, stats in stat_dict.items():
-                table_file.write(f'{fid},')
+                prefix_list = [fid]
                 if args.field_name:
-                    table_file.write(f'{fid_to_field_val[fid]},')
-                for stat_id in stat_list:
-                    table_file.write(f'{stats[stat_id]},')
-                if stats['count'] > 0:
-                    table_file.write(f'{stats["sum"]/stats["count"]}')
-                else:
-                    table_file.write('NaN')
-                table_file.write('\n')
+                    prefix_list.append(fid_to_field_val[fid])
+                _write_stat_row(table_file, prefix_list, stats)
             if args.field_name:
                 for field_name, stats in stat_by_fieldname_dict.items():
-                    table_file.write(f'BY FIELD,{field_name},')
-                    for stat_id in stat_list:
-                        table_file.write(f'{stats[stat_id]},')
-                    if stats['count'] > 0:
-                        table_file.write(f'{stats["sum"]/stats["count"]}')
-                    else:
-                        table_file.write('NaN')
-                    table_file.write('\n')
+                    _write_stat_row(
+                        table_file, ['BY FIELD', field_name], stats)
 
         LOGGER.info(f'all done, table at {table_path}')
@@ -1,4 +1,11 @@
-"""Calculate stats per landcover code type."""
+"""Calculate stats per landcover code type.
+
+The landcover and value rasters are read together once. Every block
+reduces to per code count, nodata count, sum, sum of squares, min, and max
+arrays indexed by the block's sorted codes, and those are merged across
+blocks and worker processes. Percentiles, if requested, take a second pass
+that builds a histogram per code. No intermediate rasters are written.
+"""
 import argparse
 import os
 import logging
@@ -12,7 +19,25 @@ from ecoshard import taskgraph
 import numpy
 
 gdal.SetCacheMax(2**26)
-_LARGEST_BLOCK = 2**26
+_LARGEST_BLOCK = 2**22
+
+# class codes spanning more than this are indexed with numpy.unique even if
+# they're integers
+_MAX_BINCOUNT_RANGE = 2**24
+
+# a worker merges its pending block results once it holds this many
+_MERGE_EVERY_N_BLOCKS = 64
+
+# stats accumulated per class and how partial results of a class combine
+_STAT_LIST = ['count', 'nodata_count', 'sum', 'sumsq', 'min', 'max']
+_STAT_REDUCE_MAP = {
+    'count': numpy.add,
+    'nodata_count': numpy.add,
+    'sum': numpy.add,
+    'sumsq': numpy.add,
+    'min': numpy.minimum,
+    'max': numpy.maximum,
+}
 
 _GTIFF_CREATION_TUPLE_OPTIONS = ('GTIFF', (
     geoprocessing.DEFAULT_GTIFF_CREATION_TUPLE_OPTIONS[1]) +
@@ -27,49 +52,308 @@ LOGGER = logging.getLogger(__name__)
 logging.getLogger('ecoshard.taskgraph').setLevel(logging.INFO)
 
 
-def mask_out_op(mask_data, base_data, mask_code, base_nodata):
-    """Return 1 where base data == mask_code, 0 or nodata othewise."""
-    result = numpy.full(base_data.shape, base_nodata, dtype=numpy.float32)
-    valid_mask = (mask_data == mask_code) & (~numpy.isnan(base_data))
-    if numpy.any(valid_mask):
-        result[valid_mask] = base_data[valid_mask]
-    else:
-        result = None
-    return result
-
-
-def _calculate_stats(
-        aligned_raster_path_list, mask_code, masked_nodata,
-        masked_raster_path):
-    LOGGER.debug(f'_calculate_stats for {masked_raster_path}')
-    geoprocessing.raster_calculator(
-        [(aligned_raster_path_list[0], 1), (aligned_raster_path_list[1], 1),
-         (mask_code, 'raw'), (masked_nodata, 'raw')],
-        mask_out_op, masked_raster_path, gdal.GDT_Float32,
-        masked_nodata,
-        raster_driver_creation_tuple=_GTIFF_CREATION_TUPLE_OPTIONS)
-    masked_raster = gdal.OpenEx(masked_raster_path, gdal.OF_RASTER)
-    masked_band = masked_raster.GetRasterBand(1)
-    n_pixels = masked_band.XSize * masked_band.YSize
-    LOGGER.debug(f'{n_pixels}')
-    (raster_min, raster_max, raster_mean, raster_stdev) = (
-        masked_band.GetStatistics(0, 1))
-    masked_band = None
-    masked_raster = None
-
-    LOGGER.debug(f'getting stats for {masked_raster_path}')
-    valid_count = 0
-    for offset_dict, masked_block in geoprocessing.iterblocks(
-            (masked_raster_path, 1), largest_block=_LARGEST_BLOCK,
-            skip_sparse=True):
-        valid_mask = (masked_block != masked_nodata)
-        valid_count += numpy.count_nonzero(valid_mask)
-
-    nodata_count = n_pixels - valid_count
-    LOGGER.debug(f'{valid_count}')
-
-    return (raster_min, raster_max, raster_mean,
-            raster_stdev, valid_count, nodata_count)
+def grouped_stats(
+        class_raster_path_band, value_raster_path_band, value_nodata,
+        n_workers, largest_block=_LARGEST_BLOCK):
+    """Per class stats of a value raster in one read of both rasters.
+
+    Parameters:
+        class_raster_path_band (tuple): (path, band index) of the class
+            (e.g. landcover) raster, its nodata pixels are skipped.
+        value_raster_path_band (tuple): (path, band index) of a raster on
+            the same grid to take stats of.
+        value_nodata (numeric): nodata of the value raster, NaN is also
+            treated as nodata.
+        n_workers (int): number of processes reading blocks in parallel.
+        largest_block (int): largest number of pixels to read at once.
+
+    Returns:
+        tuple of (class_array, stat_map) where ``class_array`` holds the
+        sorted class codes present in the class raster and ``stat_map`` maps
+        each of ``_STAT_LIST`` to an array parallel to ``class_array``.
+
+    """
+    chunk_list = _chunk_windows(
+        class_raster_path_band, n_workers, largest_block)
+    with multiprocessing.Pool(max(1, n_workers)) as pool:
+        grouped_stats_list = []
+        last_time = time.time()
+        for chunk_index, grouped_stats_tuple in enumerate(
+                pool.imap_unordered(_grouped_stats_in_windows, [
+                    (class_raster_path_band, value_raster_path_band,
+                     value_nodata, offset_dict_list)
+                    for offset_dict_list in chunk_list])):
+            grouped_stats_list.append(grouped_stats_tuple)
+            if time.time()-last_time > 5.0:
+                LOGGER.info(
+                    f'{(chunk_index+1)/len(chunk_list)*100:.2f}% complete')
+                last_time = time.time()
+    return _merge_grouped_stats(grouped_stats_list)
+
+
+def grouped_percentiles(
+        class_raster_path_band, value_raster_path_band, value_nodata,
+        class_array, min_array, max_array, percentile_list, n_bins,
+        n_workers, largest_block=_LARGEST_BLOCK):
+    """Approximate per class percentiles from per class histograms.
+
+    Each class gets ``n_bins`` equal width bins between its min and max and
+    percentiles are linearly interpolated within a bin, so they are accurate
+    to a fraction of (max-min)/n_bins.
+
+    Parameters:
+        class_raster_path_band (tuple): as in ``grouped_stats``.
+        value_raster_path_band (tuple): as in ``grouped_stats``.
+        value_nodata (numeric): as in ``grouped_stats``.
+        class_array (numpy.ndarray): sorted class codes from
+            ``grouped_stats``.
+        min_array (numpy.ndarray): per class min from ``grouped_stats``.
+        max_array (numpy.ndarray): per class max from ``grouped_stats``.
+        percentile_list (list): percentiles in [0, 100] to calculate.
+        n_bins (int): number of histogram bins per class.
+        n_workers (int): number of processes reading blocks in parallel.
+        largest_block (int): largest number of pixels to read at once.
+
+    Returns:
+        (n_classes, len(percentile_list)) array of percentiles, NaN for
+        classes without valid values.
+
+    """
+    chunk_list = _chunk_windows(
+        class_raster_path_band, n_workers, largest_block)
+    histogram_array = numpy.zeros((len(class_array), n_bins), numpy.int64)
+    with multiprocessing.Pool(max(1, n_workers)) as pool:
+        for chunk_histogram_array in pool.imap_unordered(
+                _class_histograms_in_windows, [
+                    (class_raster_path_band, value_raster_path_band,
+                     value_nodata, class_array, min_array, max_array, n_bins,
+                     offset_dict_list)
+                    for offset_dict_list in chunk_list]):
+            histogram_array += chunk_histogram_array
+
+    percentile_array = numpy.full(
+        (len(class_array), len(percentile_list)), numpy.nan)
+    bin_edge_fraction_array = numpy.arange(n_bins+1) / n_bins
+    for class_index, class_histogram in enumerate(histogram_array):
+        n_values = class_histogram.sum()
+        if n_values == 0:
+            continue
+        # interpolate rank against the cumulative count at each bin edge
+        percentile_array[class_index, :] = numpy.interp(
+            numpy.asarray(percentile_list) / 100 * n_values,
+            numpy.concatenate(([0], numpy.cumsum(class_histogram))),
+            min_array[class_index] + bin_edge_fraction_array * (
+                max_array[class_index] - min_array[class_index]))
+    return percentile_array
+
+
+def _chunk_windows(raster_path_band, n_workers, largest_block):
+    """Split the block windows of a raster into lists for the workers."""
+    offset_dict_list = list(geoprocessing.iterblocks(
+        raster_path_band, largest_block=largest_block, offset_only=True))
+    # more chunks than workers so progress is reported as chunks finish
+    return [
+        list(offset_dict_array)
+        for offset_dict_array in numpy.array_split(
+            numpy.array(offset_dict_list, dtype=object),
+            max(1, min(len(offset_dict_list), n_workers * 8)))
+        if len(offset_dict_array) > 0]
+
+
+def _read_class_values(
+        class_band, class_nodata, value_band, value_nodata, offset_dict):
+    """Read one window of both rasters.
+
+    Returns:
+        tuple of (class codes, values, value valid mask) for the pixels of
+        the window whose class is not nodata.
+
+    """
+    class_array = class_band.ReadAsArray(**offset_dict)
+    class_valid_mask = numpy.ones(class_array.shape, dtype=bool)
+    if class_nodata is not None:
+        class_valid_mask &= class_array != class_nodata
+    if numpy.issubdtype(class_array.dtype, numpy.floating):
+        class_valid_mask &= ~numpy.isnan(class_array)
+    value_array = value_band.ReadAsArray(**offset_dict)[class_valid_mask]
+    value_valid_mask = ~numpy.isnan(value_array)
+    if value_nodata is not None:
+        value_valid_mask &= value_array != value_nodata
+    return (
+        class_array[class_valid_mask], value_array.astype(numpy.float64),
+        value_valid_mask)
+
+
+def _grouped_stats_in_windows(job_tuple):
+    """Grouped stats over a list of windows.
+
+    Parameters:
+        job_tuple (tuple): (class raster path band, value raster path band,
+            value nodata, list of ``iterblocks`` offset dicts).
+
+    Returns:
+        (class_array, stat_map) as in ``grouped_stats`` or None if no
+        window has a class pixel.
+
+    """
+    (class_raster_path_band, value_raster_path_band, value_nodata,
+     offset_dict_list) = job_tuple
+    class_raster = gdal.OpenEx(class_raster_path_band[0], gdal.OF_RASTER)
+    class_band = class_raster.GetRasterBand(class_raster_path_band[1])
+    class_nodata = class_band.GetNoDataValue()
+    value_raster = gdal.OpenEx(value_raster_path_band[0], gdal.OF_RASTER)
+    value_band = value_raster.GetRasterBand(value_raster_path_band[1])
+
+    grouped_stats_list = []
+    for offset_dict in offset_dict_list:
+        code_array, value_array, value_valid_mask = _read_class_values(
+            class_band, class_nodata, value_band, value_nodata, offset_dict)
+        if code_array.size == 0:
+            continue
+        class_array, class_index_array = _class_index(code_array)
+        n_classes = len(class_array)
+        valid_index_array = class_index_array[value_valid_mask]
+        valid_value_array = value_array[value_valid_mask]
+        min_array, max_array = _grouped_min_max(
+            valid_index_array, valid_value_array, n_classes)
+        grouped_stats_list.append((class_array, {
+            'count': numpy.bincount(valid_index_array, minlength=n_classes),
+            'nodata_count': numpy.bincount(
+                class_index_array[~value_valid_mask], minlength=n_classes),
+            'sum': numpy.bincount(
+                valid_index_array, weights=valid_value_array,
+                minlength=n_classes),
+            'sumsq': numpy.bincount(
+                valid_index_array, weights=valid_value_array**2,
+                minlength=n_classes),
+            'min': min_array,
+            'max': max_array,
+        }))
+        if len(grouped_stats_list) >= _MERGE_EVERY_N_BLOCKS:
+            grouped_stats_list = [_merge_grouped_stats(grouped_stats_list)]
+    class_band = None
+    class_raster = None
+    value_band = None
+    value_raster = None
+    if not grouped_stats_list:
+        return None
+    return _merge_grouped_stats(grouped_stats_list)
+
+
+def _class_histograms_in_windows(job_tuple):
+    """Per class histograms over a list of windows.
+
+    Parameters:
+        job_tuple (tuple): (class raster path band, value raster path band,
+            value nodata, class array, min array, max array, number of
+            bins, list of ``iterblocks`` offset dicts).
+
+    Returns:
+        (n_classes, n_bins) int64 array of counts.
+
+    """
+    (class_raster_path_band, value_raster_path_band, value_nodata,
+     class_array, min_array, max_array, n_bins, offset_dict_list) = job_tuple
+    class_raster = gdal.OpenEx(class_raster_path_band[0], gdal.OF_RASTER)
+    class_band = class_raster.GetRasterBand(class_raster_path_band[1])
+    class_nodata = class_band.GetNoDataValue()
+    value_raster = gdal.OpenEx(value_raster_path_band[0], gdal.OF_RASTER)
+    value_band = value_raster.GetRasterBand(value_raster_path_band[1])
+
+    span_array = max_array - min_array
+    span_array[~(span_array > 0)] = 1.0
+    histogram_array = numpy.zeros(len(class_array) * n_bins, numpy.int64)
+    for offset_dict in offset_dict_list:
+        code_array, value_array, value_valid_mask = _read_class_values(
+            class_band, class_nodata, value_band, value_nodata, offset_dict)
+        class_index_array = numpy.searchsorted(
+            class_array, code_array[value_valid_mask])
+        bin_array = numpy.clip((
+            (value_array[value_valid_mask] - min_array[class_index_array]) /
+            span_array[class_index_array] * n_bins).astype(numpy.int64),
+            0, n_bins-1)
+        histogram_array += numpy.bincount(
+            class_index_array * n_bins + bin_array,
+            minlength=histogram_array.size)
+    class_band = None
+    class_raster = None
+    value_band = None
+    value_raster = None
+    return histogram_array.reshape((len(class_array), n_bins))
+
+
+def _class_index(code_array):
+    """Return the sorted unique codes and each code's index into them."""
+    if numpy.issubdtype(code_array.dtype, numpy.integer):
+        code_min = int(code_array.min())
+        if int(code_array.max()) - code_min < _MAX_BINCOUNT_RANGE:
+            offset_array = code_array.astype(numpy.int64) - code_min
+            present_array = numpy.flatnonzero(numpy.bincount(offset_array))
+            index_lookup = numpy.empty(
+                present_array[-1]+1, dtype=numpy.int64)
+            index_lookup[present_array] = numpy.arange(len(present_array))
+            return (
+                (present_array + code_min).astype(code_array.dtype),
+                index_lookup[offset_array])
+    return numpy.unique(code_array, return_inverse=True)
+
+
+def _grouped_min_max(index_array, value_array, n_groups):
+    """Min and max of ``value_array`` per group index, +/-inf if empty."""
+    min_array = numpy.full(n_groups, numpy.inf)
+    max_array = numpy.full(n_groups, -numpy.inf)
+    if index_array.size == 0:
+        return min_array, max_array
+    # sort on group then reduce each run of equal groups
+    sort_order = numpy.argsort(index_array, kind='stable')
+    sorted_index_array = index_array[sort_order]
+    sorted_value_array = value_array[sort_order]
+    start_array = numpy.flatnonzero(numpy.concatenate((
+        [True], sorted_index_array[1:] != sorted_index_array[:-1])))
+    run_index_array = sorted_index_array[start_array]
+    min_array[run_index_array] = numpy.minimum.reduceat(
+        sorted_value_array, start_array)
+    max_array[run_index_array] = numpy.maximum.reduceat(
+        sorted_value_array, start_array)
+    return min_array, max_array
+
+
+def _merge_grouped_stats(grouped_stats_list):
+    """Merge (class_array, stat_map) pairs, combining stats of equal codes.
+
+    Parameters:
+        grouped_stats_list (list): list of (class_array, stat_map) pairs as
+            returned by ``grouped_stats``, None entries from windows
+            without class pixels are skipped.
+
+    Returns:
+        merged (class_array, stat_map) pair sorted by class code.
+
+    """
+    grouped_stats_list = [
+        grouped_stats_tuple for grouped_stats_tuple in grouped_stats_list
+        if grouped_stats_tuple is not None]
+    if not grouped_stats_list:
+        # keep the dtypes of non-empty results so nothing upcasts
+        return numpy.empty(0, dtype=numpy.int64), {
+            stat_id: numpy.empty(0, dtype=(
+                numpy.int64 if stat_id in ('count', 'nodata_count')
+                else numpy.float64))
+            for stat_id in _STAT_LIST}
+    class_array = numpy.concatenate([
+        class_array for class_array, _ in grouped_stats_list])
+    sort_order = numpy.argsort(class_array, kind='stable')
+    class_array = class_array[sort_order]
+    start_array = numpy.flatnonzero(numpy.concatenate((
+        [True], class_array[1:] != class_array[:-1])))
+    merged_stat_map = {}
+    for stat_id in _STAT_LIST:
+        stat_array = numpy.concatenate([
+            stat_map[stat_id] for _, stat_map in grouped_stats_list])[
+                sort_order]
+        merged_stat_map[stat_id] = _STAT_REDUCE_MAP[stat_id].reduceat(
+            stat_array, start_array)
+    return class_array[start_array], merged_stat_map
 
 
 if __name__ == '__main__':
@@ -98,6 +382,14 @@ if __name__ == '__main__':
         '--ndv', type=float, help=(
             'set the nodata value if one is not defined or you wish to '
             'override that value when calculating statistics'))
+    parser.add_argument(
+        '--percentiles', type=float, nargs='+', help=(
+            'also report these percentiles per landcover code, approximated '
+            'from per code histograms in a second pass'))
+    parser.add_argument(
+        '--n_histogram_bins', type=int, default=1000, help=(
+            'number of histogram bins per landcover code used for '
+            '--percentiles'))
     args = parser.parse_args()
     if args.basename:
         basename = args.basename
@@ -106,8 +398,7 @@ if __name__ == '__main__':
             f'{args.landcover_raster}_{args.other_raster}'.encode(
                 'utf-8')).hexdigest()[:12]
         basename += '_'+time.strftime("%Y_%m_%d_%H_%M_%S", time.gmtime())
-    working_dir = os.path.join(args.working_dir, basename)
-    os.makedirs(working_dir, exist_ok=True)
+    os.makedirs(args.working_dir, exist_ok=True)
 
     task_graph = taskgraph.TaskGraph(args.working_dir, args.n_workers, 15.0)
     other_raster_info = geoprocessing.get_raster_info(args.other_raster)
@@ -143,7 +434,7 @@ if __name__ == '__main__':
         else:
             interpolation_list = ['near', 'near']
 
-        align_task = task_graph.add_task(
+        task_graph.add_task(
             func=geoprocessing.align_and_resize_raster_stack,
             args=(
                 base_raster_path_list, aligned_raster_path_list,
@@ -159,47 +450,46 @@ if __name__ == '__main__':
             task_name=f'aligning {aligned_raster_path_list}')
     else:
         aligned_raster_path_list = base_raster_path_list
-        align_task = task_graph.add_task()
-    task_graph.join()
-    lulc_nodata = geoprocessing.get_raster_info(
-        args.landcover_raster)['nodata']
-    LOGGER.info('calculate unique values')
-    unique_value_task = task_graph.add_task(
-        func=geoprocessing.get_unique_values,
-        args=((args.landcover_raster, 1),),
-        store_result=True,
-        dependent_task_list=[align_task],
-        task_name=f'unique values for {args.landcover_raster}')
-    unique_values = unique_value_task.get()
-    LOGGER.debug(unique_values)
-    stats_table = open(f'stats_table_{basename}.csv', 'w')
-    stats_table.write(
-        'lucode,min,max,mean,stdev,valid_count,nodata_count,total\n')
-
-    masked_stats_list = []
-    for mask_code in sorted(unique_values):
-        LOGGER.debug(f'scheduling {mask_code}')
-        masked_raster_path = os.path.join(working_dir, '%d.tif' % mask_code)
-        stats_task = task_graph.add_task(
-            func=_calculate_stats,
-            args=(
-                aligned_raster_path_list, mask_code, other_nodata,
-                masked_raster_path),
-            store_result=True,
-            dependent_task_list=[unique_value_task],
-            target_path_list=[masked_raster_path],
-            task_name=f'mask {masked_raster_path}')
-        masked_stats_list.append((stats_task, mask_code))
-
-    LOGGER.debug('waiting for it to gadot')
-    for masked_task, mask_code in masked_stats_list:
-        (raster_min, raster_max, raster_mean,
-         raster_stdev, valid_count, nodata_count) = masked_task.get()
-        stats_table.write(
-            '%d,%f,%f,%f,%f,%d,%d,%d\n' % (
-                mask_code, raster_min, raster_max, raster_mean, raster_stdev,
-                valid_count, nodata_count, valid_count+nodata_count))
-    stats_table.close()
-
     task_graph.join()
     task_graph.close()
+
+    LOGGER.info('calculate stats per landcover code')
+    class_array, stat_map = grouped_stats(
+        (aligned_raster_path_list[0], 1), (aligned_raster_path_list[1], 1),
+        other_nodata, args.n_workers)
+    percentile_list = args.percentiles or []
+    if percentile_list:
+        LOGGER.info('calculate percentiles per landcover code')
+        percentile_array = grouped_percentiles(
+            (aligned_raster_path_list[0], 1),
+            (aligned_raster_path_list[1], 1), other_nodata, class_array,
+            stat_map['min'], stat_map['max'], percentile_list,
+            args.n_histogram_bins, args.n_workers)
+
+    with open(f'stats_table_{basename}.csv', 'w') as stats_table:
+        stats_table.write(
+            'lucode,min,max,mean,stdev,sum,valid_count,nodata_count,total' +
+            ''.join([f',p{percentile:g}' for percentile in percentile_list]) +
+            '\n')
+        for class_index, lucode in enumerate(class_array):
+            valid_count = stat_map['count'][class_index]
+            nodata_count = stat_map['nodata_count'][class_index]
+            if valid_count > 0:
+                value_mean = stat_map['sum'][class_index] / valid_count
+                # population stdev as GetStatistics reports
+                value_stdev = numpy.sqrt(max(
+                    0.0, stat_map['sumsq'][class_index] / valid_count -
+                    value_mean**2))
+                value_min = stat_map['min'][class_index]
+                value_max = stat_map['max'][class_index]
+            else:
+                value_mean = value_stdev = value_min = value_max = numpy.nan
+            stats_table.write(
+                f'{lucode},{value_min:f},{value_max:f},{value_mean:f},'
+                f'{value_stdev:f},{stat_map["sum"][class_index]:f},'
+                f'{valid_count},{nodata_count},{valid_count+nodata_count}')
+            if percentile_list:
+                stats_table.write(''.join([
+                    f',{percentile_value:f}'
+                    for percentile_value in percentile_array[class_index]]))
+            stats_table.write('\n')